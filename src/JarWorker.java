@@ -0,0 +1,112 @@
+import java.io.BufferedReader;
+import java.io.ByteArrayOutputStream;
+import java.io.File;
+import java.io.FileDescriptor;
+import java.io.FileOutputStream;
+import java.io.InputStreamReader;
+import java.io.OutputStream;
+import java.io.PrintStream;
+import java.lang.reflect.InvocationTargetException;
+import java.lang.reflect.Method;
+import java.net.URL;
+import java.net.URLClassLoader;
+import java.nio.charset.StandardCharsets;
+import java.security.Permission;
+import java.util.Arrays;
+import java.util.jar.Attributes;
+import java.util.jar.JarFile;
+
+/**
+ * Keeps the main class of a jar loaded and runs it for every job read from stdin, so jobs skip JVM startup and
+ * reuse classes compiled by the JIT.
+ *
+ * Requests are lines, "PING" is answered by "PONG" and "RUN" followed by tab separated arguments runs a job.
+ * A job is answered by "DONE exit_code stdout_length stderr_length" and the bytes of its stdout and stderr.
+ * Started in source file mode by jvm_worker.py, the jar path is the only argument.
+ */
+public class JarWorker {
+    static class ExitException extends SecurityException {
+        final int status;
+
+        ExitException(int status) {
+            this.status = status;
+        }
+    }
+
+    public static void main(String[] args) throws Exception {
+        File jar = new File(args[0]);
+        String mainClassName;
+        try (JarFile jarFile = new JarFile(jar)) {
+            mainClassName = jarFile.getManifest().getMainAttributes().getValue(Attributes.Name.MAIN_CLASS);
+        }
+        // Class-Path of the manifest is followed by the loader, like with java -jar
+        URLClassLoader loader = new URLClassLoader(new URL[]{jar.toURI().toURL()}, JarWorker.class.getClassLoader());
+        Thread.currentThread().setContextClassLoader(loader);
+        Method main = loader.loadClass(mainClassName).getMethod("main", String[].class);
+
+        // Jobs call System.exit when they are done, it has to end the job instead of the worker
+        System.setSecurityManager(new SecurityManager() {
+            @Override
+            public void checkExit(int status) {
+                throw new ExitException(status);
+            }
+
+            @Override
+            public void checkPermission(Permission permission) {
+            }
+
+            @Override
+            public void checkPermission(Permission permission, Object context) {
+            }
+        });
+
+        OutputStream protocol = new FileOutputStream(FileDescriptor.out);
+        PrintStream stdout = System.out;
+        PrintStream stderr = System.err;
+        BufferedReader reader = new BufferedReader(new InputStreamReader(System.in, StandardCharsets.UTF_8));
+
+        String line;
+        while ((line = reader.readLine()) != null) {
+            if (line.equals("PING")) {
+                protocol.write("PONG\n".getBytes(StandardCharsets.UTF_8));
+                protocol.flush();
+                continue;
+            }
+
+            String[] parts = line.split("\t", -1);
+            String[] jobArgs = Arrays.copyOfRange(parts, 1, parts.length);
+            ByteArrayOutputStream jobStdout = new ByteArrayOutputStream();
+            ByteArrayOutputStream jobStderr = new ByteArrayOutputStream();
+            System.setOut(new PrintStream(jobStdout, true, StandardCharsets.UTF_8));
+            System.setErr(new PrintStream(jobStderr, true, StandardCharsets.UTF_8));
+
+            int status = 0;
+            try {
+                main.invoke(null, (Object) jobArgs);
+            } catch (InvocationTargetException e) {
+                Throwable cause = e.getCause();
+                if (cause instanceof ExitException) {
+                    status = ((ExitException) cause).status;
+                } else {
+                    cause.printStackTrace();
+                    status = 1;
+                }
+            } finally {
+                System.out.flush();
+                System.err.flush();
+                System.setOut(stdout);
+                System.setErr(stderr);
+            }
+
+            byte[] stdoutBytes = jobStdout.toByteArray();
+            byte[] stderrBytes = jobStderr.toByteArray();
+            protocol.write(("DONE " + status + " " + stdoutBytes.length + " " + stderrBytes.length + "\n")
+                    .getBytes(StandardCharsets.UTF_8));
+            protocol.write(stdoutBytes);
+            protocol.write(stderrBytes);
+            protocol.flush();
+        }
+        // Threads left by jobs must not keep the worker alive, exit is blocked by the security manager
+        Runtime.getRuntime().halt(0);
+    }
+}
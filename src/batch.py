@@ -0,0 +1,197 @@
+import argparse
+import math
+import shutil
+import tempfile
+from datetime import datetime
+from pathlib import Path
+from typing import List, Tuple
+
+from extract import OSMExtract
+from internet import Fetcher, SRTMCache, download_map_data, download_SRTM_data
+from main import (CONFIG_FILE, convert_osm_data, convert_region_draft, convert_region_tiled, get_map_bboxes,
+                  get_SRTM_path, get_SRTM_tiles, prune_stage_store, read_config, save_region_file, voxelize_region)
+from scheduler import Pipeline, Stage, create_executor, create_thread_executor
+
+
+def get_rectangle_regions(min_x: int, min_z: int, max_x: int, max_z: int) -> List[Tuple[int, int]]:
+    """ Returns coordinates of regions in the rectangle, both corners are inclusive. """
+    return [(region_x, region_z) for region_z in range(min(min_z, max_z), max(min_z, max_z) + 1)
+            for region_x in range(min(min_x, max_x), max(min_x, max_x) + 1)]
+
+
+def parse_region(value: str) -> Tuple[int, int]:
+    region_x, region_z = value.split(',')
+    return int(region_x), int(region_z)
+
+
+def split_bboxes(map_bboxes: List[tuple], piece_size: float) -> List[tuple]:
+    """
+    Covers the bboxes with a grid of pieces at most piece_size degrees wide, pieces outside all bboxes are skipped.
+
+    Windows of neighbouring regions overlap, so the pieces download every area once.
+    """
+    south = min(bbox[0][0] for bbox in map_bboxes)
+    west = min(bbox[0][1] for bbox in map_bboxes)
+    north = max(bbox[1][0] for bbox in map_bboxes)
+    east = max(bbox[1][1] for bbox in map_bboxes)
+
+    rows_count = max(math.ceil((north - south) / piece_size), 1)
+    columns_count = max(math.ceil((east - west) / piece_size), 1)
+    lat_step, lon_step = (north - south) / rows_count, (east - west) / columns_count
+
+    pieces = []
+    for row in range(rows_count):
+        for column in range(columns_count):
+            piece = ((south + row * lat_step, west + column * lon_step),
+                     (south + (row + 1) * lat_step, west + (column + 1) * lon_step))
+            if any(piece[0][0] <= bbox[1][0] and bbox[0][0] <= piece[1][0] and
+                   piece[0][1] <= bbox[1][1] and bbox[0][1] <= piece[1][1] for bbox in map_bboxes):
+                pieces.append(piece)
+    return pieces
+
+
+def download_batch_data(config: dict, map_bboxes: List[tuple], SRTM_path: Path,
+                        temporary_directory_path: Path) -> OSMExtract:
+    """
+    Downloads SRTM tiles and osm data covering all bboxes, each tile and each area only once.
+
+    Returns the osm data as an extract to slice region bboxes from. Pieces are cached like single region
+    downloads, so reruns of the batch are served from disk.
+    """
+    with Fetcher(config['workers'], config['host_connections']) as fetcher:
+        SRTM_cache = SRTMCache(fetcher, config['SRTM_url'], Path(config['SRTM_cache_path']),
+                               config['SRTM_links_ttl'])
+        SRTM_tiles = sorted({tile for map_bbox in map_bboxes for tile in get_SRTM_tiles(map_bbox)})
+        SRTM_futures = [fetcher.submit(download_SRTM_data, SRTM_cache, SRTM_path, lat, lon)
+                        for lat, lon in SRTM_tiles]
+
+        if config['extract_path']:
+            extract = OSMExtract([Path(config['extract_path'])], Path(config['extract_index_path']))
+        else:
+            pieces_paths = []
+            pieces_futures = []
+            for i, piece in enumerate(split_bboxes(map_bboxes, config['batch_piece_size'])):
+                pieces_paths.append(temporary_directory_path / f'map_data_{i}.osm')
+                pieces_futures.append(fetcher.submit(download_map_data, fetcher, config, piece, pieces_paths[-1]))
+            for future in pieces_futures:
+                future.result()
+            extract = OSMExtract(pieces_paths, temporary_directory_path / 'map_data.sqlite')
+        map_future = fetcher.submit(extract.ensure_index)
+
+        for future in SRTM_futures:
+            print(future.result())
+        map_future.result()
+    return extract
+
+
+def batch(config: dict, regions: List[Tuple[int, int]], region_directory_path: Path):
+    """
+    Imports several regions sharing their downloads, every region is converted like by the single region CLI.
+
+    Regions go through a pipeline, so slicing osm data and running OSM2World for the next regions overlaps with
+    voxelization and saving of the previous ones. Voxelization of all regions shares one process pool.
+    """
+    start_time = datetime.now()
+
+    print(f'Initialized with center coordinates at: ({config["map"]["center_lat"]}, {config["map"]["center_lon"]})')
+
+    map_bboxes = get_map_bboxes(config, regions)
+
+    SRTM_path = get_SRTM_path(config)
+    SRTM_path.mkdir(parents=True, exist_ok=True)
+    prune_stage_store(config)
+
+    with tempfile.TemporaryDirectory() as temporary_directory_path_plain:
+        temporary_directory_path = Path(temporary_directory_path_plain)
+        print(f'Downloading SRTM and osm data for {len(regions)} regions')
+
+        extract = download_batch_data(config['downloader'], map_bboxes, SRTM_path, temporary_directory_path)
+
+        print('Download complete!')
+
+        def slice_region(region):
+            (region_x, region_z), map_bbox = region
+            print(f'Importing region ({region_x}, {region_z})')
+            region_temporary_directory_path = Path(tempfile.mkdtemp(dir=temporary_directory_path))
+            osm_file_path = region_temporary_directory_path / 'map_data.osm'
+            extract.write_bbox(map_bbox, osm_file_path)
+            return region_x, region_z, region_temporary_directory_path, osm_file_path
+
+        def convert_region_osm_data(region):
+            region_x, region_z, region_temporary_directory_path, osm_file_path = region
+            return (region_x, region_z, region_temporary_directory_path,
+                    convert_osm_data(config, region_x, region_z, region_temporary_directory_path, osm_file_path))
+
+        def voxelize(region):
+            region_x, region_z, region_temporary_directory_path, osm2world_output_file_path = region
+            return (region_x, region_z, region_temporary_directory_path,
+                    *voxelize_region(config, region_x, region_z, region_temporary_directory_path,
+                                     osm2world_output_file_path, process_executor))
+
+        def save(region):
+            region_x, region_z, region_temporary_directory_path, voxels, terrain = region
+            save_region_file(config, region_x, region_z, region_directory_path, voxels, terrain, thread_executor)
+            finish_region(region_x, region_z, region_temporary_directory_path)
+
+        def convert_tiles(region):
+            region_x, region_z, region_temporary_directory_path, osm2world_output_file_path = region
+            convert_region_tiled(config, region_x, region_z, region_directory_path, region_temporary_directory_path,
+                                 osm2world_output_file_path, process_executor, thread_executor)
+            finish_region(region_x, region_z, region_temporary_directory_path)
+
+        def convert_draft(region):
+            region_x, region_z, region_temporary_directory_path, osm_file_path = region
+            convert_region_draft(config, region_x, region_z, region_directory_path, osm_file_path, thread_executor)
+            finish_region(region_x, region_z, region_temporary_directory_path)
+
+        def finish_region(region_x, region_z, region_temporary_directory_path):
+            shutil.rmtree(region_temporary_directory_path)
+            print(f'Region ({region_x}, {region_z}) finished!')
+
+        pipeline_config = config['batch']
+        stages = [Stage('slice', slice_region, pipeline_config['slice_workers'])]
+        if config['draft']['enabled']:
+            stages.append(Stage('draft', convert_draft, pipeline_config['voxelize_workers']))
+        elif config['voxelizer']['tile_size']:
+            # Tiles are written as soon as they are voxelized, so voxels of a whole region never wait in a queue
+            stages += [Stage('osm2world', convert_region_osm_data, pipeline_config['osm2world_workers']),
+                       Stage('tiles', convert_tiles, pipeline_config['voxelize_workers'])]
+        else:
+            stages += [Stage('osm2world', convert_region_osm_data, pipeline_config['osm2world_workers']),
+                       Stage('voxelize', voxelize, pipeline_config['voxelize_workers']),
+                       Stage('save', save, pipeline_config['save_workers'])]
+
+        with create_executor(config['voxelizer']) as process_executor, \
+                create_thread_executor(config['voxelizer']) as thread_executor:
+            Pipeline(stages, pipeline_config['queue_size']).run(zip(regions, map_bboxes))
+
+    end_time = datetime.now()
+    print(f'Done in {end_time - start_time}!')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog='MinecraftRegionOSMImporter batch',
+        description='This utility can get OSM data of many regions at once and write it to minecraft region files')
+
+    parser.add_argument('--config', dest='config_file_path', default=None, help='Config file path')
+    regions_group = parser.add_mutually_exclusive_group(required=True)
+    regions_group.add_argument('--rectangle', type=int, nargs=4, metavar=('MIN_X', 'MIN_Z', 'MAX_X', 'MAX_Z'),
+                               help='Import all regions of the rectangle, corners are inclusive')
+    regions_group.add_argument('--regions', type=parse_region, nargs='+', metavar='X,Z',
+                               help='Import the listed regions')
+    parser.add_argument('-O', '--output', dest='output_directory_path', required=True, help='Output directory path')
+    parser.add_argument('--draft', action='store_true', help='Rasterize osm data directly for a quick preview')
+    parser.add_argument('--work', dest='work_directory_path', default=None,
+                        help='Work directory keeping stage outputs to resume from, delete it to clear them')
+
+    args = parser.parse_args()
+
+    readed_config = read_config(Path(args.config_file_path if args.config_file_path else CONFIG_FILE))
+    if args.draft:
+        readed_config['draft']['enabled'] = True
+    if args.work_directory_path:
+        readed_config['work']['path'] = args.work_directory_path
+
+    batch(readed_config, args.regions if args.regions else get_rectangle_regions(*args.rectangle),
+          Path(args.output_directory_path))
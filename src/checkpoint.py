@@ -0,0 +1,112 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator, Tuple
+
+import numpy as np
+
+from voxel_buffer import Palette, TerrainColumns, VoxelBuffer
+
+HASH_CHUNK_SIZE = 1 << 20
+
+
+class StageStore:
+    """
+    Work directory of content-addressed stage outputs.
+
+    Every output is a directory named by a key hashed from the inputs of its stage and the config the stage depends
+    on, so a rerun finds outputs of stages whose inputs did not change and runs only the stages after them.
+    Outputs are written into a temporary directory which is renamed once the stage succeeds, so outputs of failed
+    or interrupted stages are never found. Every output keeps copies of OSM2World output or voxels of a region, so
+    outputs not used for a while are pruned, the whole directory can also be deleted at any time between runs.
+    """
+
+    def __init__(self, directory: Path):
+        # Stages run in other working directories, like OSM2World in its own, so paths are absolute
+        self.directory = directory.absolute()
+
+    @staticmethod
+    def get_key(stage: str, *inputs) -> str:
+        """ Returns the key of the stage output, inputs are hashes and config sections serializable to JSON. """
+        return hashlib.sha256(json.dumps([stage, *inputs], sort_keys=True).encode()).hexdigest()
+
+    def get_path(self, stage: str, key: str) -> Path:
+        return self.directory / stage / key
+
+    def get(self, stage: str, key: str) -> Path | None:
+        """ Returns the output directory of the stage, None when it has not succeeded yet. """
+        path = self.get_path(stage, key)
+        if not path.is_dir():
+            return None
+        # Outputs are pruned by the time they were last used
+        os.utime(path)
+        return path
+
+    def prune(self, max_age: float) -> None:
+        """ Removes outputs and leftovers of interrupted stages not used for longer than max_age seconds. """
+        if not self.directory.is_dir():
+            return
+        min_time = time.time() - max_age
+        for stage_path in self.directory.iterdir():
+            for path in stage_path.iterdir():
+                if path.stat().st_mtime < min_time:
+                    shutil.rmtree(path, ignore_errors=True)
+
+    @contextmanager
+    def create(self, stage: str, key: str) -> Iterator[Path]:
+        """
+        Yields a directory to write the stage output into, it becomes the output when the block exits without
+        errors and is removed otherwise.
+        """
+        path = self.get_path(stage, key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temporary_path = Path(tempfile.mkdtemp(suffix='.tmp', dir=path.parent))
+        try:
+            yield temporary_path
+            try:
+                temporary_path.rename(path)
+            except OSError:
+                # The same output was created concurrently, it is kept
+                if not path.is_dir():
+                    raise
+        finally:
+            shutil.rmtree(temporary_path, ignore_errors=True)
+
+
+def hash_file(path: Path) -> str:
+    file_hash = hashlib.sha256()
+    with open(path, 'rb') as file:
+        while chunk := file.read(HASH_CHUNK_SIZE):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def save_region_voxels(directory_path: Path, voxels: VoxelBuffer, terrain: TerrainColumns | None) -> None:
+    """ Saves voxels and terrain of a region into the directory, see :func:`load_region_voxels`. """
+    np.savez(directory_path / 'voxels.npz', coordinates=voxels.coordinates, indices=voxels.indices,
+             block_ids=np.array(voxels.palette.block_ids, dtype=str))
+    if terrain is not None:
+        np.savez(directory_path / 'terrain.npz', heights=terrain.heights,
+                 position=np.array([terrain.min_x, terrain.min_z, terrain.min_y, terrain.seed]),
+                 block_ids=np.array(terrain.get_blocks(), dtype=str))
+
+
+def load_region_voxels(directory_path: Path) -> Tuple[VoxelBuffer, TerrainColumns | None]:
+    with np.load(directory_path / 'voxels.npz') as voxels_file:
+        voxels = VoxelBuffer(Palette(map(str, voxels_file['block_ids'])), voxels_file['coordinates'],
+                             voxels_file['indices'])
+
+    terrain = None
+    terrain_file_path = directory_path / 'terrain.npz'
+    if terrain_file_path.exists():
+        with np.load(terrain_file_path) as terrain_file:
+            min_x, min_z, min_y, seed = map(int, terrain_file['position'])
+            bottom_block, cover_block, *filler_blocks = map(str, terrain_file['block_ids'])
+            terrain = TerrainColumns(terrain_file['heights'], min_x, min_z, min_y, cover_block, bottom_block,
+                                     filler_blocks, seed)
+    return voxels, terrain
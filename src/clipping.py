@@ -0,0 +1,54 @@
+import numpy as np
+
+
+def cull_triangles(triangles: np.array, min_bound: np.array, max_bound: np.array) -> np.array:
+    """ Returns mask of (N, 3, 3) triangles whose bounding boxes overlap the box. """
+    return np.all((triangles.max(axis=1) >= min_bound) & (triangles.min(axis=1) <= max_bound), axis=1)
+
+
+def clip_triangles(triangles: np.array, min_bound: np.array, max_bound: np.array) -> np.array:
+    """
+    Cuts (N, 3, 3) triangles to the box, parts outside of it are dropped and polygons left are split into triangles.
+
+    Triangles inside the box are returned unchanged, only the ones crossing its faces are clipped.
+    """
+    triangles = triangles[cull_triangles(triangles, min_bound, max_bound)]
+    crossing = np.any((triangles.min(axis=1) < min_bound) | (triangles.max(axis=1) > max_bound), axis=1)
+
+    clipped = triangles[crossing]
+    for axis in range(3):
+        clipped = clip_triangles_to_plane(clipped, axis, min_bound[axis], 1)
+        clipped = clip_triangles_to_plane(clipped, axis, max_bound[axis], -1)
+    return np.concatenate([triangles[~crossing], clipped])
+
+
+def clip_triangles_to_plane(triangles: np.array, axis: int, limit: float, direction: int) -> np.array:
+    """
+    Keeps parts of triangles where the axis coordinate is on the direction side of the limit.
+
+    A triangle with one vertex inside becomes a smaller triangle, one with two vertices inside becomes a quad split
+    into two triangles. Vertex order, and so the normal, is kept.
+    """
+    distances = (triangles[:, :, axis] - limit) * direction
+    inside = distances >= 0
+    inside_counts = inside.sum(axis=1)
+
+    parts = [triangles[inside_counts == 3]]
+    for inside_count in (1, 2):
+        selected = inside_counts == inside_count
+        # Rotate vertices so the one on its own side of the plane goes first
+        odd_vertices = np.argmax(inside[selected] if inside_count == 1 else ~inside[selected], axis=1)
+        order = (odd_vertices[:, np.newaxis] + np.arange(3)) % 3
+        a, b, c = np.take_along_axis(triangles[selected], order[:, :, np.newaxis], axis=1).transpose(1, 0, 2)
+        distance_a, distance_b, distance_c = np.take_along_axis(distances[selected], order, axis=1).T[:, :, np.newaxis]
+
+        ab = a + (b - a) * (distance_a / (distance_a - distance_b))
+        ac = a + (c - a) * (distance_a / (distance_a - distance_c))
+        ab[:, axis] = ac[:, axis] = limit
+
+        if inside_count == 1:
+            parts.append(np.stack([a, ab, ac], axis=1))
+        else:
+            parts.append(np.stack([ab, b, c], axis=1))
+            parts.append(np.stack([ab, c, ac], axis=1))
+    return np.concatenate(parts)
@@ -0,0 +1,339 @@
+import re
+import xml.etree.ElementTree as ET
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from mathematics import MapProjection
+from voxel_buffer import VoxelBuffer
+
+# (key, values, material) of areas in drawing order, later areas cover earlier ones
+AREA_RULES = [
+    ('landuse', {'grass', 'meadow', 'village_green', 'recreation_ground', 'cemetery'}, 'GRASS_0'),
+    ('leisure', {'park', 'garden', 'playground'}, 'GRASS_0'),
+    ('landuse', {'forest', 'farmland', 'orchard', 'allotments'}, 'EARTH_0'),
+    ('natural', {'wood', 'scrub', 'heath'}, 'EARTH_0'),
+    ('natural', {'sand', 'beach'}, 'SAND_0'),
+    ('natural', {'bare_rock', 'scree'}, 'ROCK_0'),
+    ('amenity', {'parking'}, 'ASPHALT_0'),
+    ('highway', {'pedestrian'}, 'PAVING_STONE_0'),
+    ('leisure', {'pitch', 'track'}, 'TARTAN_0'),
+    ('natural', {'water'}, 'WATER_0'),
+    ('waterway', {'riverbank'}, 'WATER_0'),
+    ('landuse', {'reservoir', 'basin'}, 'WATER_0'),
+]
+
+# (key, values, material, default width in meters) of lines in drawing order, they cover all areas
+LINE_RULES = [
+    ('waterway', {'stream', 'ditch', 'drain'}, 'WATER_0', 2),
+    ('waterway', {'canal'}, 'WATER_0', 8),
+    ('waterway', {'river'}, 'WATER_0', 12),
+    ('railway', {'rail', 'light_rail', 'tram', 'subway', 'narrow_gauge'}, 'GRAVEL_0', 3),
+    ('highway', {'footway', 'path', 'cycleway', 'pedestrian', 'steps', 'bridleway'}, 'PAVING_STONE_0', 2),
+    ('highway', {'track'}, 'GRAVEL_0', 3),
+    ('highway', {'service', 'living_street'}, 'ASPHALT_0', 4),
+    ('highway', {'residential', 'unclassified', 'road'}, 'ASPHALT_0', 6),
+    ('highway', {'tertiary', 'tertiary_link'}, 'ASPHALT_0', 7),
+    ('highway', {'secondary', 'secondary_link'}, 'ASPHALT_0', 8),
+    ('highway', {'primary', 'primary_link'}, 'ASPHALT_0', 9),
+    ('highway', {'trunk', 'trunk_link', 'motorway', 'motorway_link'}, 'ASPHALT_0', 12),
+]
+
+LANE_WIDTH = 3.5
+WALL_MATERIALS = {'brick': 'BRICK_0', 'glass': 'GLASS_WALL_0', 'wood': 'WOOD_0', 'concrete': 'CONCRETE_0',
+                  'stone': 'STONE_0', 'metal': 'STEEL_0', 'steel': 'STEEL_0'}
+WALL_MATERIAL = 'BUILDING_DEFAULT_0'
+ROOF_MATERIAL = 'ROOF_DEFAULT_0'
+
+
+def read_osm(osm_file_path: Path) -> Tuple[Dict[int, Tuple[float, float]], Dict[int, Tuple[List[int], dict]],
+                                           List[Tuple[List[Tuple[str, int, str]], dict]]]:
+    """
+    Reads an .osm file into nodes as {id: (lat, lon)}, ways as {id: (node ids, tags)} and relations as
+    [((type, ref, role) of members, tags)].
+    """
+    nodes = {}
+    ways = {}
+    relations = []
+    root = None
+    for event, element in ET.iterparse(osm_file_path, events=('start', 'end')):
+        if root is None:
+            root = element
+        if event != 'end' or element.tag not in ('node', 'way', 'relation'):
+            continue
+
+        tags = {tag.get('k'): tag.get('v') for tag in element.iter('tag')}
+        if element.tag == 'node':
+            nodes[int(element.get('id'))] = (float(element.get('lat')), float(element.get('lon')))
+        elif element.tag == 'way':
+            ways[int(element.get('id'))] = ([int(nd.get('ref')) for nd in element.iter('nd')], tags)
+        else:
+            relations.append(([(member.get('type'), int(member.get('ref')), member.get('role'))
+                               for member in element.iter('member')], tags))
+        # Parsed elements stay attached to the root, dropping them keeps the memory bounded
+        root.clear()
+    return nodes, ways, relations
+
+
+def assemble_rings(ways_nodes: List[List[int]]) -> List[List[int]]:
+    """ Joins ways sharing end nodes into closed rings, rings left open are dropped. """
+    pending = [list(way_nodes) for way_nodes in ways_nodes if len(way_nodes) > 1]
+    rings = []
+    while pending:
+        ring = pending.pop()
+        while ring[0] != ring[-1]:
+            for i, way_nodes in enumerate(pending):
+                if way_nodes[0] == ring[-1]:
+                    ring += way_nodes[1:]
+                    break
+                if way_nodes[-1] == ring[-1]:
+                    ring += way_nodes[-2::-1]
+                    break
+            else:
+                break
+            pending.pop(i)
+        if ring[0] == ring[-1]:
+            rings.append(ring)
+    return rings
+
+
+def match_rule(tags: dict, rules: list) -> int | None:
+    """ Returns the index of the last rule matching the tags, so the rule drawn on top wins. """
+    for i in reversed(range(len(rules))):
+        key, values = rules[i][:2]
+        if tags.get(key) in values:
+            return i
+    return None
+
+
+def parse_length(value: str | None) -> float | None:
+    """ Returns meters of an osm length like '12', '12.5 m' or '40 ft', None when it can not be parsed. """
+    if not value:
+        return None
+    match = re.match(r'\s*([0-9]*\.?[0-9]+)\s*(m|ft|\')?\s*$', value)
+    if not match:
+        return None
+    return float(match.group(1)) * (0.3048 if match.group(2) in ('ft', "'") else 1)
+
+
+def get_line_width(tags: dict, default_width: float) -> float:
+    width = parse_length(tags.get('width'))
+    if width:
+        return width
+    lanes = parse_length(tags.get('lanes'))
+    return lanes * LANE_WIDTH if lanes else default_width
+
+
+def get_building_height(tags: dict, config: dict) -> float:
+    """ Returns the height of a building from its height tag, its levels or the default levels of the config. """
+    height = parse_length(tags.get('height'))
+    if height:
+        return height
+    levels = parse_length(tags.get('building:levels')) or config['default_building_levels']
+    return (levels + (parse_length(tags.get('roof:levels')) or 0)) * config['level_height']
+
+
+def fill_rings(rings: List[np.array], shape: Tuple[int, int], origin: Tuple[float, float] = (0, 0)) -> np.array:
+    """
+    Scanline-rasterizes closed (N, 2) x, z rings into a (rows, columns) mask of cells whose centers are inside by the
+    even-odd rule, so inner rings cut holes. Cell (0, 0) is centered at the origin, rows go along z.
+    """
+    rows_count, columns_count = shape
+    mask = np.zeros(shape, dtype=bool)
+    rings = [np.asarray(ring, dtype=np.float64) - origin for ring in rings if len(ring) > 2]
+    if not rings:
+        return mask
+
+    edges = np.concatenate([np.stack((ring[:-1], ring[1:]), axis=1) for ring in rings])
+    (x0, z0), (x1, z1) = edges[:, 0].T, edges[:, 1].T
+
+    # Every edge crosses rows in [low, high), so shared vertices are counted once
+    first_rows = np.maximum(np.ceil(np.minimum(z0, z1)), 0).astype(np.int64)
+    last_rows = np.minimum(np.ceil(np.maximum(z0, z1)) - 1, rows_count - 1).astype(np.int64)
+    counts = np.maximum(last_rows - first_rows + 1, 0)
+    if not counts.sum():
+        return mask
+
+    crossing_edges = np.repeat(np.arange(len(edges)), counts)
+    crossing_rows = np.repeat(first_rows, counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts,
+                                                                                        counts)
+    crossing_x = x0[crossing_edges] + (crossing_rows - z0[crossing_edges]) / (
+        z1[crossing_edges] - z0[crossing_edges]) * (x1[crossing_edges] - x0[crossing_edges])
+
+    # Crossings of a row come in pairs bounding spans inside of the rings
+    order = np.lexsort((crossing_x, crossing_rows))
+    crossing_rows, crossing_x = crossing_rows[order], crossing_x[order]
+    span_rows = crossing_rows[0::2]
+    span_starts = np.maximum(np.ceil(crossing_x[0::2]), 0).astype(np.int64)
+    span_ends = np.minimum(np.floor(crossing_x[1::2]), columns_count - 1).astype(np.int64)
+    spans = span_starts <= span_ends
+
+    changes = np.zeros((rows_count, columns_count + 1), dtype=np.int32)
+    np.add.at(changes, (span_rows[spans], span_starts[spans]), 1)
+    np.add.at(changes, (span_rows[spans], span_ends[spans] + 1), -1)
+    return np.cumsum(changes, axis=1)[:, :columns_count] > 0
+
+
+def stroke_line(mask: np.array, line: np.array, width: float, origin: Tuple[float, float] = (0, 0)) -> None:
+    """ Marks cells of the mask whose centers are within half the width from the (N, 2) x, z polyline. """
+    rows_count, columns_count = mask.shape
+    line = np.asarray(line, dtype=np.float64) - origin
+    radius = width / 2
+    for start, end in zip(line[:-1], line[1:]):
+        first_column, first_row = np.maximum(np.ceil(np.minimum(start, end) - radius), 0).astype(np.int64)
+        last_column, last_row = np.minimum(np.floor(np.maximum(start, end) + radius),
+                                           (columns_count - 1, rows_count - 1)).astype(np.int64)
+        if first_column > last_column or first_row > last_row:
+            continue
+
+        z, x = np.mgrid[first_row:last_row + 1, first_column:last_column + 1]
+        direction = end - start
+        length_squared = direction @ direction
+        t = np.clip(((x - start[0]) * direction[0] + (z - start[1]) * direction[1]) / length_squared, 0, 1) \
+            if length_squared else np.zeros(x.shape)
+        distances_squared = (x - start[0] - t * direction[0]) ** 2 + (z - start[1] - t * direction[1]) ** 2
+        mask[first_row:last_row + 1, first_column:last_column + 1] |= distances_squared <= radius * radius
+
+
+class DraftRasterizer:
+    """
+    Rasterizes osm features of a region straight into voxels on its terrain heights, as a quick preview instead of
+    OSM2World meshes.
+
+    Areas and buffered lines replace the top surface of the terrain, buildings are extruded from their footprints
+    to their height with walls on the outline and a flat roof. Materials are OSM2World material names resolved through
+    the material dictionary, features of materials missing from it are skipped.
+    """
+
+    def __init__(self, config: dict, region_x: int, region_z: int, heights: np.array):
+        self.config = config
+        self.heights = heights
+        self.region_min_x = region_x * config['map']['region_size_x']
+        self.region_min_z = region_z * config['map']['region_size_z']
+        self.min_y = config['voxelizer']['min_y']
+        self.max_y = config['voxelizer']['max_y']
+        self.projection = MapProjection(config['map']['center_lat'], config['map']['center_lon'])
+        self.material_dictionary = config['voxelizer']['material_dictionary']
+
+    def get_block(self, material_name: str) -> str | None:
+        material = self.material_dictionary.get(material_name)
+        return material[0] if material else None
+
+    def project(self, nodes: Dict[int, Tuple[float, float]]) -> Dict[int, Tuple[float, float]]:
+        """ Returns x, z of the nodes relative to the first column of the region, all projected at once. """
+        node_ids = list(nodes)
+        lat, lon = np.array(list(nodes.values()), dtype=np.float64).reshape(-1, 2).T
+        y, x = self.projection.to_yx_array(lat, lon)
+        return dict(zip(node_ids, zip((x - self.region_min_x).tolist(), (-y - self.region_min_z).tolist())))
+
+    def rasterize(self, osm_file_path: Path) -> VoxelBuffer:
+        nodes, ways, relations = read_osm(osm_file_path)
+        positions = self.project(nodes)
+
+        def get_points(way_nodes):
+            return np.array([positions[node_id] for node_id in way_nodes if node_id in positions],
+                            dtype=np.float64).reshape(-1, 2)
+
+        areas = []
+        lines = []
+        buildings = []
+        for way_nodes, tags in ways.values():
+            if tags.get('tunnel', 'no') != 'no' or tags.get('location') == 'underground':
+                continue
+            closed = len(way_nodes) > 3 and way_nodes[0] == way_nodes[-1]
+            if closed and tags.get('building', 'no') != 'no':
+                buildings.append(([get_points(way_nodes)], tags))
+                continue
+            area_rule = match_rule(tags, AREA_RULES) if closed else None
+            line_rule = match_rule(tags, LINE_RULES)
+            if area_rule is not None and (line_rule is None or tags.get('area') == 'yes'):
+                areas.append((area_rule, [get_points(way_nodes)]))
+            elif line_rule is not None:
+                lines.append((line_rule, get_points(way_nodes), tags))
+
+        for members, tags in relations:
+            if tags.get('type') != 'multipolygon':
+                continue
+            rings = [get_points(ring) for ring in assemble_rings([ways[ref][0] for member_type, ref, _ in members
+                                                                  if member_type == 'way' and ref in ways])]
+            if tags.get('building', 'no') != 'no':
+                buildings.append((rings, tags))
+            elif match_rule(tags, AREA_RULES) is not None:
+                areas.append((match_rule(tags, AREA_RULES), rings))
+
+        surface = np.full(self.heights.shape, -1, dtype=np.int32)
+        surface_blocks = []
+
+        def paint(mask, block_id):
+            if block_id not in surface_blocks:
+                surface_blocks.append(block_id)
+            surface[mask] = surface_blocks.index(block_id)
+
+        for rule, rings in sorted(areas, key=lambda area: area[0]):
+            block_id = self.get_block(AREA_RULES[rule][2])
+            if block_id:
+                paint(fill_rings(rings, self.heights.shape), block_id)
+
+        for rule, points, tags in sorted(lines, key=lambda line: line[0]):
+            block_id = self.get_block(LINE_RULES[rule][2])
+            if block_id:
+                mask = np.zeros(self.heights.shape, dtype=bool)
+                stroke_line(mask, points, get_line_width(tags, LINE_RULES[rule][3]))
+                paint(mask, block_id)
+
+        parts = []
+        z, x = np.nonzero(surface >= 0)
+        for i, block_id in enumerate(surface_blocks):
+            painted = surface[z, x] == i
+            parts.append((np.stack((x[painted] + self.region_min_x, self.heights[z[painted], x[painted]],
+                                    z[painted] + self.region_min_z), axis=1), block_id))
+
+        for rings, tags in buildings:
+            self.add_building(parts, rings, tags)
+        # Voxels outside of the region height are dropped like they are for OSM2World meshes
+        return VoxelBuffer.from_parts(parts).clip(np.array([self.region_min_x, self.min_y, self.region_min_z]),
+                                                  np.array([self.region_min_x + self.heights.shape[1] - 1, self.max_y,
+                                                            self.region_min_z + self.heights.shape[0] - 1])).dedupe()
+
+    def add_building(self, parts: List[Tuple[np.array, str]], rings: List[np.array], tags: dict) -> None:
+        """
+        Adds (coordinates, block id) parts of walls on the outline of the footprint from the ground to the roof and of
+        the flat roof over it.
+        """
+        wall_block = self.get_block(WALL_MATERIALS.get(tags.get('building:material'), WALL_MATERIAL))
+        roof_block = self.get_block(ROOF_MATERIAL)
+        rings = [ring for ring in rings if len(ring) > 2]
+        if not rings or not wall_block:
+            return
+
+        points = np.concatenate(rings)
+        first_column, first_row = np.maximum(np.floor(points.min(axis=0)), 0).astype(np.int64)
+        last_column, last_row = np.minimum(np.ceil(points.max(axis=0)),
+                                           np.array(self.heights.shape[::-1]) - 1).astype(np.int64)
+        if first_column > last_column or first_row > last_row:
+            return
+
+        footprint = fill_rings(rings, (last_row - first_row + 1, last_column - first_column + 1),
+                               (first_column, first_row))
+        if not footprint.any():
+            return
+
+        # Cells with a neighbour outside of the footprint carry the walls
+        padded = np.pad(footprint, 1)
+        inner = padded[:-2, 1:-1] & padded[2:, 1:-1] & padded[1:-1, :-2] & padded[1:-1, 2:]
+        z, x = np.nonzero(footprint)
+        ground = self.heights[z + first_row, x + first_column]
+        # Heights of bogus tags would make walls of billions of voxels, roofs stop at the top of the region
+        height = min(get_building_height(tags, self.config['draft']), self.max_y - self.min_y)
+        roof_y = min(int(ground.max()) + max(int(round(height)), 1), self.max_y)
+
+        outline = ~inner[z, x]
+        wall_counts = np.maximum(roof_y - 1 - ground[outline], 0)
+        wall_y = np.repeat(ground[outline] + 1, wall_counts) + np.arange(wall_counts.sum()) - \
+            np.repeat(np.cumsum(wall_counts) - wall_counts, wall_counts)
+        parts.append((np.stack((np.repeat(x[outline], wall_counts) + first_column + self.region_min_x, wall_y,
+                                np.repeat(z[outline], wall_counts) + first_row + self.region_min_z), axis=1),
+                      wall_block))
+        parts.append((np.stack((x + first_column + self.region_min_x, np.full(len(x), roof_y),
+                                z + first_row + self.region_min_z), axis=1), roof_block or wall_block))
@@ -0,0 +1,252 @@
+import bz2
+import gzip
+import os
+import sqlite3
+import threading
+import xml.etree.ElementTree as ET
+from contextlib import closing
+from pathlib import Path
+from typing import Iterable, Iterator, List, Tuple
+from xml.sax.saxutils import quoteattr
+
+BATCH_SIZE = 10000  # Rows inserted into the index at once
+GENERATOR = 'MinecraftRegionOSMImporter'
+MEMBER_TYPES = {'n': 'node', 'w': 'way', 'r': 'relation'}
+
+SCHEMA = '''
+CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE nodes (id INTEGER PRIMARY KEY, lat REAL NOT NULL, lon REAL NOT NULL, xml TEXT NOT NULL);
+CREATE VIRTUAL TABLE node_locations USING rtree(id, min_lat, max_lat, min_lon, max_lon);
+CREATE TABLE ways (id INTEGER PRIMARY KEY, xml TEXT NOT NULL);
+CREATE TABLE way_nodes (way_id INTEGER NOT NULL, node_id INTEGER NOT NULL, UNIQUE (way_id, node_id));
+CREATE TABLE relations (id INTEGER PRIMARY KEY, xml TEXT NOT NULL);
+CREATE TABLE relation_members (relation_id INTEGER NOT NULL, type TEXT NOT NULL, ref INTEGER NOT NULL,
+                               UNIQUE (relation_id, type, ref));
+'''
+
+# Created after loading, building them once is much faster than updating them on every insert
+INDICES = '''
+CREATE INDEX way_nodes_node_id ON way_nodes (node_id);
+CREATE INDEX relation_members_ref ON relation_members (type, ref);
+'''
+
+# Same selection as the map call of the osm API: nodes inside the bbox, ways using them with all their nodes and
+# relations referencing any of these nodes, ways or found relations
+SELECTION = '''
+CREATE TEMP TABLE selected_nodes (id INTEGER PRIMARY KEY);
+CREATE TEMP TABLE selected_ways (id INTEGER PRIMARY KEY);
+CREATE TEMP TABLE selected_relations (id INTEGER PRIMARY KEY);
+
+INSERT INTO selected_nodes
+    SELECT nodes.id FROM node_locations JOIN nodes ON nodes.id = node_locations.id
+    WHERE node_locations.max_lat >= :south AND node_locations.min_lat <= :north
+        AND node_locations.max_lon >= :west AND node_locations.min_lon <= :east
+        AND nodes.lat BETWEEN :south AND :north AND nodes.lon BETWEEN :west AND :east;
+INSERT OR IGNORE INTO selected_ways SELECT way_id FROM way_nodes WHERE node_id IN selected_nodes;
+INSERT OR IGNORE INTO selected_nodes SELECT node_id FROM way_nodes WHERE way_id IN selected_ways;
+INSERT OR IGNORE INTO selected_relations SELECT relation_id FROM relation_members
+    WHERE (type = 'node' AND ref IN selected_nodes) OR (type = 'way' AND ref IN selected_ways);
+INSERT OR IGNORE INTO selected_relations SELECT relation_id FROM relation_members
+    WHERE type = 'relation' AND ref IN selected_relations;
+'''
+
+
+class OSMExtract:
+    """
+    Local .osm or .osm.pbf extract sliced into bboxes through an on-disk spatial index.
+
+    The extract may consist of several files, like overlapping downloads, elements found in more than one file are
+    stored once. The index is an sqlite database built once with a streaming parser and rebuilt when the extract
+    changes.
+    It keeps every element as its serialized xml, so slicing only selects rows and memory use does not depend
+    on the size of the extract. Reading .osm.pbf requires the optional osmium package.
+    """
+
+    def __init__(self, extract_paths: List[Path], index_path: Path):
+        self.extract_paths = extract_paths
+        self.index_path = index_path
+        self.lock = threading.Lock()
+
+    def get_signature(self) -> str:
+        return '|'.join(f'{path.resolve()}:{path.stat().st_size}:{path.stat().st_mtime_ns}'
+                        for path in self.extract_paths)
+
+    def is_indexed(self) -> bool:
+        if not self.index_path.exists():
+            return False
+        with closing(sqlite3.connect(self.index_path)) as connection:
+            try:
+                row = connection.execute("SELECT value FROM meta WHERE key = 'signature'").fetchone()
+            except sqlite3.DatabaseError:
+                return False
+        return row is not None and row[0] == self.get_signature()
+
+    def ensure_index(self) -> None:
+        with self.lock:
+            if not self.is_indexed():
+                self.build_index()
+
+    def build_index(self) -> None:
+        """
+        Parses the extract into a new index, which replaces the old one only when it is complete.
+        """
+        self.index_path.parent.mkdir(parents=True, exist_ok=True)
+        temporary_index_path = self.index_path.with_suffix('.tmp')
+        temporary_index_path.unlink(missing_ok=True)
+
+        connection = sqlite3.connect(temporary_index_path)
+        try:
+            connection.execute('PRAGMA journal_mode = OFF')
+            connection.execute('PRAGMA synchronous = OFF')
+            connection.executescript(SCHEMA)
+
+            for extract_path in self.extract_paths:
+                if extract_path.name.endswith('.pbf'):
+                    elements = read_pbf_elements(extract_path)
+                else:
+                    elements = read_xml_elements(extract_path)
+                for element_type, rows in group_rows(elements):
+                    insert_rows(connection, element_type, rows)
+
+            connection.executescript(INDICES)
+            connection.execute("INSERT INTO meta VALUES ('signature', ?)", (self.get_signature(),))
+            connection.commit()
+        finally:
+            connection.close()
+        os.replace(temporary_index_path, self.index_path)
+
+    def write_bbox(self, bbox: tuple, output_file_path: Path) -> None:
+        """
+        Writes elements of the ((lat, lon), (lat, lon)) bbox into an .osm file like the osm API returns.
+        """
+        self.ensure_index()
+        (lat0, lon0), (lat1, lon1) = bbox
+        bounds = {'south': min(lat0, lat1), 'north': max(lat0, lat1),
+                  'west': min(lon0, lon1), 'east': max(lon0, lon1)}
+
+        connection = sqlite3.connect(self.index_path)
+        try:
+            for statement in SELECTION.split(';'):
+                if statement.strip():
+                    connection.execute(statement, bounds)
+
+            with open(output_file_path, 'w', encoding='utf-8') as osm_file:
+                osm_file.write("<?xml version='1.0' encoding='UTF-8'?>\n")
+                osm_file.write(f'<osm version="0.6" generator="{GENERATOR}">\n')
+                osm_file.write(f' <bounds minlat="{bounds["south"]}" minlon="{bounds["west"]}" '
+                               f'maxlat="{bounds["north"]}" maxlon="{bounds["east"]}"/>\n')
+                for table in ('nodes', 'ways', 'relations'):
+                    for xml, in connection.execute(f'SELECT {table}.xml FROM selected_{table} '
+                                                   f'JOIN {table} ON {table}.id = selected_{table}.id '
+                                                   f'ORDER BY {table}.id'):
+                        osm_file.write(xml)
+                        osm_file.write('\n')
+                osm_file.write('</osm>\n')
+        finally:
+            connection.close()
+
+
+def group_rows(elements: Iterable[tuple]) -> Iterator[Tuple[str, list]]:
+    """ Groups consecutive elements of one type into batches. """
+    batch_type, batch = None, []
+    for element_type, *row in elements:
+        if element_type != batch_type or len(batch) >= BATCH_SIZE:
+            if batch:
+                yield batch_type, batch
+            batch_type, batch = element_type, []
+        batch.append(row)
+    if batch:
+        yield batch_type, batch
+
+
+def insert_rows(connection: sqlite3.Connection, element_type: str, rows: list) -> None:
+    if element_type == 'node':
+        connection.executemany('INSERT OR REPLACE INTO nodes VALUES (?, ?, ?, ?)',
+                               [(element_id, lat, lon, xml) for element_id, lat, lon, xml in rows])
+        connection.executemany('INSERT OR REPLACE INTO node_locations VALUES (?, ?, ?, ?, ?)',
+                               [(element_id, lat, lat, lon, lon) for element_id, lat, lon, _ in rows])
+    elif element_type == 'way':
+        connection.executemany('INSERT OR REPLACE INTO ways VALUES (?, ?)',
+                               [(element_id, xml) for element_id, xml, _ in rows])
+        connection.executemany('INSERT OR IGNORE INTO way_nodes VALUES (?, ?)',
+                               [(element_id, node_id) for element_id, _, node_ids in rows for node_id in node_ids])
+    else:
+        connection.executemany('INSERT OR REPLACE INTO relations VALUES (?, ?)',
+                               [(element_id, xml) for element_id, xml, _ in rows])
+        connection.executemany('INSERT OR IGNORE INTO relation_members VALUES (?, ?, ?)',
+                               [(element_id, member_type, ref)
+                                for element_id, _, members in rows for member_type, ref in members])
+
+
+def open_extract(path: Path):
+    if path.suffix == '.bz2':
+        return bz2.open(path, 'rb')
+    if path.suffix == '.gz':
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def read_xml_elements(path: Path) -> Iterator[tuple]:
+    """
+    Streams nodes as ('node', id, lat, lon, xml), ways as ('way', id, xml, node ids) and relations as
+    ('relation', id, xml, (type, ref) of members) from an .osm file, optionally compressed with bz2 or gzip.
+    """
+    with open_extract(path) as osm_file:
+        root = None
+        for event, element in ET.iterparse(osm_file, events=('start', 'end')):
+            if root is None:
+                root = element
+            if event != 'end' or element.tag not in ('node', 'way', 'relation'):
+                continue
+
+            element.tail = None
+            xml = ET.tostring(element, encoding='unicode')
+            element_id = int(element.get('id'))
+            if element.tag == 'node':
+                yield 'node', element_id, float(element.get('lat')), float(element.get('lon')), xml
+            elif element.tag == 'way':
+                yield 'way', element_id, xml, [int(nd.get('ref')) for nd in element.iter('nd')]
+            else:
+                yield 'relation', element_id, xml, [(member.get('type'), int(member.get('ref')))
+                                                    for member in element.iter('member')]
+            # Parsed elements stay attached to the root, dropping them keeps the memory bounded
+            root.clear()
+
+
+def get_element_xml(tag: str, attributes: dict, children: Iterable[Tuple[str, dict]]) -> str:
+    """ Serializes an element with empty children, like tags and node references of osm elements. """
+    def get_attributes_xml(element_attributes: dict) -> str:
+        return ''.join(f' {key}={quoteattr(str(value))}' for key, value in element_attributes.items())
+
+    children_xml = ''.join(f'<{child_tag}{get_attributes_xml(child_attributes)} />'
+                           for child_tag, child_attributes in children)
+    return f'<{tag}{get_attributes_xml(attributes)}>{children_xml}</{tag}>'
+
+
+def read_pbf_elements(path: Path) -> Iterator[tuple]:
+    """ Streams elements of an .osm.pbf file like read_xml_elements, requires the osmium package. """
+    try:
+        import osmium
+    except ImportError:
+        raise ImportError('Reading .osm.pbf extracts requires the osmium package, install it with '
+                          '"pip install osmium" or convert the extract to .osm')
+
+    for element in osmium.FileProcessor(str(path)):
+        attributes = {'id': element.id, 'version': element.version}
+        tags = [('tag', {'k': tag.k, 'v': tag.v}) for tag in element.tags]
+        if element.is_node():
+            if not element.location.valid():
+                continue
+            attributes.update(lat=element.location.lat, lon=element.location.lon)
+            yield 'node', element.id, element.location.lat, element.location.lon, \
+                get_element_xml('node', attributes, tags)
+        elif element.is_way():
+            node_ids = [node.ref for node in element.nodes]
+            yield 'way', element.id, \
+                get_element_xml('way', attributes, [('nd', {'ref': node_id}) for node_id in node_ids] + tags), node_ids
+        elif element.is_relation():
+            members = [(MEMBER_TYPES[member.type], member.ref, member.role) for member in element.members]
+            yield 'relation', element.id, \
+                get_element_xml('relation', attributes, [('member', {'type': member_type, 'ref': ref, 'role': role})
+                                                         for member_type, ref, role in members] + tags), \
+                [(member_type, ref) for member_type, ref, _ in members]
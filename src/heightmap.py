@@ -0,0 +1,79 @@
+import math
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+from internet import get_SRTM_file_name
+
+SRTM_VOID = -32768  # Height of cells without data
+
+
+class SRTMHeightmap:
+    """
+    Heights of the SRTM tiles in a directory.
+
+    Tiles are squares of big-endian int16 heights in meters, rows go from north to south and edge cells are shared
+    with the neighbouring tiles, both 3 (1201 cells) and 1 arc second (3601 cells) tiles work. They are
+    memory-mapped when first sampled, so only pages with sampled cells are read.
+    """
+
+    def __init__(self, directory: Path):
+        self.directory = directory
+        self.tiles: Dict[Tuple[int, int], Optional[np.array]] = {}
+
+    def get_tile(self, lat: int, lon: int) -> Optional[np.array]:
+        if (lat, lon) not in self.tiles:
+            tile_path = self.directory / f'{get_SRTM_file_name(lat, lon)}.hgt'
+            tile = None
+            if tile_path.exists():
+                side = math.isqrt(tile_path.stat().st_size // 2)
+                tile = np.memmap(tile_path, dtype='>i2', mode='r', shape=(side, side))
+            self.tiles[(lat, lon)] = tile
+        return self.tiles[(lat, lon)]
+
+    def sample(self, lat: np.array, lon: np.array) -> np.array:
+        """
+        Returns bilinearly interpolated heights at the points given by arrays of any broadcastable shapes.
+
+        Points outside of the tiles in the directory get NaN, as do points with only void cells around them.
+        """
+        lat, lon = np.broadcast_arrays(np.asarray(lat, dtype=np.float64), np.asarray(lon, dtype=np.float64))
+        heights = np.full(lat.shape, np.nan)
+
+        tiles_lat, tiles_lon = np.floor(lat).astype(np.int64), np.floor(lon).astype(np.int64)
+        tiles, tile_indices = np.unique(np.stack((tiles_lat.ravel(), tiles_lon.ravel()), axis=1), axis=0,
+                                        return_inverse=True)
+        tile_indices = tile_indices.reshape(lat.shape)
+        for i, (tile_lat, tile_lon) in enumerate(tiles.tolist()):
+            tile = self.get_tile(tile_lat, tile_lon)
+            if tile is not None:
+                mask = tile_indices == i
+                heights[mask] = sample_tile(tile, lat[mask] - tile_lat, lon[mask] - tile_lon)
+        return heights
+
+
+def sample_tile(tile: np.array, lat: np.array, lon: np.array) -> np.array:
+    """
+    Bilinearly samples the tile at offsets in degrees from its south west corner.
+
+    Void cells are left out and the weights of the others are renormalized, NaN is returned where all cells around
+    the point are void.
+    """
+    last = len(tile) - 1
+    rows = (1 - lat) * last
+    columns = lon * last
+    first_rows = np.clip(np.floor(rows).astype(np.int64), 0, last - 1)
+    first_columns = np.clip(np.floor(columns).astype(np.int64), 0, last - 1)
+    row_fractions = rows - first_rows
+    column_fractions = columns - first_columns
+
+    heights_sum = np.zeros(len(rows))
+    weights_sum = np.zeros(len(rows))
+    for row_offset, row_weights in ((0, 1 - row_fractions), (1, row_fractions)):
+        for column_offset, column_weights in ((0, 1 - column_fractions), (1, column_fractions)):
+            heights = tile[first_rows + row_offset, first_columns + column_offset]
+            weights = row_weights * column_weights * (heights != SRTM_VOID)
+            heights_sum += weights * heights
+            weights_sum += weights
+    return np.divide(heights_sum, weights_sum, out=np.full(len(rows), np.nan), where=weights_sum > 0)
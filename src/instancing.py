@@ -0,0 +1,88 @@
+import hashlib
+from typing import List, Tuple
+
+import numpy as np
+
+OFFSET_DECIMALS = 3  # Instances are compared by vertex offsets rounded to millimeters
+
+
+def get_components(vertices_count: int, faces: np.array) -> np.array:
+    """
+    Returns a component label of every face, faces sharing vertices belong to one component.
+
+    Every round hooks the label roots of face vertices to the lowest root of the face and compresses the label
+    chains, so meshes of any length take a few rounds.
+    """
+    labels = np.arange(vertices_count)
+    while True:
+        previous_labels = labels
+        face_labels = labels[faces]
+        labels = labels.copy()
+        np.minimum.at(labels, face_labels.ravel(), np.repeat(face_labels.min(axis=1), 3))
+        while True:
+            jumped_labels = labels[labels]
+            if np.array_equal(jumped_labels, labels):
+                break
+            labels = jumped_labels
+        if np.array_equal(labels, previous_labels):
+            return labels[faces[:, 0]]
+
+
+def find_instances(vertices: np.array, faces: np.array,
+                   min_count: int) -> Tuple[List[Tuple[np.array, np.array, np.array]], np.array]:
+    """
+    Finds connected components of the mesh that are identical up to translation.
+
+    Components are keyed by a hash of their vertex offsets from the lowest corner and of their faces, so copies
+    written in the same order match. Returns (vertex offsets, faces, lowest corners of instances) of every shape
+    with at least min_count instances and faces of the rest of the mesh in their order.
+    """
+    vertices = np.asarray(vertices)
+    faces = np.asarray(faces)
+    if not len(faces):
+        return [], faces
+
+    components = get_components(len(vertices), faces)
+    order = np.argsort(components, kind='stable')
+    starts = np.flatnonzero(np.diff(components[order]))
+
+    shapes = {}
+    for component_faces in np.split(order, starts + 1):
+        used_vertices, shape_faces = np.unique(faces[component_faces], return_inverse=True)
+        corner = vertices[used_vertices].min(axis=0)
+        offsets = vertices[used_vertices] - corner
+        shape_faces = shape_faces.reshape(-1, 3).astype(np.int32)
+
+        key = hashlib.blake2b(np.round(offsets, OFFSET_DECIMALS).tobytes() + shape_faces.tobytes()).digest()
+        shape = shapes.setdefault(key, (offsets, shape_faces, [], []))
+        shape[2].append(corner)
+        shape[3].append(component_faces)
+
+    instanced_shapes = []
+    rest_faces = []
+    for offsets, shape_faces, corners, components_faces in shapes.values():
+        if len(corners) >= min_count:
+            instanced_shapes.append((offsets, shape_faces, np.array(corners)))
+        else:
+            rest_faces += components_faces
+    rest_faces = np.sort(np.concatenate(rest_faces)) if rest_faces else np.empty(0, dtype=np.int64)
+    return instanced_shapes, faces[rest_faces]
+
+
+def get_offset_classes(corners: np.array, subdivisions: int) -> Tuple[np.array, np.array]:
+    """
+    Splits corners into integer voxel positions and sub-voxel offset classes, every voxel is cut into subdivisions
+    steps along each axis. Returns (N, 3) integer positions and (N, 3) classes.
+    """
+    steps = np.floor(np.asarray(corners) * subdivisions).astype(np.int64)
+    return steps // subdivisions, steps % subdivisions
+
+
+def get_class_offset(offset_class: np.array, subdivisions: int) -> np.array:
+    """ Returns the sub-voxel offset in the middle of the class, so its instances move by at most half a step. """
+    return (np.asarray(offset_class) + 0.5) / subdivisions
+
+
+def stamp(pattern: np.array, positions: np.array) -> np.array:
+    """ Returns (N, 3) voxel coordinates of the pattern moved to every position. """
+    return (np.asarray(pattern)[np.newaxis] + np.asarray(positions)[:, np.newaxis]).reshape(-1, 3)
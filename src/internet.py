@@ -1,10 +1,20 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
 import time
+from concurrent.futures import Future, ThreadPoolExecutor
 from io import BytesIO
 from pathlib import Path
+from typing import Any, Callable, Dict
+from urllib.parse import urlsplit
 from zipfile import ZipFile
 
 import requests
 from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
 
 # Define custom headers with a Firefox User-Agent
 HEADERS = {
@@ -14,88 +24,306 @@ HEADERS = {
 }
 
 MAX_RETRIES = 3  # Maximum number of retries for failed requests
-RETRY_DELAY = 5  # Delay (in seconds) between retries
+RETRY_DELAY = 1  # Delay (in seconds) before the first retry, doubled for every next one
+MAX_WORKERS = 8  # Concurrent downloads
+HOST_CONNECTIONS = 4  # Concurrent requests to one host
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+DOWNLOAD_CHUNK_SIZE = 1 << 20
 
 
-def download_map_data(config: dict, bbox: tuple, output_file_path: Path):
+class IncompleteDownloadError(Exception):
+    pass
+
+
+class Fetcher:
+    """
+    Shared HTTP client for concurrent downloads.
+
+    A thread pool shares one keep-alive session, requests to one host are limited by a semaphore and failed
+    requests are retried with exponential backoff. Client errors other than 429 are not retried.
+    """
+
+    def __init__(self, max_workers: int = MAX_WORKERS, host_connections: int = HOST_CONNECTIONS,
+                 retries: int = MAX_RETRIES, retry_delay: float = RETRY_DELAY):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.host_connections = host_connections
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.host_semaphores: Dict[str, threading.BoundedSemaphore] = {}
+        self.lock = threading.Lock()
+
+    def __enter__(self) -> 'Fetcher':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.executor.shutdown()
+        self.session.close()
+
+    def get_host_semaphore(self, url: str) -> threading.BoundedSemaphore:
+        host = urlsplit(url).netloc
+        with self.lock:
+            if host not in self.host_semaphores:
+                self.host_semaphores[host] = threading.BoundedSemaphore(self.host_connections)
+            return self.host_semaphores[host]
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        """
+        Requests the url and reads the whole response.
+        """
+        return self.request(url, lambda response: response, **kwargs)
+
+    def download(self, url: str, output_file_path: Path, validate: Callable[[Path], bool] = None, **kwargs) -> None:
+        """
+        Streams the response into the file. The file is replaced only by a complete and valid download.
+        """
+        def save(response: requests.Response) -> None:
+            file_descriptor, temporary_path = tempfile.mkstemp(dir=output_file_path.parent, suffix='.tmp')
+            try:
+                with os.fdopen(file_descriptor, 'wb') as output_file:
+                    for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                        output_file.write(chunk)
+                if validate is not None and not validate(Path(temporary_path)):
+                    raise IncompleteDownloadError(f'Incomplete response from {url}')
+                Path(temporary_path).replace(output_file_path)
+            finally:
+                Path(temporary_path).unlink(missing_ok=True)
+
+        output_file_path.parent.mkdir(parents=True, exist_ok=True)
+        self.request(url, save, stream=True, **kwargs)
+
+    def request(self, url: str, read_response: Callable[[requests.Response], Any], **kwargs) -> Any:
+        """
+        Requests the url and reads the response while holding a connection to the host.
+
+        Connection errors, incomplete responses and server errors are retried.
+        """
+        for attempt in range(1, self.retries + 1):
+            try:
+                with self.get_host_semaphore(url):
+                    with self.session.get(url, **kwargs) as response:
+                        response.raise_for_status()
+                        return read_response(response)
+            except requests.HTTPError as e:
+                if e.response.status_code not in RETRY_STATUS_CODES or attempt == self.retries:
+                    raise
+            except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError,
+                    IncompleteDownloadError):
+                if attempt == self.retries:
+                    raise
+            time.sleep(self.retry_delay * 2 ** (attempt - 1))
+
+    def submit(self, function: Callable, *args) -> Future:
+        return self.executor.submit(function, *args)
+
+
+def download_map_data(fetcher: Fetcher, config: dict, bbox: tuple, output_file_path: Path):
+    """
+    Downloads osm data of the bbox through a local cache.
+
+    Cached responses are keyed by the request url, so by the server and the bbox, and are reused until
+    they are older than the configured TTL in seconds, a null TTL keeps them forever.
+    """
     url = config['url'].format(lat0=bbox[0][0], lon0=bbox[0][1], lat1=bbox[1][0], lon1=bbox[1][1])
-    response = requests.get(url)
-    with open(output_file_path, 'w') as osm_file:
-        osm_file.write(response.text)
+    cache_file_path = Path(config['osm_cache_path']) / f'{hashlib.sha256(url.encode()).hexdigest()}.osm'
+
+    if not is_fresh(cache_file_path, config['osm_cache_ttl']):
+        fetcher.download(url, cache_file_path, validate=is_complete_osm)
+    install_file(cache_file_path, output_file_path)
+
 
+def is_fresh(path: Path, ttl: float | None) -> bool:
+    if not path.exists():
+        return False
+    return ttl is None or time.time() - path.stat().st_mtime < ttl
 
-def fetch_links(url):
+
+def is_complete_osm(path: Path) -> bool:
+    """ Checks the closing tag, the osm API streams its response and a cut connection leaves a file without it. """
+    with open(path, 'rb') as osm_file:
+        osm_file.seek(max(path.stat().st_size - 64, 0))
+        return osm_file.read().rstrip().endswith(b'</osm>')
+
+
+def fetch_links(fetcher: Fetcher, url):
     """
     Fetches all links (files and directories) from the specified URL.
 
     Args:
+        fetcher (Fetcher): HTTP client to use.
         url (str): The URL to scrape.
 
     Returns:
         list: List of links (absolute URLs).
+
+    Raises:
+        requests.RequestException: When the listing can not be fetched, so a partial crawl is never taken for a
+        complete one.
     """
-    try:
-        response = requests.get(url, headers=HEADERS)
-        response.raise_for_status()
-        soup = BeautifulSoup(response.text, 'html.parser')
-        links = [f'{url.replace("/index.html", "")}/{a["href"]}' for a in soup.find_all('a', href=True) if
-                 not a['href'].startswith('?')
-                 and not a['href'].startswith('..')]
-        return links
-    except Exception as e:
-        print(f'Failed to fetch links from {url}: {e}')
-        return []
-
-
-def download_and_extract_file(file_url, output_folder):
-    """
-    Downloads and extracts a single .zip file from a given URL to the specified folder.
+    response = fetcher.get(url, headers=HEADERS)
+    soup = BeautifulSoup(response.text, 'html.parser')
+    links = [f'{url.replace("/index.html", "")}/{a["href"]}' for a in soup.find_all('a', href=True) if
+             not a['href'].startswith('?')
+             and not a['href'].startswith('..')]
+    return links
 
-    Args:
-        file_url (str): URL of the .zip file to download.
-        output_folder (Path): Directory where the file will be extracted.
 
-    Returns:
-        str: The name of the extracted file or an error message.
+def download_file(fetcher: Fetcher, file_url: str) -> bytes:
     """
-    for attempt in range(1, MAX_RETRIES + 1):
-        try:
-            # Download the zip file
-            response = requests.get(file_url, headers=HEADERS)
-            response.raise_for_status()
-
-            # Extract the zip file
-            with ZipFile(BytesIO(response.content)) as zip_file:
-                for file_info in zip_file.infolist():
-                    zip_file.extract(file_info, path=output_folder)
-            return f'Extracted {file_url} successfully.'
-        except Exception as e:
-            if attempt < MAX_RETRIES:
-                time.sleep(RETRY_DELAY)
-            else:
-                return f'Failed to process {file_url} after {MAX_RETRIES} retries: {e}'
-
+    Downloads a file into memory.
+    """
+    return fetcher.get(file_url, headers=HEADERS).content
 
-def find_SRTM_link(root_url: str, filename: str) -> str | None:
-    links = fetch_links(root_url)
 
-    file_url = None
-    for link in links:
-        if filename in link:
-            file_url = link
-        if not file_url and link.endswith('index.html'):
-            file_url = find_SRTM_link(link, filename)
-        if file_url:
-            return file_url
+def find_SRTM_links(fetcher: Fetcher, root_url: str) -> Dict[str, str]:
+    """
+    Crawls the directory listings of the SRTM server and returns links to all tile archives by tile name.
+    """
+    SRTM_links = {}
+    for link in fetch_links(fetcher, root_url):
+        if link.endswith('index.html'):
+            SRTM_links.update(find_SRTM_links(fetcher, link))
+        elif link.endswith('.zip'):
+            SRTM_links[link.rsplit('/', 1)[-1].split('.')[0]] = link
+    return SRTM_links
 
 
-def download_SRTM_data(root_url: str, destination_folder: Path, lat: int, lon: int):
+def get_SRTM_file_name(lat: int, lon: int) -> str:
     lat_prefix = 'N' if lat >= 0 else 'S'
     lon_prefix = 'E' if lon >= 0 else 'W'
 
     lat, lon = abs(lat), abs(lon)
 
-    SRTM_file_name = f'{lat_prefix}{str(lat).zfill(2)}{lon_prefix}{str(lon).zfill(3)}'
-    SRTM_file_link = find_SRTM_link(root_url, SRTM_file_name)
-    result = download_and_extract_file(SRTM_file_link, destination_folder)
+    return f'{lat_prefix}{str(lat).zfill(2)}{lon_prefix}{str(lon).zfill(3)}'
+
+
+class SRTMCache:
+    """
+    Local cache of SRTM tiles shared by all runs.
+
+    The index maps tile names to their links on the server and to the files of each downloaded tile.
+    File contents are stored once under their SHA-256, so a cache directory copied to another machine
+    serves every indexed tile without network access. Links are crawled again when a tile is missing from
+    links older than the links TTL in seconds, a null TTL keeps them forever.
+
+    Layout::
+
+        index.json
+        objects/ab/abcdef....hgt
+    """
+
+    def __init__(self, fetcher: Fetcher, root_url: str, cache_directory: Path, links_ttl: float | None = None):
+        self.fetcher = fetcher
+        self.root_url = root_url
+        self.links_ttl = links_ttl
+        self.lock = threading.Lock()
+        self.cache_directory = cache_directory
+        self.index_path = cache_directory / 'index.json'
+        self.objects_path = cache_directory / 'objects'
+        self.index = {'root_url': root_url, 'links': None, 'tiles': {}}
+        if self.index_path.exists():
+            with open(self.index_path) as index_file:
+                self.index = json.load(index_file)
+
+    def save_index(self) -> None:
+        self.cache_directory.mkdir(parents=True, exist_ok=True)
+        temporary_index_path = self.index_path.with_suffix('.tmp')
+        with open(temporary_index_path, 'w') as index_file:
+            json.dump(self.index, index_file, indent=2)
+        temporary_index_path.replace(self.index_path)
+
+    def get_object_path(self, digest: str) -> Path:
+        return self.objects_path / digest[:2] / f'{digest}.hgt'
+
+    def are_links_fresh(self) -> bool:
+        return self.links_ttl is None or time.time() - self.index.get('links_time', 0) < self.links_ttl
+
+    def get_link(self, SRTM_file_name: str) -> str | None:
+        """
+        Returns the link of the tile archive, None when the server has no such tile.
+
+        Crawl errors are raised and leave the index as it was.
+        """
+        with self.lock:
+            links = self.index['links'] if self.index['root_url'] == self.root_url else None
+            if links is None or (SRTM_file_name not in links and not self.are_links_fresh()):
+                links = find_SRTM_links(self.fetcher, self.root_url)
+                self.index.update(root_url=self.root_url, links=links, links_time=time.time())
+                self.save_index()
+            return links.get(SRTM_file_name)
+
+    def download(self, SRTM_file_name: str, SRTM_file_link: str) -> Dict[str, Path]:
+        return self.store(SRTM_file_name, download_file(self.fetcher, SRTM_file_link))
+
+    def get_cached_files(self, SRTM_file_name: str) -> Dict[str, Path] | None:
+        tile_files = self.index['tiles'].get(SRTM_file_name)
+        if tile_files is None:
+            return None
+        paths = {file_name: self.get_object_path(digest) for file_name, digest in tile_files.items()}
+        return paths if all(path.exists() for path in paths.values()) else None
+
+    def store(self, SRTM_file_name: str, archive: bytes) -> Dict[str, Path]:
+        tile_files = {}
+        with ZipFile(BytesIO(archive)) as zip_file:
+            for file_info in zip_file.infolist():
+                if file_info.is_dir():
+                    continue
+                content = zip_file.read(file_info)
+                digest = hashlib.sha256(content).hexdigest()
+                object_path = self.get_object_path(digest)
+                if not object_path.exists():
+                    object_path.parent.mkdir(parents=True, exist_ok=True)
+                    temporary_object_path = object_path.with_suffix('.tmp')
+                    temporary_object_path.write_bytes(content)
+                    temporary_object_path.replace(object_path)
+                tile_files[Path(file_info.filename).name] = digest
+
+        with self.lock:
+            self.index['tiles'][SRTM_file_name] = tile_files
+            self.save_index()
+        return {file_name: self.get_object_path(digest) for file_name, digest in tile_files.items()}
+
+
+def install_file(source_path: Path, destination_path: Path) -> None:
+    """ Hard links a cached file to the destination, copies it where links are not supported. """
+    destination_path.unlink(missing_ok=True)
+    try:
+        os.link(source_path, destination_path)
+    except OSError:
+        shutil.copyfile(source_path, destination_path)
+
+
+def download_SRTM_data(cache: SRTMCache, destination_folder: Path, lat: int, lon: int):
+    """
+    Puts the SRTM tile containing the point into the destination folder, downloading it only if it is not cached.
+
+    Returns:
+        str: Description of the result.
+    """
+    SRTM_file_name = get_SRTM_file_name(lat, lon)
+
+    tile_files = cache.get_cached_files(SRTM_file_name)
+    if tile_files is not None:
+        result = f'Found {SRTM_file_name} in cache.'
+    else:
+        try:
+            SRTM_file_link = cache.get_link(SRTM_file_name)
+        except Exception as e:
+            return f'Failed to find link of {SRTM_file_name}: {e}'
+        if SRTM_file_link is None:
+            return f'No SRTM data for {SRTM_file_name}.'
+        try:
+            tile_files = cache.download(SRTM_file_name, SRTM_file_link)
+        except Exception as e:
+            return f'Failed to process {SRTM_file_link}: {e}'
+        result = f'Extracted {SRTM_file_link} successfully.'
+
+    for file_name, path in tile_files.items():
+        install_file(path, destination_folder / file_name)
     return result
@@ -0,0 +1,179 @@
+import atexit
+import queue
+import select
+import subprocess
+import sys
+import threading
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+WORKER_SOURCE_PATH = Path(__file__).resolve().parent / 'JarWorker.java'
+START_TIMEOUT = 120  # Seconds, the worker source is compiled on start
+HEALTH_CHECK_TIMEOUT = 10  # Seconds
+
+
+class WorkerError(Exception):
+    pass
+
+
+class JarWorker:
+    """
+    Resident JVM running the main class of a jar for every job, see JarWorker.java for the protocol.
+    """
+
+    def __init__(self, java_executable: Path, jar: str, working_directory: str):
+        self.java_executable = java_executable
+        self.jar = jar
+        self.working_directory = working_directory
+        self.process = None
+        self.jobs_count = 0
+
+    def start(self) -> None:
+        # Security manager is needed to catch System.exit of jobs, since java 18 it has to be allowed explicitly
+        self.process = subprocess.Popen([self.java_executable, '-Djava.security.manager=allow',
+                                         WORKER_SOURCE_PATH, self.jar],
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                        cwd=self.working_directory)
+        self.jobs_count = 0
+        if not self.ping(START_TIMEOUT):
+            self.stop()
+            raise WorkerError(f'Worker for {self.jar} did not start')
+
+    def stop(self) -> None:
+        if self.process is None:
+            return
+        try:
+            self.process.stdin.close()
+            self.process.wait(HEALTH_CHECK_TIMEOUT)
+        except (OSError, subprocess.TimeoutExpired):
+            self.process.kill()
+            self.process.wait()
+        self.process = None
+
+    def ping(self, timeout: float = HEALTH_CHECK_TIMEOUT) -> bool:
+        try:
+            self.send(['PING'])
+            return self.read_line(timeout) == 'PONG'
+        except (OSError, ValueError, WorkerError):
+            return False
+
+    def run(self, arguments: List[str]) -> Tuple[int, bytes, bytes]:
+        """ Returns exit code, stdout and stderr of the job. """
+        self.send(['RUN', *arguments])
+        status, stdout_length, stderr_length = map(int, self.read_line().split()[1:])
+        self.jobs_count += 1
+        return status, self.read_bytes(stdout_length), self.read_bytes(stderr_length)
+
+    def send(self, fields: List[str]) -> None:
+        self.process.stdin.write(('\t'.join(fields) + '\n').encode())
+        self.process.stdin.flush()
+
+    def read_line(self, timeout: float = None) -> str:
+        if timeout is not None and not select.select([self.process.stdout], [], [], timeout)[0]:
+            raise WorkerError(f'Worker for {self.jar} did not respond')
+        line = self.process.stdout.readline()
+        if not line:
+            raise WorkerError(f'Worker for {self.jar} exited')
+        return line.decode().strip()
+
+    def read_bytes(self, length: int) -> bytes:
+        data = self.process.stdout.read(length)
+        if len(data) != length:
+            raise WorkerError(f'Worker for {self.jar} exited')
+        return data
+
+
+class JarWorkerPool:
+    """
+    Resident workers of one jar, started on demand so concurrent jobs get a worker each.
+
+    Idle workers are health checked before a job and replaced when they are dead. A job whose worker crashes
+    is not retried by the pool, the caller runs it as a one-shot process. When no worker can be started,
+    like when the java runtime lacks the source launcher, the pool is disabled for the rest of the run.
+    """
+
+    def __init__(self, java_executable: Path, jar: str, working_directory: str, max_jobs: int):
+        self.java_executable = java_executable
+        self.jar = jar
+        self.working_directory = working_directory
+        self.max_jobs = max_jobs
+        self.idle = queue.LifoQueue()
+        self.disabled = False
+
+    def acquire(self) -> JarWorker | None:
+        while True:
+            try:
+                worker = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            if worker.ping():
+                return worker
+            worker.stop()
+
+        worker = JarWorker(self.java_executable, self.jar, self.working_directory)
+        try:
+            worker.start()
+        except (OSError, WorkerError) as e:
+            print(f'{e}, falling back to one-shot processes', file=sys.stderr)
+            self.disabled = True
+            return None
+        return worker
+
+    def release(self, worker: JarWorker) -> None:
+        # Restarting once in a while drops static state and memory leaked by jobs
+        if self.max_jobs and worker.jobs_count >= self.max_jobs:
+            worker.stop()
+        else:
+            self.idle.put(worker)
+
+    def run(self, arguments: List[str]) -> subprocess.CompletedProcess | None:
+        """ Returns the completed job, or None when it has to run as a one-shot process. """
+        if self.disabled:
+            return None
+        worker = self.acquire()
+        if worker is None:
+            return None
+
+        try:
+            returncode, stdout, stderr = worker.run(arguments)
+        except (OSError, ValueError, WorkerError):
+            worker.stop()
+            return None
+        self.release(worker)
+        return subprocess.CompletedProcess(arguments, returncode, stdout, stderr)
+
+    def close(self) -> None:
+        while not self.idle.empty():
+            self.idle.get_nowait().stop()
+
+
+pools: Dict[tuple, JarWorkerPool] = {}
+pools_lock = threading.Lock()
+
+
+def get_pool(java_executable: Path, config: dict, worker_config: dict) -> JarWorkerPool:
+    key = (str(java_executable), config['path'], config['jar'])
+    with pools_lock:
+        if key not in pools:
+            pools[key] = JarWorkerPool(java_executable, config['jar'], config['path'], worker_config['max_jobs'])
+        return pools[key]
+
+
+@atexit.register
+def close_pools() -> None:
+    with pools_lock:
+        for pool in pools.values():
+            pool.close()
+
+
+def run_jar(java_executable: Path, config: dict, arguments: list,
+            worker_config: dict = None) -> subprocess.CompletedProcess:
+    """
+    Runs the jar of the tool config like java -jar in its directory, on a resident worker when they are enabled.
+    """
+    arguments = [str(argument) for argument in arguments]
+    if worker_config and worker_config['enabled']:
+        completed_process = get_pool(java_executable, config, worker_config).run(arguments)
+        if completed_process is not None:
+            return completed_process
+    return subprocess.run([java_executable, '-jar', config['jar'], *arguments], capture_output=True, cwd=config['path'])
@@ -1,23 +1,38 @@
 import argparse
 import math
-import subprocess
 import sys
 import tempfile
-from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import Executor
+from contextlib import nullcontext
 from datetime import datetime
+from functools import partial
+from importlib import import_module
 from json import load
 from pathlib import Path
-from typing import Dict
+from typing import Callable, Dict, List, Tuple
 
-import anvil
 import numpy as np
 
-from internet import download_map_data, download_SRTM_data
+from checkpoint import StageStore, hash_file, load_region_voxels, save_region_voxels
+from draft import DraftRasterizer
+from extract import OSMExtract
+from heightmap import SRTMHeightmap
+from instancing import find_instances, get_class_offset, get_offset_classes, stamp
+from internet import Fetcher, SRTMCache, download_map_data, download_SRTM_data, get_SRTM_file_name
+from jvm_worker import run_jar
 from mathematics import MapProjection
-from mtl import get_material_from_file, get_material_sort_key
-from voxelizer import voxelize_mesh, make_terrain
+from mtl import MaterialIndex, get_material_sort_key
+from obj_reader import read_obj
+from region_writer import RegionWriter, write_region
+from scheduler import TaskScheduler, create_executor, create_thread_executor, split_into_chunks
+from tiling import TileGrid
+from transport import open_shared, release_shared, share, slice_shared
+from voxel_buffer import Palette, TerrainColumns, VoxelBuffer
+from voxelizer import make_terrain
 
 CONFIG_FILE = Path('config.json')
+OSM2WORLD_OUTPUT_FILE_NAME = 'osm2world_output.obj'
+VOXELIZER_ENGINES = {'open3d': 'voxelizer', 'self': 'voxelizer-self'}
 
 
 def read_config(path: Path):
@@ -30,216 +45,655 @@ def check_osm2world_stderr(stderr) -> bool:
     return True or stderr  # Add checking for elevation calculation fail
 
 
-def run_osm2world(java_executable: Path, config: dict, output_file_path: Path, map_data_path: Path) -> None:
-    command = [java_executable, '-jar', config['jar'],
-               '--input', map_data_path,
-               '-o', output_file_path,
-               '--config', config['config-file']]
+def download_region_data(config: dict, map_bbox: tuple, SRTM_path: Path, osm_file_path: Path):
+    """
+    Downloads SRTM tiles covering the bbox together with its osm data.
 
-    completed_process = subprocess.run(command, capture_output=True, cwd=config['path'])
-    if completed_process.returncode:
-        print(completed_process.stderr.decode(), sys.stderr)
-        raise Exception('Run OSM2World failed, trace is above.')
-
-    if not check_osm2world_stderr(completed_process.stderr):
-        print(completed_process.stderr.decode(), sys.stderr)
-        raise Exception('OSM2World generated wrong elevation, trace is above.')
+    With an extract path in the config osm data is sliced from the local extract instead of the osm API.
+    """
+    with Fetcher(config['workers'], config['host_connections']) as fetcher:
+        SRTM_cache = SRTMCache(fetcher, config['SRTM_url'], Path(config['SRTM_cache_path']),
+                               config['SRTM_links_ttl'])
+        SRTM_futures = [fetcher.submit(download_SRTM_data, SRTM_cache, SRTM_path, lat, lon)
+                        for lat, lon in get_SRTM_tiles(map_bbox)]
+        if config['extract_path']:
+            extract = OSMExtract([Path(config['extract_path'])], Path(config['extract_index_path']))
+            map_future = fetcher.submit(extract.write_bbox, map_bbox, osm_file_path)
+        else:
+            map_future = fetcher.submit(download_map_data, fetcher, config, map_bbox, osm_file_path)
 
+        for future in SRTM_futures:
+            print(future.result())
+        map_future.result()
 
-def run_splitter(java_executable: Path, config: dict,
-                 input_file_path: Path, output_directory_path: Path) -> Dict[str, Path]:
-    command = [java_executable, '-jar', config['jar'], input_file_path, output_directory_path]
 
-    completed_process = subprocess.run(command, capture_output=True, cwd=config['path'])
+def run_osm2world(java_executable: Path, config: dict, output_file_path: Path, map_data_path: Path,
+                  worker_config: dict = None) -> None:
+    arguments = ['--input', map_data_path,
+                 '-o', output_file_path,
+                 '--config', config['config-file']]
 
+    completed_process = run_jar(java_executable, config, arguments, worker_config)
     if completed_process.returncode:
         print(completed_process.stderr.decode(), sys.stderr)
-        raise Exception('Run splitter failed, trace is above.')
+        raise Exception('Run OSM2World failed, trace is above.')
 
-    output = completed_process.stdout.decode()
-    output_lines_list = output.strip().split('\n')
+    if not check_osm2world_stderr(completed_process.stderr):
+        print(completed_process.stderr.decode(), sys.stderr)
+        raise Exception('OSM2World generated wrong elevation, trace is above.')
 
-    output_dictionary = {}
-    for line in output_lines_list:
-        line_separated = line.split(config['separator-signature'])
-        output_dictionary[line_separated[0]] = Path(line_separated[1])
 
-    return output_dictionary
+def get_voxelizer(config: dict):
+    return import_module(VOXELIZER_ENGINES[config.get('engine', 'open3d')])
 
 
-def process_material(arguments):
-    (material_name, material_mesh_path, material_dictionary, osm2world_output_file_path, config,
-     region_min_bound, region_max_bound, region_offset, region_size_x, region_size_z, region_center_x, region_center_z,
-     terrain_blocks) = arguments
+def get_material_id(material_name: str, material_dictionary: dict, material_index: MaterialIndex) -> str | None:
     material = material_dictionary.get(material_name)
     if material:
-        material_id = material[0]
-    else:
-        material_id = get_material_from_file(config['voxelizer'], Path(str(osm2world_output_file_path) + '.mtl'),
-                                             material_name)
-
-    if material_id:
-        material_block = anvil.Block('minecraft', material_id)
-
-        if material_mesh_path:
-            voxel_list = voxelize_mesh(material_mesh_path, region_min_bound, region_max_bound, region_offset)
-            voxels = [(voxel, material_block) for voxel in voxel_list]
-            return voxels
+        return material[0]
+    return material_index.get_material_id(material_name)
+
+
+def process_material(arguments) -> VoxelBuffer:
+    material_id, material_mesh, config, region_min_bound, region_max_bound, region_offset = arguments
+    vertices, faces = material_mesh
+    return get_voxelizer(config['voxelizer']).voxelize_mesh(vertices, faces, region_min_bound, region_max_bound,
+                                                            region_offset, material_id)
+
+
+def process_shape(arguments) -> VoxelBuffer:
+    material_id, shape_mesh, config = arguments
+    vertices, faces = shape_mesh
+    unbounded = np.full(3, np.inf)
+    return get_voxelizer(config['voxelizer']).voxelize_mesh(vertices, faces, -unbounded, unbounded, np.zeros(3),
+                                                            material_id)
+
+
+def gather(store: Callable, count: int) -> List[Callable]:
+    """ Returns count callbacks, store gets the voxels passed to all of them joined once the last one is called. """
+    parts = [None] * count
+    pending = [count]
+
+    def store_part(i, voxels):
+        parts[i] = voxels
+        pending[0] -= 1
+        if not pending[0]:
+            store(VoxelBuffer.concatenate(parts))
+
+    return [partial(store_part, i) for i in range(count)]
+
+
+def schedule_instances(scheduler: TaskScheduler, shapes: list, grid_origin: np.array, arguments,
+                       store: Callable) -> None:
+    """
+    Queues voxelization of shapes repeated in a material and passes voxels of all their instances to store.
+
+    Every shape is voxelized once per sub-voxel offset class of its instances from the voxel grid origin, near the
+    first instance of the class, and the voxel pattern is stamped at the integer positions of the others.
+    """
+    material_id, _, config, region_min_bound, region_max_bound, region_offset = arguments
+    voxelizer = get_voxelizer(config['voxelizer'])
+    subdivisions = config['voxelizer']['instance_subdivisions']
+
+    tasks = []
+    for offsets, faces, corners in shapes:
+        positions, offset_classes = get_offset_classes(corners - grid_origin, subdivisions)
+        offset_classes, first_instances, instance_classes = np.unique(offset_classes, axis=0, return_index=True,
+                                                                      return_inverse=True)
+        for class_index, (offset_class, first_instance) in enumerate(zip(offset_classes, first_instances)):
+            origin = grid_origin + positions[first_instance]
+            # An unused vertex at the origin keeps the grid of voxelizers anchoring it at the lowest mesh corner
+            shape_vertices = np.concatenate([offsets + origin + get_class_offset(offset_class, subdivisions),
+                                             origin[np.newaxis]])
+            tasks.append(((material_id, (shape_vertices, faces), config),
+                          voxelizer.get_region_axes(positions[instance_classes.ravel() == class_index] -
+                                                    positions[first_instance])))
+
+    def place(store_pattern, instances_positions, pattern):
+        coordinates = stamp(pattern.coordinates, instances_positions)
+        coordinates = coordinates[np.all((coordinates >= region_min_bound) & (coordinates <= region_max_bound),
+                                         axis=1)]
+        store_pattern(VoxelBuffer.from_coordinates(coordinates + region_offset, material_id))
+
+    for (shape_arguments, instances_positions), store_pattern in zip(tasks, gather(store, len(tasks))):
+        scheduler.submit(partial(place, store_pattern, instances_positions), process_shape, shape_arguments)
+
+
+def schedule_material(scheduler: TaskScheduler, arguments, store: Callable) -> None:
+    """
+    Queues voxelization of one material on the shared scheduler and passes its voxels to store when done.
+
+    With instancing, shapes repeated in the material are voxelized once and stamped at every copy. Voxelizers
+    working on triangle chunks get the triangles of the rest of the mesh split into chunk tasks on the same queue,
+    other voxelizers get it as one task. Materials without a block id are skipped.
+    """
+    material_id, material_mesh, config, region_min_bound, region_max_bound, region_offset = arguments
+    if not material_id:
+        store(None)
+        return
+
+    voxelizer = get_voxelizer(config['voxelizer'])
+
+    if config['voxelizer']['instancing']:
+        vertices, faces = open_shared(material_mesh)
+        shapes, faces = find_instances(vertices, faces, config['voxelizer']['instance_min_count'])
+        if shapes:
+            store_instances, store = gather(store, 2)
+            schedule_instances(scheduler, shapes, voxelizer.get_grid_origin(vertices), arguments, store_instances)
+            material_mesh = (material_mesh[0], faces)
+            arguments = (material_id, material_mesh, config, region_min_bound, region_max_bound, region_offset)
+
+    if not hasattr(voxelizer, 'voxelize_chunk'):
+        scheduler.submit(store, process_material, arguments)
+        return
+
+    triangles = voxelizer.get_triangles(*open_shared(material_mesh), region_min_bound, region_max_bound)
+    chunks = split_into_chunks(triangles)
+    if not chunks:
+        store(None)
+        return
+
+    chunks_voxels = []
+    # Triangles are shared once, chunk tasks get only their slice of them
+    shared_triangles = share(triangles, scheduler.transport_directory) if scheduler.transport_directory else triangles
+
+    def store_chunk(voxels):
+        chunks_voxels.append(voxels)
+        if len(chunks_voxels) == len(chunks):
+            release_shared(shared_triangles)
+            store(voxelizer.get_region_voxels(np.unique(np.concatenate(chunks_voxels), axis=0),
+                                              region_min_bound, region_max_bound, region_offset, material_id))
+
+    for chunk in chunks:
+        scheduler.submit(store_chunk, voxelizer.voxelize_chunk,
+                         (slice_shared(shared_triangles, chunk), region_min_bound, region_max_bound))
+
+
+def get_map_bbox(config: dict, region_x: int, region_z: int) -> tuple:
+    """
+    Returns ((lat, lon), (lat, lon)) bbox of the osm data needed for the region.
+    """
+    return get_map_bboxes(config, [(region_x, region_z)])[0]
+
+
+def get_map_bboxes(config: dict, regions: List[Tuple[int, int]]) -> List[tuple]:
+    """
+    Returns ((lat, lon), (lat, lon)) bboxes of the osm data needed for the regions, all projected at once.
+    """
+    projection = MapProjection(config['map']['center_lat'], config['map']['center_lon'])
+
+    region_x, region_z = np.array(regions, dtype=np.int64).reshape(-1, 2).T
+    region_center_x = ((region_x + 0.5) * config['map']['region_size_x']).astype(np.int64)
+    region_center_z = ((region_z + 0.5) * config['map']['region_size_z']).astype(np.int64)
+
+    download_map_south_z = region_center_z + config['map']['download_length'] / 2
+    download_map_north_z = region_center_z - config['map']['download_length'] / 2
+
+    download_map_western_x = region_center_x - config['map']['download_width'] / 2
+    download_map_eastern_x = region_center_x + config['map']['download_width'] / 2
+
+    south_lat, western_lon = projection.to_lat_lon_array(-download_map_south_z, download_map_western_x)
+    north_lat, eastern_lon = projection.to_lat_lon_array(-download_map_north_z, download_map_eastern_x)
+    return [((south, west), (north, east)) for south, west, north, east in
+            zip(south_lat.tolist(), western_lon.tolist(), north_lat.tolist(), eastern_lon.tolist())]
+
+
+def get_SRTM_path(config: dict) -> Path:
+    """ Returns the directory OSM2World reads SRTM tiles from. """
+    return Path(config['osm2world']['path']) / 'SRTM'
+
+
+def get_SRTM_tiles(map_bbox: tuple) -> List[Tuple[int, int]]:
+    """ Returns (lat, lon) of SRTM tiles covering the bbox. """
+    integer_bbox = list(map(math.floor, map_bbox[0])), list(map(math.ceil, map_bbox[1]))
+    return [(lat, lon) for lat in range(integer_bbox[0][0], integer_bbox[1][0] + 1)
+            for lon in range(integer_bbox[0][1], integer_bbox[1][1] + 1)]
 
 
 def main(config, region_x, region_z, region_directory_path: Path):
     start_time = datetime.now()
-    java_executable_path = Path(config['java'])
 
-    center_lat = config['map']['center_lat']
-    center_lon = config['map']['center_lon']
+    print(f'Initialized with center coordinates at: ({config["map"]["center_lat"]}, {config["map"]["center_lon"]})')
 
-    region_size_x = config['map']['region_size_x']
-    region_size_z = config['map']['region_size_z']
-
-    download_width = config['map']['download_width']
-    download_length = config['map']['download_length']
-
-    material_dictionary = config['voxelizer']['material_dictionary']
-
-    print(f'Initialized with center coordinates at: ({center_lat}, {center_lon})')
-
-    projection = MapProjection(center_lat, center_lon)
-
-    region_center_x = int((region_x + 0.5) * region_size_x)
-    region_center_z = int((region_z + 0.5) * region_size_z)
-
-    download_map_south_z = region_center_z + download_length / 2
-    download_map_north_z = region_center_z - download_length / 2
-
-    download_map_western_x = region_center_x - download_width / 2
-    download_map_eastern_x = region_center_x + download_width / 2
-
-    map_bbox = (projection.to_lat_lon(-download_map_south_z, download_map_western_x),
-                projection.to_lat_lon(-download_map_north_z, download_map_eastern_x))
+    map_bbox = get_map_bbox(config, region_x, region_z)
 
     print(f'Got bounding box of map to download: {map_bbox}')
 
-    print('Downloading SRTM data')
-    SRTM_path = Path(config['osm2world']['path']) / 'SRTM'
-    SRTM_path.mkdir()
-    integer_bbox = list(map(math.floor, map_bbox[0])), list(map(math.ceil, map_bbox[1]))
-    for lat in range(integer_bbox[0][0], integer_bbox[1][0] + 1):
-        for lon in range(integer_bbox[0][1], integer_bbox[1][1] + 1):
-            result = download_SRTM_data(config['downloader']['SRTM_url'],
-                                        SRTM_path, lat, lon)
-            print(result)
-    print('Download complete!')
+    SRTM_path = get_SRTM_path(config)
+    SRTM_path.mkdir(parents=True, exist_ok=True)
+    prune_stage_store(config)
 
     with tempfile.TemporaryDirectory() as temporary_directory_path_plain:
         temporary_directory_path = Path(temporary_directory_path_plain)
-        print('Downloading osm data')
+        print('Downloading SRTM and osm data')
 
         osm_file_path = temporary_directory_path / 'map_data.osm'
-        download_map_data(config['downloader'], map_bbox, osm_file_path)
+        download_region_data(config['downloader'], map_bbox, SRTM_path, osm_file_path)
 
         print('Download complete!')
-        print('Running OSM2World')
-
-        osm2world_output_file_path = temporary_directory_path / 'osm2world_output.obj'
 
-        run_osm2world(java_executable_path, config['osm2world'], osm2world_output_file_path, osm_file_path)
-
-        print('OSM2World finished!')
-        print('Running material splitter')
-        splitter_output_directory_path = temporary_directory_path / 'splitter_output'
-        splitter_output_directory_path.mkdir()
+        if config['draft']['enabled']:
+            with create_thread_executor(config['voxelizer']) as executor:
+                convert_region_draft(config, region_x, region_z, region_directory_path, osm_file_path, executor)
+        else:
+            convert_region(config, region_x, region_z, region_directory_path, temporary_directory_path,
+                           osm_file_path)
+
+    end_time = datetime.now()
+    print(f'Done in {end_time - start_time}!')
+
+
+def convert_region(config: dict, region_x: int, region_z: int, region_directory_path: Path,
+                   temporary_directory_path: Path, osm_file_path: Path) -> None:
+    """
+    Converts downloaded osm data of the region into its region file, SRTM data must be in place already.
+    """
+    osm2world_output_file_path = convert_osm_data(config, region_x, region_z, temporary_directory_path,
+                                                  osm_file_path)
+
+    if config['voxelizer']['tile_size']:
+        with create_executor(config['voxelizer']) as executor, \
+                create_thread_executor(config['voxelizer']) as thread_executor:
+            convert_region_tiled(config, region_x, region_z, region_directory_path, temporary_directory_path,
+                                 osm2world_output_file_path, executor, thread_executor)
+        return
+
+    with create_executor(config['voxelizer']) as executor:
+        voxels, terrain = voxelize_region(config, region_x, region_z, temporary_directory_path,
+                                          osm2world_output_file_path, executor)
+
+    with create_thread_executor(config['voxelizer']) as executor:
+        save_region_file(config, region_x, region_z, region_directory_path, voxels, terrain, executor)
+
+
+def get_stage_store(config: dict) -> StageStore | None:
+    """ Returns the store of stage outputs in the work directory, None when stage outputs are not kept. """
+    if not config['work']['path']:
+        return None
+    return StageStore(Path(config['work']['path']))
+
+
+def prune_stage_store(config: dict) -> None:
+    """ Removes stage outputs not used for longer than the work TTL in seconds, a null TTL keeps them forever. """
+    store = get_stage_store(config)
+    if store is not None and config['work']['ttl'] is not None:
+        store.prune(config['work']['ttl'])
+
+
+def get_SRTM_digests(config: dict, region_x: int, region_z: int) -> Dict[str, str | None]:
+    """ Returns hashes of SRTM tiles covering the map bbox of the region by tile name, None for missing tiles. """
+    SRTM_path = get_SRTM_path(config)
+    digests = {}
+    for lat, lon in get_SRTM_tiles(get_map_bbox(config, region_x, region_z)):
+        SRTM_file_name = get_SRTM_file_name(lat, lon)
+        tile_path = SRTM_path / f'{SRTM_file_name}.hgt'
+        digests[SRTM_file_name] = hash_file(tile_path) if tile_path.exists() else None
+    return digests
+
+
+def convert_osm_data(config: dict, region_x: int, region_z: int, temporary_directory_path: Path,
+                     osm_file_path: Path) -> Path:
+    """
+    Runs OSM2World on the osm data of the region and returns the path of its output, the mtl file is next to it.
+
+    With a work directory the output is kept there keyed by the osm data, the SRTM tiles OSM2World takes elevation
+    from and the OSM2World config, OSM2World is run only when there is no output for them yet.
+    """
+    store = get_stage_store(config)
+    if store is None:
+        output_context = nullcontext(temporary_directory_path)
+    else:
+        osm2world_config_file_path = Path(config['osm2world']['path']) / config['osm2world']['config-file']
+        key = StageStore.get_key('osm2world', hash_file(osm_file_path), get_SRTM_digests(config, region_x, region_z),
+                                 config['osm2world'],
+                                 hash_file(osm2world_config_file_path) if osm2world_config_file_path.exists() else None)
+        if store.get('osm2world', key):
+            print('Reusing OSM2World output')
+            return store.get_path('osm2world', key) / OSM2WORLD_OUTPUT_FILE_NAME
+        output_context = store.create('osm2world', key)
 
-        splited_files_dictionary = run_splitter(java_executable_path, config['splitter'],
-                                                osm2world_output_file_path, splitter_output_directory_path)
+    print('Running OSM2World')
 
-        print('Material splitter finished!')
+    with output_context as output_directory_path:
+        run_osm2world(Path(config['java']), config['osm2world'], output_directory_path / OSM2WORLD_OUTPUT_FILE_NAME,
+                      osm_file_path, config['jvm_worker'])
 
-        region = anvil.EmptyRegion(region_x, region_z, config['voxelizer']['max_y'])
+    print('OSM2World finished!')
+    output_directory_path = temporary_directory_path if store is None else store.get_path('osm2world', key)
+    return output_directory_path / OSM2WORLD_OUTPUT_FILE_NAME
 
-        region_min_bound = np.array([-region_size_x / 2, config['map']['min_height'], -region_size_z / 2])
-        region_max_bound = np.array([region_size_x / 2 - 1,
-                                     config['voxelizer']['max_y'] + config['map']['min_height'] - config['voxelizer'][
-                                         'min_y'], region_size_z / 2 - 1])
 
-        region_offset = np.array(
-            [region_center_x, config['voxelizer']['min_y'] - config['map']['min_height'], region_center_z])
+def read_osm2world_output(osm2world_output_file_path: Path) -> Dict[str, Tuple[np.array, np.array]]:
+    """ Returns (vertices, faces) meshes of OSM2World output by material name. """
+    print('Reading OSM2World output')
 
-        print('Starting voxelization')
+    material_meshes = read_obj(osm2world_output_file_path)
 
-        terrain_blocks = [anvil.Block('minecraft', block_id) for block_id in config['voxelizer']['terrain_blocks']]
+    print('Reading finished!')
+    return material_meshes
 
-        splitted_materials = sorted(splited_files_dictionary.items(), key=get_material_sort_key(material_dictionary))
 
-        terrain_material_objects = []
-        terrain_material = material_dictionary.get(config['voxelizer']['terrain_material_name'])
-        if terrain_material:
-            terrain_material_id = terrain_material[0]
+def get_mtl_file_path(osm2world_output_file_path: Path) -> Path:
+    return Path(str(osm2world_output_file_path) + '.mtl')
 
-            terrain_material_block = anvil.Block('minecraft', terrain_material_id)
 
-            i = 0
-            while i < len(splitted_materials):
-                if splitted_materials[i][0] == config['voxelizer']['terrain_material_name']:
-                    terrain_material_objects.append(splitted_materials.pop(i))
-                else:
-                    i += 1
+def get_region_bounds(config: dict, region_x: int, region_z: int) -> Tuple[np.array, np.array, np.array]:
+    """
+    Returns inclusive min and max bounds of region voxels around the region center, with the offset moving them
+    into world coordinates.
+    """
+    region_size_x = config['map']['region_size_x']
+    region_size_z = config['map']['region_size_z']
 
-        with ProcessPoolExecutor() as executor:
-            materials_voxels = executor.map(process_material, (
-                (material_name, material_mesh_path, material_dictionary, osm2world_output_file_path, config,
-                 region_min_bound, region_max_bound, region_offset, region_size_x, region_size_z, region_center_x,
-                 region_center_z,
-                 terrain_blocks) for material_name, material_mesh_path in splitted_materials))
+    region_center_x = int((region_x + 0.5) * region_size_x)
+    region_center_z = int((region_z + 0.5) * region_size_z)
 
-        height_matrix = None
-        terrain_matrix = None
-        object_voxels_list = []
-        terrain_voxels_list = []
-        if terrain_material_objects:
-            print('Generating terrain')
-            height_matrix = [[None for _ in range(region_size_x)] for _ in range(region_size_z)]
-            terrain_matrix = [[False for _ in range(region_size_x)] for _ in range(region_size_z)]
+    region_min_bound = np.array([-region_size_x / 2, config['map']['min_height'], -region_size_z / 2])
+    region_max_bound = np.array([region_size_x / 2 - 1,
+                                 config['voxelizer']['max_y'] + config['map']['min_height'] - config['voxelizer'][
+                                     'min_y'], region_size_z / 2 - 1])
 
-            for terrain_material_object in terrain_material_objects:
-                terrain_voxels_list.extend(
-                    voxelize_mesh(terrain_material_object[1], region_min_bound, region_max_bound, region_offset))
+    region_offset = np.array(
+        [region_center_x, config['voxelizer']['min_y'] - config['map']['min_height'], region_center_z])
+    return region_min_bound, region_max_bound, region_offset
 
-            for x, y, z in terrain_voxels_list:
-                x, z = x % region_size_x, z % region_size_z
-                if height_matrix and (height_matrix[z][x] is None or y > height_matrix[z][x]):
-                    height_matrix[z][x] = y
-                    terrain_matrix[z][x] = True
 
-        for voxels in materials_voxels:
-            if voxels:
-                for (x, y, z), block in voxels:
-                    object_voxels_list.append(((x, y, z), block))
-                    x, z = x % region_size_x, z % region_size_z
-                    if (height_matrix and terrain_matrix and
-                        not terrain_matrix[z][x] and
-                        (height_matrix[z][x] is None or y < height_matrix[z][x])) and \
-                            block.id in config['voxelizer']['terrain_interpolator_markers']:
-                        height_matrix[z][x] = y
+def get_materials(config: dict, osm2world_output_file_path: Path) -> Tuple[list, list]:
+    """
+    Reads OSM2World output, returns (block id, mesh) of object materials in placing order and of terrain materials.
+    """
+    material_meshes = read_osm2world_output(osm2world_output_file_path)
+    material_dictionary = config['voxelizer']['material_dictionary']
+    terrain_material_name = config['voxelizer']['terrain_material_name']
+
+    material_cache_path = config['voxelizer']['material_cache_path']
+    material_index = MaterialIndex(config['voxelizer'], get_mtl_file_path(osm2world_output_file_path),
+                                   Path(material_cache_path) if material_cache_path else None)
+
+    materials = []
+    terrain_materials = []
+    for material_name, material_mesh in sorted(material_meshes.items(),
+                                               key=get_material_sort_key(material_dictionary)):
+        material_id = get_material_id(material_name, material_dictionary, material_index)
+        if material_name == terrain_material_name and material_dictionary.get(terrain_material_name):
+            terrain_materials.append((material_id, material_mesh))
+        else:
+            materials.append((material_id, material_mesh))
+    return materials, terrain_materials
+
+
+def get_transport_directory(config: dict, temporary_directory_path: Path) -> Path | None:
+    if not config['voxelizer'].get('shared_transport'):
+        return None
+    transport_directory_path = temporary_directory_path / 'transport'
+    transport_directory_path.mkdir(exist_ok=True)
+    return transport_directory_path
+
+
+def voxelize_materials(scheduler: TaskScheduler, config: dict, materials: list, min_bound: np.array,
+                       max_bound: np.array, offset: np.array) -> List[VoxelBuffer | None]:
+    """ Voxelizes (block id, mesh) materials inside the bounds on the scheduler, returns their voxels in order. """
+    materials_voxels = [None] * len(materials)
+    for i, (material_id, material_mesh) in enumerate(materials):
+        schedule_material(scheduler, (material_id, material_mesh, config, min_bound, max_bound, offset),
+                          partial(materials_voxels.__setitem__, i))
+    scheduler.run()
+    return materials_voxels
+
+
+def get_terrain_block(config: dict, terrain_materials: list) -> str | None:
+    """ Returns the cover block of the terrain, None when the region gets no terrain. """
+    if config['voxelizer']['SRTM_terrain']:
+        terrain_material = config['voxelizer']['material_dictionary'].get(config['voxelizer']['terrain_material_name'])
+        return terrain_material[0] if terrain_material else None
+    return terrain_materials[0][0] if terrain_materials else None
+
+
+def create_height_matrix(config: dict, region_x: int, region_z: int) -> np.array:
+    """
+    Returns heights of region columns in voxels, rows go along z.
+
+    With SRTM terrain they are sampled from the SRTM tiles at centers of the columns, NaN is left where tiles have
+    no data. Otherwise the matrix is empty (NaN) for terrain voxels to be added into.
+    """
+    if not config['voxelizer']['SRTM_terrain']:
+        return np.full((config['map']['region_size_z'], config['map']['region_size_x']), np.nan)
+    return sample_SRTM_heights(config, region_x, region_z)
+
+
+def sample_SRTM_heights(config: dict, region_x: int, region_z: int) -> np.array:
+    """ Returns heights of region columns in voxels sampled from SRTM tiles, NaN where they have no data. """
+    region_size_x = config['map']['region_size_x']
+    region_size_z = config['map']['region_size_z']
 
-        if terrain_material_object is not None:
-            terrain_voxels_list = make_terrain(height_matrix, config['voxelizer']['min_y'],
-                                               int(region_center_x - region_size_x / 2),
-                                               int(region_center_z - region_size_z / 2),
-                                               terrain_material_block, anvil.Block('minecraft', 'bedrock'),
-                                               terrain_blocks)
-            print('Terrain generation finished!')
+    projection = MapProjection(config['map']['center_lat'], config['map']['center_lon'])
+    # Latitude depends only on z and longitude only on x, so a column of rows and a row of columns are projected
+    z = np.arange(region_z * region_size_z, (region_z + 1) * region_size_z) + 0.5
+    x = np.arange(region_x * region_size_x, (region_x + 1) * region_size_x) + 0.5
+    lat, lon = projection.to_lat_lon_array(-z[:, np.newaxis], x[np.newaxis])
+
+    heights = SRTMHeightmap(get_SRTM_path(config)).sample(lat, lon)
+    return heights + config['voxelizer']['min_y'] - config['map']['min_height']
+
+
+def add_heights(config: dict, height_matrix: np.array, marker_height_matrix: np.array, terrain_voxels: VoxelBuffer,
+                object_voxels: VoxelBuffer) -> None:
+    """ Adds tops of terrain voxels and bottoms of terrain interpolator marker voxels into the height matrices. """
+    region_size_z, region_size_x = height_matrix.shape
+
+    x, y, z = terrain_voxels.coordinates.T
+    np.fmax.at(height_matrix, (z % region_size_z, x % region_size_x), y)
+
+    marker_voxels = object_voxels.select(object_voxels.mask(config['voxelizer']['terrain_interpolator_markers']))
+    x, y, z = marker_voxels.coordinates.T
+    np.fmin.at(marker_height_matrix, (z % region_size_z, x % region_size_x), y)
 
-        for (x, y, z), block in terrain_voxels_list + object_voxels_list:
-            region.set_block(block, x, y, z)
 
-        print('Voxelization finished!')
-        print('Saving')
+def build_terrain(config: dict, region_x: int, region_z: int, height_matrix: np.array,
+                  marker_height_matrix: np.array, terrain_block: str) -> TerrainColumns:
+    """
+    Builds terrain from the height matrices, columns without terrain get heights of markers or interpolated.
+
+    Without any heights, like over sea where SRTM has no tiles, the region is flat at the min height of the map.
+    """
+    terrain_matrix = ~np.isnan(height_matrix)
+    height_matrix[~terrain_matrix] = marker_height_matrix[~terrain_matrix]
+    if np.all(np.isnan(height_matrix)):
+        height_matrix[:] = config['voxelizer']['min_y']
+
+    return make_terrain(height_matrix, config['voxelizer']['min_y'],
+                        region_x * config['map']['region_size_x'], region_z * config['map']['region_size_z'],
+                        terrain_block, 'bedrock', config['voxelizer']['terrain_blocks'],
+                        config['voxelizer']['terrain_seed'])
+
 
-        region.save(str(region_directory_path / f'r.{region_x}.{region_z}.mca'))
+def voxelize_region(config: dict, region_x: int, region_z: int, temporary_directory_path: Path,
+                    osm2world_output_file_path: Path, executor: Executor) -> Tuple[VoxelBuffer, TerrainColumns | None]:
+    """
+    Voxelizes OSM2World output of the region on the executor and builds its terrain.
 
-        end_time = datetime.now()
-        print(f'Done in {end_time - start_time}!')
+    With a work directory voxels are kept there keyed by the OSM2World output, the region, the map and voxelizer
+    config and the SRTM tiles when terrain is sampled from them, so a failed save or a change of only the saving
+    config does not voxelize the region again.
+    """
+    store = get_stage_store(config)
+    if store is None:
+        return voxelize_region_meshes(config, region_x, region_z, temporary_directory_path,
+                                      osm2world_output_file_path, executor)
+
+    key = StageStore.get_key('voxelize', hash_file(osm2world_output_file_path),
+                             hash_file(get_mtl_file_path(osm2world_output_file_path)), region_x, region_z,
+                             config['map'], get_voxelization_config(config['voxelizer']),
+                             get_SRTM_digests(config, region_x, region_z) if config['voxelizer']['SRTM_terrain']
+                             else None)
+    if store.get('voxelize', key):
+        print('Reusing voxelization output')
+        return load_region_voxels(store.get_path('voxelize', key))
+
+    voxels, terrain = voxelize_region_meshes(config, region_x, region_z, temporary_directory_path,
+                                             osm2world_output_file_path, executor)
+    with store.create('voxelize', key) as output_directory_path:
+        save_region_voxels(output_directory_path, voxels, terrain)
+    return voxels, terrain
+
+
+def get_voxelization_config(voxelizer_config: dict) -> dict:
+    """ Returns the voxelizer config without options which do not change voxels, like parallelism and saving. """
+    return {name: value for name, value in voxelizer_config.items()
+            if name not in ('workers', 'shared_transport', 'data_version', 'compression_level', 'material_cache_path')}
+
+
+def voxelize_region_meshes(config: dict, region_x: int, region_z: int, temporary_directory_path: Path,
+                           osm2world_output_file_path: Path,
+                           executor: Executor) -> Tuple[VoxelBuffer, TerrainColumns | None]:
+    region_min_bound, region_max_bound, region_offset = get_region_bounds(config, region_x, region_z)
+
+    print('Starting voxelization')
+
+    materials, terrain_materials = get_materials(config, osm2world_output_file_path)
+    terrain_block = get_terrain_block(config, terrain_materials)
+    if config['voxelizer']['SRTM_terrain']:
+        # Heights are sampled from SRTM tiles, so the terrain mesh is not voxelized
+        terrain_materials = []
+
+    scheduler = TaskScheduler(executor, get_transport_directory(config, temporary_directory_path))
+    materials_voxels = voxelize_materials(scheduler, config, materials + terrain_materials, region_min_bound,
+                                          region_max_bound, region_offset)
+
+    object_voxels = VoxelBuffer.concatenate(materials_voxels[:len(materials)])
+    terrain = None
+    if terrain_block:
+        print('Generating terrain')
+        height_matrix = create_height_matrix(config, region_x, region_z)
+        marker_height_matrix = np.full_like(height_matrix, np.nan)
+        add_heights(config, height_matrix, marker_height_matrix,
+                    VoxelBuffer.concatenate(materials_voxels[len(materials):]), object_voxels)
+        terrain = build_terrain(config, region_x, region_z, height_matrix, marker_height_matrix, terrain_block)
+        print('Terrain generation finished!')
+
+    voxels = object_voxels.dedupe()
+
+    print('Voxelization finished!')
+    return voxels, terrain
+
+
+def save_region_file(config: dict, region_x: int, region_z: int, region_directory_path: Path, voxels: VoxelBuffer,
+                     terrain: TerrainColumns | None, executor: Executor) -> None:
+    print('Saving')
+
+    write_region(region_directory_path / f'r.{region_x}.{region_z}.mca', region_x, region_z, voxels,
+                 config['voxelizer']['min_y'], config['voxelizer']['max_y'],
+                 config['voxelizer']['data_version'], config['voxelizer']['compression_level'], terrain, executor)
+
+
+def convert_region_draft(config: dict, region_x: int, region_z: int, region_directory_path: Path,
+                         osm_file_path: Path, executor: Executor) -> None:
+    """
+    Imports a quick preview of the region rasterized straight from osm data, without OSM2World and voxelization.
+
+    Terrain heights are sampled from SRTM tiles, without any the region is flat at the min height of the map.
+    """
+    print('Rasterizing osm data')
+
+    height_matrix = sample_SRTM_heights(config, region_x, region_z)
+    terrain_block = config['voxelizer']['material_dictionary'][config['voxelizer']['terrain_material_name']][0]
+    terrain = build_terrain(config, region_x, region_z, height_matrix, np.full_like(height_matrix, np.nan),
+                            terrain_block)
+
+    voxels = DraftRasterizer(config, region_x, region_z, terrain.heights).rasterize(osm_file_path)
+
+    print('Rasterization finished!')
+    save_region_file(config, region_x, region_z, region_directory_path, voxels, terrain, executor)
+
+
+def get_tiles_materials(grid: TileGrid, config: dict, materials: list,
+                        transport_directory_path: Path | None) -> Tuple[List[list], list]:
+    """
+    Splits (block id, mesh) materials into their faces overlapping every tile of the grid through a spatial index.
+
+    Returns materials of every tile, which skip materials without faces there, and shared vertices to release.
+    Vertices of a material are shared once for all its tiles.
+    """
+    voxelizer = get_voxelizer(config['voxelizer'])
+    tiles_materials = [[] for _ in range(len(grid))]
+    shared_vertices = []
+    for material_id, (vertices, faces) in materials:
+        if not material_id or not len(faces):
+            continue
+        triangles = vertices[faces]
+        lower, upper = voxelizer.get_mesh_bounds(triangles.min(axis=1), triangles.max(axis=1))
+        del triangles
+
+        if transport_directory_path:
+            vertices = share(vertices, transport_directory_path)
+            shared_vertices.append(vertices)
+        for tile_materials, tile_faces in zip(tiles_materials, grid.index(lower, upper)):
+            if len(tile_faces):
+                tile_materials.append((material_id, (vertices, faces[tile_faces])))
+    return tiles_materials, shared_vertices
+
+
+def convert_region_tiled(config: dict, region_x: int, region_z: int, region_directory_path: Path,
+                         temporary_directory_path: Path, osm2world_output_file_path: Path, executor: Executor,
+                         thread_executor: Executor) -> None:
+    """
+    Voxelizes and writes the region in tiles of chunk columns, so only voxels of one tile are in memory at once.
+
+    Terrain needs heights of the whole region before its first chunk is written, so the first pass over tiles
+    voxelizes terrain and marker materials into height matrices only. The second pass voxelizes object materials
+    tile by tile and writes chunks of every tile right away. Marker materials are voxelized in both passes.
+    """
+    region_min_bound, region_max_bound, region_offset = get_region_bounds(config, region_x, region_z)
+    grid = TileGrid(region_min_bound, region_max_bound, config['voxelizer']['tile_size'])
+
+    print(f'Starting voxelization in {len(grid)} tiles')
+
+    materials, terrain_materials = get_materials(config, osm2world_output_file_path)
+    terrain_block = get_terrain_block(config, terrain_materials)
+    if config['voxelizer']['SRTM_terrain']:
+        # Heights are sampled from SRTM tiles, so the terrain mesh is not voxelized
+        terrain_materials = []
+    transport_directory_path = get_transport_directory(config, temporary_directory_path)
+    scheduler = TaskScheduler(executor, transport_directory_path)
+
+    tiles_materials, shared_vertices = get_tiles_materials(grid, config, materials, transport_directory_path)
+    tiles_terrain_materials, shared_terrain_vertices = get_tiles_materials(grid, config, terrain_materials,
+                                                                           transport_directory_path)
+
+    terrain = None
+    if terrain_block:
+        print('Generating terrain')
+        markers = set(config['voxelizer']['terrain_interpolator_markers'])
+        height_matrix = create_height_matrix(config, region_x, region_z)
+        marker_height_matrix = np.full_like(height_matrix, np.nan)
+
+        for (tile_min_bound, tile_max_bound), tile_materials, tile_terrain_materials in \
+                zip(grid, tiles_materials, tiles_terrain_materials):
+            tile_marker_materials = [material for material in tile_materials if material[0] in markers]
+            materials_voxels = voxelize_materials(scheduler, config, tile_marker_materials + tile_terrain_materials,
+                                                  tile_min_bound, tile_max_bound, region_offset)
+            add_heights(config, height_matrix, marker_height_matrix,
+                        VoxelBuffer.concatenate(materials_voxels[len(tile_marker_materials):]),
+                        VoxelBuffer.concatenate(materials_voxels[:len(tile_marker_materials)]))
+
+        terrain = build_terrain(config, region_x, region_z, height_matrix, marker_height_matrix, terrain_block)
+        print('Terrain generation finished!')
+
+    print('Voxelizing and saving tiles')
+
+    palette = Palette(material_id for material_id, _ in materials if material_id)
+    with RegionWriter(region_directory_path / f'r.{region_x}.{region_z}.mca', region_x, region_z,
+                      config['voxelizer']['min_y'], config['voxelizer']['max_y'], config['voxelizer']['data_version'],
+                      config['voxelizer']['compression_level'], terrain, thread_executor, palette) as writer:
+        for (tile_min_bound, tile_max_bound), tile_materials in zip(grid, tiles_materials):
+            voxels = VoxelBuffer.concatenate(voxelize_materials(scheduler, config, tile_materials, tile_min_bound,
+                                                                tile_max_bound, region_offset), palette).dedupe()
+            writer.write(voxels, grid.get_chunks_positions(tile_min_bound, tile_max_bound)
+                         if terrain is not None else None)
+
+    for vertices in shared_vertices + shared_terrain_vertices:
+        release_shared(vertices)
+    print('Voxelization and saving finished!')
 
 
 if __name__ == '__main__':
@@ -251,9 +705,16 @@ if __name__ == '__main__':
     parser.add_argument('-x', type=int, required=True, help='Region X coordinate')
     parser.add_argument('-z', type=int, required=True, help='Region Z coordinate')
     parser.add_argument('-O', '--output', dest='output_directory_path', required=True, help='Output directory path')
+    parser.add_argument('--draft', action='store_true', help='Rasterize osm data directly for a quick preview')
+    parser.add_argument('--work', dest='work_directory_path', default=None,
+                        help='Work directory keeping stage outputs to resume from, delete it to clear them')
 
     args = parser.parse_args()
 
     readed_config = read_config(Path(args.config_file_path if args.config_file_path else CONFIG_FILE))
+    if args.draft:
+        readed_config['draft']['enabled'] = True
+    if args.work_directory_path:
+        readed_config['work']['path'] = args.work_directory_path
 
     main(readed_config, args.x, args.z, Path(args.output_directory_path))
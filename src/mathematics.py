@@ -1,5 +1,7 @@
 import math
 
+import numpy as np
+
 
 class MapProjection:
     origin_x = None
@@ -30,6 +32,25 @@ class MapProjection:
         return (MercatorProjection.y_to_lat((y + self.origin_y) / self.scale_factor),
                 MercatorProjection.x_to_lon((x + self.origin_x) / self.scale_factor))
 
+    def to_yx_array(self, lat, lon):
+        """ Array version of to_yx, y follows the shape of lat and x the shape of lon. """
+        if self.origin_x is None:
+            raise ValueError("The origin needs to be set first")
+
+        x = MercatorProjection.lon_to_x_array(lon) * self.scale_factor - self.origin_x
+        y = MercatorProjection.lat_to_y_array(lat) * self.scale_factor - self.origin_y
+
+        # Snap to mm precision like to_yx
+        return np.round(y * 1000) / 1000.0, np.round(x * 1000) / 1000.0
+
+    def to_lat_lon_array(self, y, x):
+        """ Array version of to_lat_lon, lat follows the shape of y and lon the shape of x. """
+        if self.origin_x is None:
+            raise ValueError("The origin needs to be set first")
+
+        return (MercatorProjection.y_to_lat_array((np.asarray(y) + self.origin_y) / self.scale_factor),
+                MercatorProjection.x_to_lon_array((np.asarray(x) + self.origin_x) / self.scale_factor))
+
 
 class MercatorProjection:
     R_MAJOR = 6378137.0
@@ -65,6 +86,27 @@ class MercatorProjection:
         """ Convert from Mercator projection (range [0..1]) to latitude. """
         return 360.0 * math.atan(math.exp((y - 0.5) * (2.0 * math.pi))) / math.pi - 90.0
 
+    @staticmethod
+    def lon_to_x_array(longitude):
+        """ Array version of lon_to_x. """
+        return (np.asarray(longitude, dtype=np.float64) + 180.0) / 360.0
+
+    @staticmethod
+    def x_to_lon_array(x):
+        """ Array version of x_to_lon. """
+        return 360.0 * (np.asarray(x, dtype=np.float64) - 0.5)
+
+    @staticmethod
+    def lat_to_y_array(latitude):
+        """ Array version of lat_to_y. """
+        sin_lat = np.sin(np.radians(np.asarray(latitude, dtype=np.float64)))
+        return np.log((1.0 + sin_lat) / (1.0 - sin_lat)) / (4.0 * np.pi) + 0.5
+
+    @staticmethod
+    def y_to_lat_array(y):
+        """ Array version of y_to_lat. """
+        return 360.0 * np.arctan(np.exp((np.asarray(y, dtype=np.float64) - 0.5) * (2.0 * np.pi))) / np.pi - 90.0
+
     @staticmethod
     def lat_to_y_elliptical(lat):
         """ This is for the Elliptical Mercator version """
@@ -89,3 +131,29 @@ class MercatorProjection:
             phi += dphi
             i += 1
         return math.degrees(phi)
+
+    @staticmethod
+    def lat_to_y_elliptical_array(lat):
+        """ Array version of lat_to_y_elliptical. """
+        lat = np.clip(np.asarray(lat, dtype=np.float64), -89.5, 89.5)
+        phi = np.radians(lat)
+        con = MercatorProjection.ECCENT * np.sin(phi)
+        con = np.power((1.0 - con) / (1.0 + con), MercatorProjection.COM)
+        ts = np.tan(0.5 * ((np.pi * 0.5) - phi)) / con
+        return 0 - MercatorProjection.R_MAJOR * np.log(ts)
+
+    @staticmethod
+    def y_to_lat_elliptical_array(y):
+        """ Array version of y_to_lat_elliptical, every point stops iterating when it converges like in it. """
+        ts = np.exp(-np.asarray(y, dtype=np.float64) / MercatorProjection.R_MAJOR)
+        phi = np.array(np.pi / 2 - 2 * np.arctan(ts))
+        active = np.ones(phi.shape, dtype=bool)
+        for _ in range(15):
+            con = MercatorProjection.ECCENT * np.sin(phi[active])
+            dphi = np.pi / 2 - 2 * np.arctan(ts[active] * np.power((1.0 - con) / (1.0 + con),
+                                                                  MercatorProjection.COM)) - phi[active]
+            phi[active] += dphi
+            active[active] = np.abs(dphi) > 0.000000001
+            if not np.any(active):
+                break
+        return np.degrees(phi)
@@ -1,5 +1,16 @@
+import hashlib
+import json
+import os
+import re
 import sys
+import tempfile
+import threading
 from pathlib import Path
+from typing import Dict, List
+
+import numpy as np
+
+CACHE_LOCK = threading.Lock()  # Regions of a batch resolve their materials concurrently
 
 
 def is_number(s):
@@ -39,50 +50,129 @@ def get_color_from_line(line: str) -> tuple | None:
             return value
 
 
-def get_material_from_file(config: dict, mtl_file_path: Path, material_name: str) -> str | None:
+class MaterialIndex:
+    """
+    Materials of an .mtl file parsed once and resolved into block ids.
+
+    Materials mapped by the material dictionary are left out, the others are resolved by their first texture and
+    materials without a texture by their colour. Textures are matched by one precompiled pattern, where the first
+    dictionary entry found in the texture path wins, and colours of all materials are matched to the nearest
+    dictionary colour at once.
+    With a cache path, resolutions are also stored in a json file and reused by later runs, as long as the
+    dictionaries and material definitions are the same.
+    """
+
+    def __init__(self, config: dict, mtl_file_path: Path, cache_path: Path = None):
+        self.texture_dictionary = config['material_texture_dictionary']
+        self.color_dictionary = config['material_color_dictionary']
+        self.cache_path = cache_path
+        material_dictionary = config['material_dictionary']
+        self.definitions = {name: definition for name, definition in read_mtl(mtl_file_path).items()
+                            if not material_dictionary.get(name)}
+
+        self.cache = self.load_cache()
+        resolved = {name: self.cache[get_definition_key(name, definition)] for name, definition in
+                    self.definitions.items() if get_definition_key(name, definition) in self.cache}
+        unresolved = {name: definition for name, definition in self.definitions.items() if name not in resolved}
+
+        self.material_ids = {**resolved, **self.resolve(unresolved)}
+        if self.cache_path and unresolved:
+            self.cache.update((get_definition_key(name, definition), self.material_ids[name])
+                              for name, definition in unresolved.items())
+            self.save_cache()
+
+    def get_material_id(self, material_name: str) -> str | None:
+        return self.material_ids.get(material_name)
+
+    def resolve(self, definitions: Dict[str, tuple]) -> Dict[str, str | None]:
+        material_ids = {}
+        colored_names = []
+        texture_matcher = TextureMatcher(self.texture_dictionary)
+        for name, (texture_path, color) in definitions.items():
+            if texture_path:
+                material_ids[name] = texture_matcher.get_material_id(texture_path)
+                if not material_ids[name]:
+                    print(f'Skipping unknown material: {name} with texture {texture_path}', file=sys.stderr)
+            elif color and self.color_dictionary:
+                colored_names.append(name)
+            else:
+                material_ids[name] = None
+
+        if colored_names:
+            nearest_ids = get_nearest_color_ids(self.color_dictionary,
+                                                np.array([definitions[name][1] for name in colored_names]))
+            material_ids.update(zip(colored_names, nearest_ids))
+        return material_ids
+
+    def get_signature(self) -> str:
+        return hashlib.sha256(json.dumps([self.texture_dictionary, self.color_dictionary]).encode()).hexdigest()
+
+    def load_cache(self) -> Dict[str, str | None]:
+        if not self.cache_path or not self.cache_path.exists():
+            return {}
+        try:
+            with open(self.cache_path) as cache_file:
+                cache = json.load(cache_file)
+        except (OSError, ValueError):
+            return {}
+        if cache.get('signature') != self.get_signature():
+            return {}
+        return cache['materials']
+
+    def save_cache(self) -> None:
+        """ Merges the resolutions into the cache file, so ones saved by other regions in the meantime are kept. """
+        self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+        with CACHE_LOCK:
+            self.cache = {**self.load_cache(), **self.cache}
+            file_descriptor, temporary_cache_path = tempfile.mkstemp(suffix='.tmp', dir=self.cache_path.parent)
+            with os.fdopen(file_descriptor, 'w') as cache_file:
+                json.dump({'signature': self.get_signature(), 'materials': self.cache}, cache_file)
+            os.replace(temporary_cache_path, self.cache_path)
+
+
+def read_mtl(mtl_file_path: Path) -> Dict[str, tuple]:
+    """ Returns (first texture path, first colour) of every material of the file, missing ones are None. """
+    definitions = {}
+    material_lines = None
     with open(mtl_file_path) as mtl_file:
-        material_data = mtl_file.read()
-
-    material_name_index = material_data.find(material_name + '\t')
-    if material_name_index == -1:
-        material_name_index = material_data.find(material_name + '\n')
-    if material_name_index == -1:
-        material_name_index = material_data.find(material_name + ' ')
-    if material_name_index == -1:
-        return None
-
-    material_data_crop = material_data[material_name_index:]
-
-    material_end_index = material_data_crop.find('newmtl')
-
-    found_material_data_lines = material_data_crop[:material_end_index].strip().split('\n')
-
-    for line in found_material_data_lines:
-        texture_path_string = get_texture_from_line(line)
-        if texture_path_string:
-            material_id = get_material_id_by_texture(config['material_texture_dictionary'], texture_path_string)
-            if not material_id:
-                print(f'Skipping unknown material: {material_name} with texture {texture_path_string}', file=sys.stderr)
-                return
-            return material_id
-
-    for line in found_material_data_lines:
-        color = get_color_from_line(line)
-        if color:
-            min_distance = None
-            chosen_id = None
-            for material_id, rgb in config['material_color_dictionary'].items():
-                distance = (color[0] - rgb[0]) ** 2 + (color[1] - rgb[1]) ** 2 + (color[2] - rgb[2]) ** 2
-                if min_distance is None or distance < min_distance:
-                    min_distance = distance
-                    chosen_id = material_id
-            return chosen_id
-
-
-def get_material_id_by_texture(texture_dictionary: dict, texture_path: str) -> str | None:
-    for material_pattern, material_id in texture_dictionary.items():
-        if material_pattern in texture_path:
-            return material_id
+        for line in mtl_file:
+            line = line.strip()
+            if line.startswith('newmtl'):
+                material_lines = definitions.setdefault(line[6:].strip(), [])
+            elif material_lines is not None:
+                material_lines.append(line)
+
+    return {name: (next(filter(None, map(get_texture_from_line, lines)), None),
+                   next(filter(None, map(get_color_from_line, lines)), None))
+            for name, lines in definitions.items()}
+
+
+def get_definition_key(material_name: str, definition: tuple) -> str:
+    texture_path, color = definition
+    return f'{material_name}|{texture_path}|{color}'
+
+
+class TextureMatcher:
+    """ Finds the first texture dictionary entry contained in a texture path with one precompiled pattern. """
+
+    def __init__(self, texture_dictionary: dict):
+        self.texture_dictionary = texture_dictionary
+        self.priorities = {material_pattern: i for i, material_pattern in enumerate(texture_dictionary)}
+        # Lookahead reports a match at every position, so no entry is hidden by an overlapping one
+        self.pattern = re.compile('(?=(' + '|'.join(map(re.escape, texture_dictionary)) + '))')
+
+    def get_material_id(self, texture_path: str) -> str | None:
+        found_patterns = {match.group(1) for match in self.pattern.finditer(texture_path)} & self.priorities.keys()
+        if found_patterns:
+            return self.texture_dictionary[min(found_patterns, key=self.priorities.__getitem__)]
+
+
+def get_nearest_color_ids(color_dictionary: dict, colors: np.array) -> List[str]:
+    """ Returns ids of the nearest dictionary colours for an (N, 3) colour array. """
+    material_ids = list(color_dictionary)
+    dictionary_colors = np.array([color_dictionary[material_id] for material_id in material_ids], dtype=np.float64)
+    distances = ((colors[:, np.newaxis] - dictionary_colors[np.newaxis]) ** 2).sum(axis=2)
+    return [material_ids[i] for i in distances.argmin(axis=1)]
 
 
 def get_material_sort_key(material_dictionary: dict):
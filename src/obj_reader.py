@@ -0,0 +1,47 @@
+from array import array
+from pathlib import Path
+from typing import Dict, Tuple
+
+import numpy as np
+
+
+def read_obj(obj_file_path: Path) -> Dict[str, Tuple[np.array, np.array]]:
+    """
+    Reads an .obj file in one pass into (vertices, faces) arrays of every material named by usemtl.
+
+    Faces are triangles, polygons are split into fans. Vertices are deduplicated once for all materials and every
+    material gets only the vertices its faces use. Faces before the first usemtl belong to the '' material.
+    """
+    vertices = array('d')
+    materials_faces: Dict[str, array] = {}
+    faces = materials_faces.setdefault('', array('q'))
+
+    with open(obj_file_path) as obj_file:
+        for line in obj_file:
+            if line.startswith('v '):
+                vertices.extend(map(float, line.split()[1:4]))
+            elif line.startswith('f '):
+                vertices_count = len(vertices) // 3
+                # Only vertex indices matter, texture and normal ones are cut off, negative indices count from the end
+                indices = [int(vertex.split('/', 1)[0]) for vertex in line.split()[1:]]
+                indices = [index - 1 if index > 0 else vertices_count + index for index in indices]
+                if len(indices) == 3:
+                    faces.extend(indices)
+                else:
+                    for i in range(1, len(indices) - 1):
+                        faces.extend((indices[0], indices[i], indices[i + 1]))
+            elif line.startswith('usemtl'):
+                faces = materials_faces.setdefault(line[6:].strip(), array('q'))
+
+    vertices = np.frombuffer(vertices, dtype=np.float64).reshape(-1, 3)
+    unique_vertices, vertex_indices = np.unique(vertices, axis=0, return_inverse=True)
+    vertex_indices = vertex_indices.reshape(-1)
+
+    meshes = {}
+    for material_name, faces in materials_faces.items():
+        if not faces:
+            continue
+        used_vertices, material_faces = np.unique(vertex_indices[np.frombuffer(faces, dtype=np.int64)],
+                                                  return_inverse=True)
+        meshes[material_name] = (unique_vertices[used_vertices], material_faces.reshape(-1, 3).astype(np.int32))
+    return meshes
@@ -0,0 +1,297 @@
+import math
+import struct
+import zlib
+from concurrent.futures import Executor
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from voxel_buffer import Palette, TerrainColumns, VoxelBuffer
+
+REGION_SIZE = 512
+CHUNK_SIZE = 16
+SECTION_VOLUME = CHUNK_SIZE ** 3
+SECTOR_SIZE = 4096
+MAX_CHUNK_SECTORS = 255
+DEFAULT_COMPRESSION_LEVEL = 6
+AIR = 'minecraft:air'
+BIOME = 'minecraft:plains'
+
+TAG_END = 0
+TAG_BYTE = 1
+TAG_INT = 3
+TAG_LONG = 4
+TAG_STRING = 8
+TAG_LIST = 9
+TAG_COMPOUND = 10
+TAG_LONG_ARRAY = 12
+
+
+def nbt_string(value: str) -> bytes:
+    encoded = value.encode('utf-8')
+    return struct.pack('>H', len(encoded)) + encoded
+
+
+def nbt_tag(tag_type: int, name: str, payload: bytes) -> bytes:
+    return bytes((tag_type,)) + nbt_string(name) + payload
+
+
+def nbt_compound(*tags: bytes) -> bytes:
+    return b''.join(tags) + bytes((TAG_END,))
+
+
+def nbt_list(item_type: int, payloads: list) -> bytes:
+    return bytes((item_type if payloads else TAG_END,)) + struct.pack('>i', len(payloads)) + b''.join(payloads)
+
+
+def nbt_long_array(array: np.array) -> bytes:
+    return struct.pack('>i', len(array)) + array.astype('>i8').tobytes()
+
+
+def get_block_name(block_id: str) -> str:
+    return block_id if ':' in block_id else f'minecraft:{block_id}'
+
+
+def pack_block_states(section_indices: np.array, palette_size: int) -> np.array:
+    """
+    Packs 4096 palette indices into the BlockStates long array, entries never span two longs.
+    """
+    bits = max((palette_size - 1).bit_length(), 4)
+    values_per_long = 64 // bits
+    longs_count = math.ceil(SECTION_VOLUME / values_per_long)
+
+    values = np.zeros(longs_count * values_per_long, dtype=np.uint64)
+    values[:SECTION_VOLUME] = section_indices
+    shifts = (np.arange(values_per_long, dtype=np.uint64) * np.uint64(bits))
+    packed = np.bitwise_or.reduce(values.reshape(longs_count, values_per_long) << shifts, axis=1)
+    return packed.view(np.int64)
+
+
+def encode_section(section_y: int, section_indices: np.array, block_names: list) -> bytes:
+    palette_indices = np.flatnonzero(np.bincount(section_indices, minlength=len(block_names)))
+    local_indices_lookup = np.zeros(len(block_names), dtype=np.uint16)
+    local_indices_lookup[palette_indices] = np.arange(len(palette_indices))
+    local_indices = local_indices_lookup[section_indices]
+    block_states = [nbt_tag(TAG_LIST, 'palette', nbt_list(TAG_COMPOUND, [
+        nbt_compound(nbt_tag(TAG_STRING, 'Name', nbt_string(block_names[index]))) for index in palette_indices]))]
+    if len(palette_indices) > 1:
+        block_states.append(nbt_tag(TAG_LONG_ARRAY, 'data',
+                                    nbt_long_array(pack_block_states(local_indices, len(palette_indices)))))
+
+    return nbt_compound(
+        nbt_tag(TAG_BYTE, 'Y', struct.pack('>b', section_y)),
+        nbt_tag(TAG_COMPOUND, 'block_states', nbt_compound(*block_states)),
+        nbt_tag(TAG_COMPOUND, 'biomes', nbt_compound(
+            nbt_tag(TAG_LIST, 'palette', nbt_list(TAG_STRING, [nbt_string(BIOME)])))))
+
+
+def encode_chunk(chunk_x: int, chunk_z: int, min_section_y: int, sections: list, data_version: int) -> bytes:
+    return nbt_tag(TAG_COMPOUND, '', nbt_compound(
+        nbt_tag(TAG_INT, 'DataVersion', struct.pack('>i', data_version)),
+        nbt_tag(TAG_INT, 'xPos', struct.pack('>i', chunk_x)),
+        nbt_tag(TAG_INT, 'zPos', struct.pack('>i', chunk_z)),
+        nbt_tag(TAG_INT, 'yPos', struct.pack('>i', min_section_y)),
+        nbt_tag(TAG_STRING, 'Status', nbt_string('minecraft:full')),
+        nbt_tag(TAG_LONG, 'LastUpdate', struct.pack('>q', 0)),
+        nbt_tag(TAG_LONG, 'InhabitedTime', struct.pack('>q', 0)),
+        # Light is not computed here, so the game relights the chunk on load
+        nbt_tag(TAG_BYTE, 'isLightOn', struct.pack('>b', 0)),
+        nbt_tag(TAG_LIST, 'sections', nbt_list(TAG_COMPOUND, sections)),
+        nbt_tag(TAG_LIST, 'block_entities', nbt_list(TAG_COMPOUND, [])),
+        nbt_tag(TAG_COMPOUND, 'Heightmaps', nbt_compound())))
+
+
+def get_block_names(*palettes: Palette) -> Tuple[list, list]:
+    """
+    Joins palettes into one list of block names with air, returns it with an index lookup array for every palette.
+    """
+    # Different ids may name the same block, like air and minecraft:air
+    palettes_block_names = [[get_block_name(block_id) for block_id in palette] for palette in palettes]
+    block_names = list(dict.fromkeys([name for names in palettes_block_names for name in names] + [AIR]))
+    return block_names, [np.array([block_names.index(name) for name in names], dtype=np.uint16)
+                         for names in palettes_block_names]
+
+
+def split_chunks(voxels: VoxelBuffer, indices_lookup: np.array, min_y: int) -> Dict[Tuple[int, int], tuple]:
+    """
+    Groups voxels of one region by chunk.
+
+    Returns (block_indices, palette_indices, section_indices) of every non-empty chunk by its position inside the
+    region. Block indices are positions inside 16x16x16 sections, palette indices are voxel indices translated with
+    indices_lookup and section indices count sections from min_y. Voxels must be deduplicated.
+    """
+    x, y, z = voxels.coordinates.T.astype(np.int64)
+    chunk_indices = (z % REGION_SIZE // CHUNK_SIZE) * (REGION_SIZE // CHUNK_SIZE) + x % REGION_SIZE // CHUNK_SIZE
+    section_indices = y // CHUNK_SIZE - min_y // CHUNK_SIZE
+    block_indices = (y % CHUNK_SIZE) * CHUNK_SIZE ** 2 + (z % CHUNK_SIZE) * CHUNK_SIZE + x % CHUNK_SIZE
+
+    order = np.lexsort((section_indices, chunk_indices))
+    chunk_indices, section_indices, block_indices = chunk_indices[order], section_indices[order], block_indices[order]
+    palette_indices = indices_lookup[voxels.indices[order]] if len(order) else voxels.indices
+    unique_chunks, starts = np.unique(chunk_indices, return_index=True)
+    stops = np.append(starts[1:], len(chunk_indices))
+
+    chunks = {}
+    for chunk_index, start, stop in zip(unique_chunks.tolist(), starts.tolist(), stops.tolist()):
+        local_z, local_x = divmod(chunk_index, REGION_SIZE // CHUNK_SIZE)
+        chunks[local_x, local_z] = (block_indices[start:stop], palette_indices[start:stop],
+                                    section_indices[start:stop])
+    return chunks
+
+
+def compress_chunk(args) -> Optional[bytes]:
+    """
+    Encodes one chunk into NBT and compresses it into the bytes of its region file entry, without sector padding.
+
+    Terrain sections are filled first and voxels are placed over them. Returns None for an empty chunk.
+    """
+    (chunk_x, chunk_z, chunk_voxels, terrain, terrain_indices_lookup,
+     block_names, min_y, max_y, data_version, compression_level) = args
+    air_index = block_names.index(AIR)
+    min_section_y, max_section_y = min_y // CHUNK_SIZE, max_y // CHUNK_SIZE
+
+    sections_blocks = {}
+    if terrain is not None:
+        chunk_heights = terrain.get_chunk_heights(chunk_x, chunk_z, CHUNK_SIZE)
+        generator = terrain.get_chunk_generator(chunk_x, chunk_z)
+        for section_y in range(max(terrain.min_y // CHUNK_SIZE, min_section_y),
+                               min(int(chunk_heights.max()) // CHUNK_SIZE, max_section_y) + 1):
+            section_blocks = np.full((CHUNK_SIZE,) * 3, air_index, dtype=np.uint16)
+            terrain.fill_section(section_blocks, section_y, chunk_heights, generator, terrain_indices_lookup)
+            sections_blocks[section_y] = section_blocks.reshape(-1)
+
+    if chunk_voxels is not None:
+        block_indices, palette_indices, section_indices = chunk_voxels
+        unique_sections, starts = np.unique(section_indices, return_index=True)
+        stops = np.append(starts[1:], len(section_indices))
+        for section_index, start, stop in zip(unique_sections.tolist(), starts.tolist(), stops.tolist()):
+            section_blocks = sections_blocks.setdefault(section_index + min_section_y,
+                                                        np.full(SECTION_VOLUME, air_index, dtype=np.uint16))
+            section_blocks[block_indices[start:stop]] = palette_indices[start:stop]
+
+    if not sections_blocks:
+        return None
+    sections = [encode_section(section_y, sections_blocks[section_y], block_names)
+                for section_y in sorted(sections_blocks)]
+
+    compressed_data = zlib.compress(encode_chunk(chunk_x, chunk_z, min_section_y, sections, data_version),
+                                    compression_level)
+    # 4 bytes of length and 1 byte of compression type, 2 is zlib
+    return struct.pack('>iB', len(compressed_data) + 1, 2) + compressed_data
+
+
+class RegionWriter:
+    """
+    Region file written progressively, compressed chunks are appended as they are given and the location header is
+    written on close, so finished chunks do not stay in memory. Chunks go to a temporary file which replaces the
+    region file only on close, a writer left by an exception removes it, so failed conversions leave no partial
+    regions.
+
+    Block names of the palette and the terrain are joined once, so all chunks share the order of section palettes.
+    Blocks missing from them are appended as they appear.
+    """
+
+    def __init__(self, path: Path, region_x: int, region_z: int, min_y: int, max_y: int, data_version: int,
+                 compression_level: int = DEFAULT_COMPRESSION_LEVEL, terrain: TerrainColumns = None,
+                 executor: Executor = None, palette: Palette = None):
+        self.region_x = region_x
+        self.region_z = region_z
+        self.min_y = min_y
+        self.max_y = max_y
+        self.data_version = data_version
+        self.compression_level = compression_level
+        self.terrain = terrain
+        self.executor = executor
+        self.block_names, (_, self.terrain_indices_lookup) = get_block_names(
+            palette if palette is not None else Palette(), terrain.palette if terrain is not None else Palette())
+
+        self.locations = bytearray(SECTOR_SIZE)
+        self.written_positions = set()
+        self.path = path
+        self.temporary_path = path.with_name(f'{path.name}.tmp')
+        self.region_file = open(self.temporary_path, 'wb')
+        self.region_file.write(bytes(2 * SECTOR_SIZE))  # Locations are written on close, timestamps stay empty
+
+    def get_indices_lookup(self, palette: Palette) -> np.array:
+        names = [get_block_name(block_id) for block_id in palette]
+        self.block_names.extend(name for name in dict.fromkeys(names) if name not in self.block_names)
+        return np.array([self.block_names.index(name) for name in names], dtype=np.uint16)
+
+    def write(self, voxels: VoxelBuffer, chunks_positions: List[Tuple[int, int]] = None) -> None:
+        """
+        Encodes, compresses and appends chunks at the given positions inside the region, by default the ones holding
+        voxels. Voxels must be deduplicated and inside these chunks, every chunk can be written once.
+        """
+        x, y, z = voxels.coordinates.T
+        if np.any(x // REGION_SIZE != self.region_x) or np.any(z // REGION_SIZE != self.region_z) or \
+                np.any(y < self.min_y) or np.any(y > self.max_y):
+            raise ValueError(f'Voxels are not inside region ({self.region_x}, {self.region_z})')
+
+        voxel_chunks = split_chunks(voxels, self.get_indices_lookup(voxels.palette), self.min_y)
+        if chunks_positions is None:
+            chunks_positions = sorted(voxel_chunks, key=lambda position: (position[1], position[0]))
+        if not voxel_chunks.keys() <= set(chunks_positions):
+            raise ValueError('Voxels are outside of the written chunks')
+        if self.written_positions.intersection(chunks_positions):
+            raise ValueError('Chunks can be written only once')
+        self.written_positions.update(chunks_positions)
+
+        chunks_per_region = REGION_SIZE // CHUNK_SIZE
+        arguments = [(self.region_x * chunks_per_region + local_x, self.region_z * chunks_per_region + local_z,
+                      voxel_chunks.get((local_x, local_z)), self.terrain, self.terrain_indices_lookup,
+                      self.block_names, self.min_y, self.max_y, self.data_version, self.compression_level)
+                     for local_x, local_z in chunks_positions]
+        chunks_bytes = self.executor.map(compress_chunk, arguments) if self.executor else \
+            map(compress_chunk, arguments)
+
+        for (local_x, local_z), chunk_bytes in zip(chunks_positions, chunks_bytes):
+            if chunk_bytes is not None:
+                self.write_chunk(local_x, local_z, chunk_bytes)
+
+    def write_chunk(self, local_x: int, local_z: int, chunk_bytes: bytes) -> None:
+        sectors_count = math.ceil(len(chunk_bytes) / SECTOR_SIZE)
+        if sectors_count > MAX_CHUNK_SECTORS:
+            raise ValueError(f'Chunk ({local_x}, {local_z}) is too large for a region file')
+
+        sector_offset = self.region_file.tell() // SECTOR_SIZE
+        location_index = 4 * (local_z * (REGION_SIZE // CHUNK_SIZE) + local_x)
+        self.locations[location_index:location_index + 4] = struct.pack('>I', sector_offset << 8 | sectors_count)
+
+        self.region_file.write(chunk_bytes + bytes(sectors_count * SECTOR_SIZE - len(chunk_bytes)))
+
+    def close(self) -> None:
+        self.region_file.seek(0)
+        self.region_file.write(self.locations)
+        self.region_file.close()
+        self.temporary_path.replace(self.path)
+
+    def discard(self) -> None:
+        self.region_file.close()
+        self.temporary_path.unlink(missing_ok=True)
+
+    def __enter__(self) -> 'RegionWriter':
+        return self
+
+    def __exit__(self, exc_type, *exc_info) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+
+def write_region(path: Path, region_x: int, region_z: int, voxels: VoxelBuffer, min_y: int, max_y: int,
+                 data_version: int, compression_level: int = DEFAULT_COMPRESSION_LEVEL, terrain: TerrainColumns = None,
+                 executor: Executor = None) -> None:
+    """
+    Encodes and compresses chunks on the given executor, then writes the region file.
+
+    Voxels are placed over the terrain. zlib and most of NumPy release the GIL, so a thread pool keeps all cores busy
+    without pickling the voxels. Without an executor chunks are compressed in the current thread.
+    """
+    with RegionWriter(path, region_x, region_z, min_y, max_y, data_version, compression_level, terrain, executor,
+                      voxels.palette) as writer:
+        chunks_per_region = REGION_SIZE // CHUNK_SIZE
+        writer.write(voxels, [(local_x, local_z) for local_z, local_x in np.ndindex(chunks_per_region,
+                                                                                    chunks_per_region)]
+                     if terrain is not None else None)
@@ -0,0 +1,159 @@
+import os
+import queue
+import threading
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, List, Tuple
+
+import numpy as np
+
+from transport import call_shared, open_shared, release_shared
+
+CHUNK_VOLUME = 1 << 20  # Summary bounding box volume of triangles in one task
+MAX_CHUNK_SIZE = 4096  # Maximum count of triangles in one task
+
+
+def get_workers_count(config: dict) -> int:
+    return config.get('workers') or os.cpu_count() or 1
+
+
+def create_executor(config: dict) -> ProcessPoolExecutor:
+    return ProcessPoolExecutor(max_workers=get_workers_count(config))
+
+
+def create_thread_executor(config: dict) -> ThreadPoolExecutor:
+    """ Pool for work that releases the GIL, like compression, where pickling the data would cost more. """
+    return ThreadPoolExecutor(max_workers=get_workers_count(config))
+
+
+def split_into_chunks(triangles: np.array, chunk_volume: int = CHUNK_VOLUME,
+                      max_chunk_size: int = MAX_CHUNK_SIZE) -> List[slice]:
+    """
+    Splits an (N, 3, 3) triangle array into consecutive chunks of roughly equal work.
+
+    Work of a triangle is estimated by the volume of its voxel bounding box, so a chunk holds either a lot of
+    small triangles or a few big ones.
+    """
+    if not len(triangles):
+        return []
+
+    volumes = np.prod(np.ceil(triangles.max(axis=1)) - np.floor(triangles.min(axis=1)) + 1, axis=1)
+    cumulative_volumes = np.cumsum(volumes)
+
+    chunks = []
+    start = 0
+    while start < len(triangles):
+        base_volume = cumulative_volumes[start - 1] if start else 0
+        stop = int(np.searchsorted(cumulative_volumes, base_volume + chunk_volume, side='right'))
+        stop = min(max(stop, start + 1), start + max_chunk_size, len(triangles))
+        chunks.append(slice(start, stop))
+        start = stop
+    return chunks
+
+
+class TaskScheduler:
+    """
+    Runs tasks of every granularity on one shared executor.
+
+    Callbacks are called in the submitting process as results arrive and may submit further tasks,
+    so material-level tasks can fan out into triangle chunks on the same queue.
+
+    With a transport directory, array results come back as memory-mapped files instead of pickles. They are mapped
+    and unlinked before the callback, unless keep_shared asks for the shared handle to pass it to further tasks.
+    """
+
+    def __init__(self, executor: Executor, transport_directory: Path = None):
+        self.executor = executor
+        self.transport_directory = transport_directory
+        self.pending: Dict[Future, Tuple[Callable, bool]] = {}
+
+    def submit(self, callback: Callable, function: Callable, *args, keep_shared: bool = False) -> None:
+        if self.transport_directory:
+            future = self.executor.submit(call_shared, function, self.transport_directory, *args)
+        else:
+            future = self.executor.submit(function, *args)
+        self.pending[future] = (callback, keep_shared)
+
+    def run(self) -> None:
+        while self.pending:
+            done, _ = wait(self.pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                callback, keep_shared = self.pending.pop(future)
+                result = future.result()
+                if not keep_shared:
+                    shared_result, result = result, open_shared(result)
+                    release_shared(shared_result)
+                callback(result)
+
+
+class Stage:
+    """ Step of a pipeline, function is called by up to workers threads at once. """
+    __slots__ = ('name', 'function', 'workers')
+
+    def __init__(self, name: str, function: Callable[[Any], Any], workers: int = 1):
+        self.name = name
+        self.function = function
+        self.workers = workers
+
+
+class Pipeline:
+    """
+    Passes items through a chain of stages, which run at the same time on different items.
+
+    Stages are connected by bounded queues, so a slow stage holds back the ones before it instead of letting
+    finished work pile up. While one item is voxelized, the next ones can already be downloaded and converted.
+    After an error no new items are started, the error is raised by run once running work is finished.
+    """
+    _DONE = object()
+
+    def __init__(self, stages: List[Stage], queue_size: int = 1):
+        self.stages = stages
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+        self.results: Dict[int, Any] = {}
+        self.errors: List[BaseException] = []
+        self.failed = threading.Event()
+
+    def run(self, items: Iterable) -> List:
+        """ Returns results of the last stage in the order of items. """
+        threads = [[threading.Thread(target=self.work, args=(stage_index,), name=f'{stage.name}-{i}', daemon=True)
+                    for i in range(stage.workers)] for stage_index, stage in enumerate(self.stages)]
+        for thread in sum(threads, []):
+            thread.start()
+
+        items_count = 0
+        for items_count, item in enumerate(items, 1):
+            if self.failed.is_set():
+                break
+            self.queues[0].put((items_count - 1, item))
+
+        for stage_index, stage_threads in enumerate(threads):
+            for _ in stage_threads:
+                self.queues[stage_index].put(self._DONE)
+            for thread in stage_threads:
+                thread.join()
+
+        if self.errors:
+            raise self.errors[0]
+        return [self.results[i] for i in range(items_count)]
+
+    def work(self, stage_index: int) -> None:
+        stage = self.stages[stage_index]
+        while True:
+            task = self.queues[stage_index].get()
+            if task is self._DONE:
+                return
+            if self.failed.is_set():
+                continue
+
+            index, item = task
+            try:
+                result = stage.function(item)
+            except BaseException as e:
+                self.errors.append(e)
+                self.failed.set()
+                continue
+
+            if stage_index + 1 < len(self.stages):
+                self.queues[stage_index + 1].put((index, result))
+            else:
+                self.results[index] = result
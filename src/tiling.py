@@ -0,0 +1,68 @@
+import math
+from typing import Iterator, List, Tuple
+
+import numpy as np
+
+from region_writer import CHUNK_SIZE
+
+TILE_MARGIN = 2  # Voxels around a tile whose triangles are given to it, at least the culling margin of voxelizers
+
+
+class TileGrid:
+    """
+    Square tiles of chunk columns covering voxel bounds of a region, heights are not split.
+
+    Bounds are inclusive voxel coordinates, tiles start at the min bound, which must be on a chunk border.
+    """
+
+    def __init__(self, min_bound: np.array, max_bound: np.array, tile_size: int):
+        if tile_size <= 0 or tile_size % CHUNK_SIZE:
+            raise ValueError(f'Tile size must be a positive multiple of {CHUNK_SIZE}')
+        self.min_bound = np.asarray(min_bound)
+        self.max_bound = np.asarray(max_bound)
+        self.tile_size = tile_size
+        self.columns_count = math.ceil((self.max_bound[0] - self.min_bound[0] + 1) / tile_size)
+        self.rows_count = math.ceil((self.max_bound[2] - self.min_bound[2] + 1) / tile_size)
+
+    def __len__(self):
+        return self.columns_count * self.rows_count
+
+    def __iter__(self) -> Iterator[Tuple[np.array, np.array]]:
+        """ Yields (min bound, max bound) of tiles, row by row. """
+        for row in range(self.rows_count):
+            for column in range(self.columns_count):
+                tile_min_bound = self.min_bound + np.array([column, 0, row]) * self.tile_size
+                tile_max_bound = np.minimum(tile_min_bound + np.array([1, 0, 1]) * (self.tile_size - 1), self.max_bound)
+                tile_max_bound[1] = self.max_bound[1]
+                yield tile_min_bound, tile_max_bound
+
+    def get_chunks_positions(self, tile_min_bound: np.array, tile_max_bound: np.array) -> List[Tuple[int, int]]:
+        """ Returns (x, z) of chunks of the tile counted from the min bound of the grid, row by row. """
+        first_x, _, first_z = (tile_min_bound - self.min_bound).astype(int) // CHUNK_SIZE
+        last_x, _, last_z = (tile_max_bound - self.min_bound).astype(int) // CHUNK_SIZE
+        return [(chunk_x, chunk_z) for chunk_z in range(first_z, last_z + 1) for chunk_x in range(first_x, last_x + 1)]
+
+    def index(self, lower: np.array, upper: np.array) -> List[np.array]:
+        """
+        Returns indices of boxes overlapping every tile extended by the margin, boxes are given by (N, 3) arrays of
+        their lower and upper corners. Boxes outside of the grid belong to no tile, indices keep their order.
+        """
+        axes = [0, 2]
+        counts = np.array([self.columns_count, self.rows_count])
+        first = np.floor((lower[:, axes] - TILE_MARGIN - self.min_bound[axes]) / self.tile_size).astype(np.int64)
+        last = np.floor((upper[:, axes] + TILE_MARGIN - self.min_bound[axes]) / self.tile_size).astype(np.int64)
+        inside = np.all((last >= 0) & (first < counts), axis=1)
+        box_indices = np.flatnonzero(inside)
+        first, last = np.maximum(first[inside], 0), np.minimum(last[inside], counts - 1)
+
+        # Every box is repeated for each tile of its rectangle
+        spans = last - first + 1
+        tiles_counts = spans.prod(axis=1)
+        repeated_boxes = np.repeat(np.arange(len(box_indices)), tiles_counts)
+        offsets = np.arange(len(repeated_boxes)) - np.repeat(np.cumsum(tiles_counts) - tiles_counts, tiles_counts)
+        columns = first[repeated_boxes, 0] + offsets % spans[repeated_boxes, 0]
+        rows = first[repeated_boxes, 1] + offsets // spans[repeated_boxes, 0]
+
+        tiles = rows * self.columns_count + columns
+        order = np.argsort(tiles, kind='stable')
+        return np.split(box_indices[repeated_boxes[order]], np.cumsum(np.bincount(tiles, minlength=len(self)))[:-1])
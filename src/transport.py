@@ -0,0 +1,105 @@
+import os
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+from voxel_buffer import Palette, VoxelBuffer
+
+
+class SharedArray:
+    """
+    NumPy array stored in a memory-mapped temporary file.
+
+    Only the path is pickled, so passing it between processes costs nothing and opening it maps the data
+    without copying.
+    """
+    __slots__ = ('path',)
+
+    def __init__(self, path: str):
+        self.path = path
+
+    @classmethod
+    def create(cls, array: np.array, directory: Path) -> 'SharedArray':
+        file_descriptor, path = tempfile.mkstemp(suffix='.npy', dir=directory)
+        with os.fdopen(file_descriptor, 'wb') as shared_file:
+            np.save(shared_file, np.ascontiguousarray(array))
+        return cls(path)
+
+    def open(self) -> np.array:
+        return np.load(self.path, mmap_mode='r')
+
+    def release(self) -> None:
+        # Already opened mappings stay valid, the space is freed when they are gone
+        Path(self.path).unlink(missing_ok=True)
+
+
+class SharedSlice:
+    """ Part of a shared array, lets tasks get their chunk of a once shared array. """
+    __slots__ = ('array', 'index')
+
+    def __init__(self, array: SharedArray, index):
+        self.array = array
+        self.index = index
+
+    def open(self) -> np.array:
+        return self.array.open()[self.index]
+
+    def release(self) -> None:
+        pass
+
+
+class SharedVoxelBuffer:
+    __slots__ = ('coordinates', 'indices', 'block_ids')
+
+    def __init__(self, coordinates: SharedArray, indices: SharedArray, block_ids: list):
+        self.coordinates = coordinates
+        self.indices = indices
+        self.block_ids = block_ids
+
+    @classmethod
+    def create(cls, buffer: VoxelBuffer, directory: Path) -> 'SharedVoxelBuffer':
+        return cls(SharedArray.create(buffer.coordinates, directory), SharedArray.create(buffer.indices, directory),
+                   list(buffer.palette))
+
+    def open(self) -> VoxelBuffer:
+        return VoxelBuffer(Palette(self.block_ids), self.coordinates.open(), self.indices.open())
+
+    def release(self) -> None:
+        self.coordinates.release()
+        self.indices.release()
+
+
+SHARED_TYPES = (SharedArray, SharedSlice, SharedVoxelBuffer)
+
+
+def share(value, directory: Path):
+    if isinstance(value, np.ndarray):
+        return SharedArray.create(value, directory)
+    if isinstance(value, VoxelBuffer):
+        return SharedVoxelBuffer.create(value, directory)
+    return value
+
+
+def open_shared(value):
+    if isinstance(value, SHARED_TYPES):
+        return value.open()
+    if isinstance(value, tuple):
+        return tuple(open_shared(item) for item in value)
+    return value
+
+
+def release_shared(value) -> None:
+    if isinstance(value, SHARED_TYPES):
+        value.release()
+
+
+def slice_shared(value, index):
+    if isinstance(value, SharedArray):
+        return SharedSlice(value, index)
+    return value[index]
+
+
+def call_shared(function, directory: Path, *args):
+    """ Runs function on opened shared arguments and returns its result shared through the directory. """
+    return share(function(*open_shared(args)), directory)
@@ -3,6 +3,7 @@ import numpy as np
 EPS = 1e-5
 INSIDE = 0
 OUTSIDE = 1
+DIAGONALS = np.array([[1, 1, 1], [1, 1, -1], [1, -1, 1], [-1, 1, 1]])
 
 class Point3:
     def __init__(self, x, y, z):
@@ -31,7 +32,7 @@ def sub(a, b):
     return a - b
 
 def lerp(alpha, a, b):
-    return b + alpha * (a - b)
+    return a + alpha * (b - a)
 
 def min3(a, b, c):
     return min(a, b, c)
@@ -99,7 +100,8 @@ def point_triangle_intersection(p, t):
     v1, v2, v3 = t.v1.as_array(), t.v2.as_array(), t.v3.as_array()
     p = p.as_array()
 
-    if np.any(p > np.maximum.reduce([v1, v2, v3])) or np.any(p < np.minimum.reduce([v1, v2, v3])):
+    # Points on axis-aligned triangles may round past their bbox, so it is widened like the other tests
+    if np.any(p > np.maximum.reduce([v1, v2, v3]) + EPS) or np.any(p < np.minimum.reduce([v1, v2, v3]) - EPS):
         return OUTSIDE
 
     vect12 = sub(v1, v2)
@@ -143,20 +145,148 @@ def t_c_intersection(t):
         return False
 
     edges = [
-        (t.v1, t.v2, v1_test | v2_test),
-        (t.v1, t.v3, v1_test | v3_test),
-        (t.v2, t.v3, v2_test | v3_test)
+        (t.v1, t.v2, v1_test, v2_test),
+        (t.v1, t.v3, v1_test, v3_test),
+        (t.v2, t.v3, v2_test, v3_test)
     ]
 
-    for p1, p2, outcode_diff in edges:
-        if not (v1_test & v2_test) and check_line(p1, p2, outcode_diff) == INSIDE:
+    for p1, p2, p1_test, p2_test in edges:
+        if not (p1_test & p2_test) and check_line(p1, p2, p1_test | p2_test) == INSIDE:
             return True
 
     norm = cross(sub(t.v1.as_array(), t.v2.as_array()), sub(t.v1.as_array(), t.v3.as_array()))
     d = np.dot(norm, t.v1.as_array())
 
-    for denom, point in [(norm.sum(), Point3(d / denom, d / denom, d / denom)) for denom in [norm.sum(), norm.sum() - 2 * norm[2], norm.sum() - 2 * norm[1], norm.sum() - 2 * norm[0]]]:
-        if abs(denom) > EPS and abs(point.x) <= 0.5 and point_triangle_intersection(point, t) == INSIDE:
-            return True
+    # Intersections of the triangle plane with the four cube diagonals
+    for diagonal in DIAGONALS:
+        denom = np.dot(norm, diagonal)
+        if abs(denom) > EPS:
+            point = Point3(*(diagonal * (d / denom)))
+            if abs(point.x) <= 0.5 and point_triangle_intersection(point, t) == INSIDE:
+                return True
 
     return False
+
+
+BATCH_SIZE = 1 << 16
+
+
+def face_plane_batch(p):
+    x, y, z = p[..., 0], p[..., 1], p[..., 2]
+    return ((x > 0.5) * 0x01 | (x < -0.5) * 0x02 |
+            (y > 0.5) * 0x04 | (y < -0.5) * 0x08 |
+            (z > 0.5) * 0x10 | (z < -0.5) * 0x20).astype(np.int64)
+
+def bevel_2d_batch(p):
+    x, y, z = p[..., 0], p[..., 1], p[..., 2]
+    return ((x + y > 1.0) * 0x001 | (x - y > 1.0) * 0x002 |
+            (-x + y > 1.0) * 0x004 | (-x - y > 1.0) * 0x008 |
+            (x + z > 1.0) * 0x010 | (x - z > 1.0) * 0x020 |
+            (-x + z > 1.0) * 0x040 | (-x - z > 1.0) * 0x080 |
+            (y + z > 1.0) * 0x100 | (y - z > 1.0) * 0x200 |
+            (-y + z > 1.0) * 0x400 | (-y - z > 1.0) * 0x800).astype(np.int64)
+
+def bevel_3d_batch(p):
+    x, y, z = p[..., 0], p[..., 1], p[..., 2]
+    return ((x + y + z > 1.5) * 0x01 | (x + y - z > 1.5) * 0x02 |
+            (x - y + z > 1.5) * 0x04 | (x - y - z > 1.5) * 0x08 |
+            (-x + y + z > 1.5) * 0x10 | (-x + y - z > 1.5) * 0x20 |
+            (-x - y + z > 1.5) * 0x40 | (-x - y - z > 1.5) * 0x80).astype(np.int64)
+
+def check_line_batch(p1, p2, outcode_diff):
+    result = np.zeros(len(p1), dtype=bool)
+    for axis, (mask, plane, face_mask) in ((0, (0x01, 0.5, 0x3e)), (0, (0x02, -0.5, 0x3d)),
+                                          (1, (0x04, 0.5, 0x3b)), (1, (0x08, -0.5, 0x37)),
+                                          (2, (0x10, 0.5, 0x2f)), (2, (0x20, -0.5, 0x1f))):
+        alpha = (plane - p1[:, axis]) / (p2[:, axis] - p1[:, axis])
+        plane_point = lerp(alpha[:, None], p1, p2)
+        result |= ((outcode_diff & mask) != 0) & ((face_plane_batch(plane_point) & face_mask) == INSIDE)
+    return result
+
+def sign3_batch(vec):
+    return ((vec[:, 0] < EPS) * 4 | (vec[:, 1] < EPS) * 2 | (vec[:, 2] < EPS) * 1 |
+            (vec[:, 0] > -EPS) * 32 | (vec[:, 1] > -EPS) * 16 | (vec[:, 2] > -EPS) * 8)
+
+def point_triangle_intersection_batch(p, v1, v2, v3):
+    outside = np.any(p > np.maximum(np.maximum(v1, v2), v3) + EPS, axis=1) | \
+        np.any(p < np.minimum(np.minimum(v1, v2), v3) - EPS, axis=1)
+
+    sign12 = sign3_batch(cross(sub(v1, v2), sub(v1, p)))
+    sign23 = sign3_batch(cross(sub(v2, v3), sub(v2, p)))
+    sign31 = sign3_batch(cross(sub(v3, v1), sub(v3, p)))
+
+    return ~outside & ((sign12 & sign23 & sign31) != 0)
+
+def t_c_intersection_array(t):
+    """ Vectorized t_c_intersection over a (K, 3, 3) array of triangles given relative to the cube center. """
+    v1, v2, v3 = t[:, 0], t[:, 1], t[:, 2]
+
+    v1_test = face_plane_batch(v1)
+    v2_test = face_plane_batch(v2)
+    v3_test = face_plane_batch(v3)
+
+    result = (v1_test == INSIDE) | (v2_test == INSIDE) | (v3_test == INSIDE)
+
+    # Only triangles surviving the cheap trivial tests go further, most of the pairs end here
+    remaining = np.flatnonzero(~result & ((v1_test & v2_test & v3_test) == 0))
+    v1, v2, v3 = v1[remaining], v2[remaining], v3[remaining]
+    v1_test, v2_test, v3_test = v1_test[remaining], v2_test[remaining], v3_test[remaining]
+
+    v1_test |= (bevel_2d_batch(v1) << 8) | (bevel_3d_batch(v1) << 24)
+    v2_test |= (bevel_2d_batch(v2) << 8) | (bevel_3d_batch(v2) << 24)
+    v3_test |= (bevel_2d_batch(v3) << 8) | (bevel_3d_batch(v3) << 24)
+
+    # The outcode bit groups do not overlap, so a single test covers both bevel rejection stages
+    not_rejected = (v1_test & v2_test & v3_test) == 0
+    remaining = remaining[not_rejected]
+    v1, v2, v3 = v1[not_rejected], v2[not_rejected], v3[not_rejected]
+    v1_test, v2_test, v3_test = v1_test[not_rejected], v2_test[not_rejected], v3_test[not_rejected]
+
+    hit = ((v1_test & v2_test) == 0) & check_line_batch(v1, v2, v1_test | v2_test)
+    hit |= ((v1_test & v3_test) == 0) & check_line_batch(v1, v3, v1_test | v3_test)
+    hit |= ((v2_test & v3_test) == 0) & check_line_batch(v2, v3, v2_test | v3_test)
+
+    norm = cross(sub(v1, v2), sub(v1, v3))
+    d = norm[:, 0] * v1[:, 0] + norm[:, 1] * v1[:, 1] + norm[:, 2] * v1[:, 2]
+
+    for diagonal in DIAGONALS:
+        denom = norm[:, 0] * diagonal[0] + norm[:, 1] * diagonal[1] + norm[:, 2] * diagonal[2]
+        point = diagonal * (d / denom)[:, None]
+        hit |= (np.abs(denom) > EPS) & (np.abs(point[:, 0]) <= 0.5) & \
+            point_triangle_intersection_batch(point, v1, v2, v3)
+
+    result[remaining] = hit
+    return result
+
+def t_c_intersection_pairs(triangles, voxels):
+    """
+    Tests the i-th triangle of a (K, 3, 3) array against the unit cube centered at the i-th voxel of a (K, 3) array.
+    """
+    triangles = np.asarray(triangles, dtype=np.float64)
+    voxels = np.asarray(voxels)
+
+    result = np.empty(len(triangles), dtype=bool)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for start in range(0, len(triangles), BATCH_SIZE):
+            stop = start + BATCH_SIZE
+            result[start:stop] = t_c_intersection_array(triangles[start:stop] - voxels[start:stop, None, :])
+    return result
+
+def t_c_intersection_batch(triangles, voxels):
+    """
+    Tests every triangle of an (N, 3, 3) array against every unit cube centered at an (M, 3) array of voxels.
+
+    Returns an (N, M) boolean mask, equal to calling t_c_intersection for each pair.
+    """
+    triangles = np.asarray(triangles, dtype=np.float64)
+    voxels = np.asarray(voxels)
+
+    pairs_count = len(triangles) * len(voxels)
+    result = np.empty(pairs_count, dtype=bool)
+
+    for start in range(0, pairs_count, BATCH_SIZE):
+        pair_indices = np.arange(start, min(start + BATCH_SIZE, pairs_count))
+        triangle_indices, voxel_indices = np.divmod(pair_indices, len(voxels))
+        result[pair_indices] = t_c_intersection_pairs(triangles[triangle_indices], voxels[voxel_indices])
+
+    return result.reshape(len(triangles), len(voxels))
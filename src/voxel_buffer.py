@@ -0,0 +1,187 @@
+from typing import Iterable, List, Tuple
+
+import numpy as np
+
+
+class Palette:
+    """
+    Ordered set of block ids, voxel buffers store indices into it instead of block objects.
+    """
+
+    def __init__(self, block_ids: Iterable[str] = ()):
+        self.block_ids: List[str] = []
+        self.indices = {}
+        for block_id in block_ids:
+            self.index(block_id)
+
+    def index(self, block_id: str) -> int:
+        index = self.indices.get(block_id)
+        if index is None:
+            index = len(self.block_ids)
+            if index > np.iinfo(np.uint16).max:
+                raise OverflowError('Palette can not hold more than 65536 blocks')
+            self.block_ids.append(block_id)
+            self.indices[block_id] = index
+        return index
+
+    def __getitem__(self, index: int) -> str:
+        return self.block_ids[index]
+
+    def __iter__(self):
+        return iter(self.block_ids)
+
+    def __len__(self):
+        return len(self.block_ids)
+
+
+class VoxelBuffer:
+    """
+    Array-backed list of voxels.
+
+    Attributes
+    ----------
+    coordinates: (N, 3) int32 array of x, y, z
+    indices: (N,) uint16 array of palette indices
+    palette: :class:`Palette`, may be shared between buffers
+    """
+    __slots__ = ('coordinates', 'indices', 'palette')
+
+    def __init__(self, palette: Palette = None, coordinates: np.array = None, indices: np.array = None):
+        self.palette = palette if palette is not None else Palette()
+        self.coordinates = np.empty((0, 3), dtype=np.int32) if coordinates is None else \
+            np.asarray(coordinates, dtype=np.int32).reshape(-1, 3)
+        self.indices = np.empty(0, dtype=np.uint16) if indices is None else np.asarray(indices, dtype=np.uint16)
+
+    @classmethod
+    def from_coordinates(cls, coordinates: np.array, block_id: str, palette: Palette = None) -> 'VoxelBuffer':
+        buffer = cls(palette)
+        buffer.append(coordinates, block_id)
+        return buffer
+
+    @classmethod
+    def from_parts(cls, parts: Iterable[Tuple[np.array, str]], palette: Palette = None) -> 'VoxelBuffer':
+        """ Builds a buffer of (coordinates, block id) parts in order, joining their arrays once at the end. """
+        buffer = cls(palette)
+        coordinates = []
+        indices = []
+        for part_coordinates, block_id in parts:
+            part_coordinates = np.asarray(part_coordinates, dtype=np.int32).reshape(-1, 3)
+            coordinates.append(part_coordinates)
+            indices.append(np.full(len(part_coordinates), buffer.palette.index(block_id), dtype=np.uint16))
+        if coordinates:
+            buffer.coordinates = np.concatenate(coordinates)
+            buffer.indices = np.concatenate(indices)
+        return buffer
+
+    def __len__(self):
+        return len(self.coordinates)
+
+    def append(self, coordinates: np.array, block_id: str) -> None:
+        coordinates = np.asarray(coordinates, dtype=np.int32).reshape(-1, 3)
+        self.coordinates = np.concatenate((self.coordinates, coordinates))
+        self.indices = np.concatenate((self.indices, np.full(len(coordinates), self.palette.index(block_id),
+                                                             dtype=np.uint16)))
+
+    def block_ids(self) -> np.array:
+        """ Returns block id of every voxel as an object array. """
+        return np.array(self.palette.block_ids, dtype=object)[self.indices]
+
+    def mask(self, block_ids: Iterable[str]) -> np.array:
+        """ Returns a mask of voxels made of any of the given blocks. """
+        indices = [self.palette.indices[block_id] for block_id in block_ids if block_id in self.palette.indices]
+        return np.isin(self.indices, indices)
+
+    def select(self, mask: np.array) -> 'VoxelBuffer':
+        return VoxelBuffer(self.palette, self.coordinates[mask], self.indices[mask])
+
+    def clip(self, min_bound: np.array, max_bound: np.array) -> 'VoxelBuffer':
+        """ Returns voxels inside the box, both bounds are inclusive. """
+        return self.select(np.all(self.coordinates >= min_bound, axis=1) & np.all(self.coordinates <= max_bound, axis=1))
+
+    def dedupe(self) -> 'VoxelBuffer':
+        """ Returns one voxel per coordinate, the last one wins as if the voxels were placed in order. """
+        if not len(self):
+            return self
+        _, reversed_first = np.unique(self.coordinates[::-1], axis=0, return_index=True)
+        return self.select(np.sort(len(self) - 1 - reversed_first))
+
+    @staticmethod
+    def concatenate(buffers: Iterable['VoxelBuffer'], palette: Palette = None) -> 'VoxelBuffer':
+        """ Joins buffers in order into one buffer on the given palette, indices are remapped where needed. """
+        buffers = [buffer for buffer in buffers if buffer is not None]
+        if palette is None:
+            palette = buffers[0].palette if buffers else Palette()
+
+        indices = []
+        for buffer in buffers:
+            if buffer.palette is palette:
+                indices.append(buffer.indices)
+            else:
+                remap = np.array([palette.index(block_id) for block_id in buffer.palette], dtype=np.uint16)
+                indices.append(remap[buffer.indices] if len(remap) else buffer.indices)
+
+        if not buffers:
+            return VoxelBuffer(palette)
+        return VoxelBuffer(palette, np.concatenate([buffer.coordinates for buffer in buffers]), np.concatenate(indices))
+
+
+class TerrainColumns:
+    """
+    Terrain stored as columns instead of voxels, so it costs memory proportional to the area only.
+
+    Every column has the bottom block at min_y, filler blocks above it and the cover block at its height.
+    Blocks are expanded section by section when they are needed, filler is drawn from a generator seeded with the
+    seed and the chunk, so the same terrain is produced in any order and between runs.
+
+    Attributes
+    ----------
+    heights: (Z, X) int32 array of column heights, columns below min_y are empty
+    min_x, min_z: world coordinates of the first column
+    palette: :class:`Palette` of the bottom block, the cover block and the filler blocks
+    bottom_index, cover_index: palette indices of the bottom and the cover block
+    filler_indices: palette index of every filler block, repeated blocks are drawn more often
+    """
+    __slots__ = ('heights', 'min_x', 'min_z', 'min_y', 'palette', 'bottom_index', 'cover_index', 'filler_indices',
+                 'seed')
+
+    def __init__(self, heights: np.array, min_x: int, min_z: int, min_y: int, cover_block: str, bottom_block: str,
+                 filler_blocks: List[str], seed: int = 0):
+        self.heights = np.asarray(heights, dtype=np.int32)
+        self.min_x = min_x
+        self.min_z = min_z
+        self.min_y = min_y
+        self.palette = Palette()
+        self.bottom_index = self.palette.index(bottom_block)
+        self.cover_index = self.palette.index(cover_block)
+        self.filler_indices = np.array([self.palette.index(block) for block in filler_blocks], dtype=np.uint16)
+        self.seed = seed
+
+    def get_chunk_heights(self, chunk_x: int, chunk_z: int, chunk_size: int = 16) -> np.array:
+        """ Returns (chunk_size, chunk_size) heights of a chunk in z, x order, min_y - 1 where there is no terrain. """
+        chunk_heights = np.full((chunk_size, chunk_size), self.min_y - 1, dtype=np.int32)
+        start_z, start_x = chunk_z * chunk_size - self.min_z, chunk_x * chunk_size - self.min_x
+        source = self.heights[max(start_z, 0):max(start_z + chunk_size, 0), max(start_x, 0):max(start_x + chunk_size, 0)]
+        chunk_heights[max(-start_z, 0):max(-start_z, 0) + source.shape[0],
+                      max(-start_x, 0):max(-start_x, 0) + source.shape[1]] = source
+        return chunk_heights
+
+    def get_blocks(self) -> List[str]:
+        """ Returns the bottom block, the cover block and the filler blocks as they were given. """
+        return [self.palette[index] for index in (self.bottom_index, self.cover_index, *self.filler_indices)]
+
+    def get_chunk_generator(self, chunk_x: int, chunk_z: int) -> np.random.Generator:
+        return np.random.default_rng((self.seed, chunk_x % (1 << 32), chunk_z % (1 << 32)))
+
+    def fill_section(self, section: np.array, section_y: int, chunk_heights: np.array, generator: np.random.Generator,
+                     indices_lookup: np.array) -> None:
+        """
+        Writes terrain of one section into a (size, size, size) y, z, x array of indices.
+
+        Indices of the terrain palette are translated with indices_lookup, cells above the terrain are not touched.
+        """
+        size = section.shape[0]
+        y = (section_y * size + np.arange(size, dtype=np.int32))[:, None, None]
+        fillers = self.filler_indices[generator.integers(len(self.filler_indices), size=section.shape)]
+        blocks = np.where(y == chunk_heights, self.cover_index, np.where(y == self.min_y, self.bottom_index, fillers))
+        terrain = (y >= self.min_y) & (y <= chunk_heights)
+        section[terrain] = indices_lookup[blocks[terrain]]
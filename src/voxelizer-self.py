@@ -1,150 +1,151 @@
-from typing import List
-
-from pathlib import Path
+from concurrent.futures import Executor
 
 import numpy as np
+from tqdm import tqdm
 
-#import open3d as o3d
-import trimesh
+from clipping import clip_triangles
+from scheduler import split_into_chunks
+from triangle_cube_intersection import EPS, t_c_intersection_batch, t_c_intersection_pairs
+from voxel_buffer import Palette, VoxelBuffer
 
-from random import choice
-from math import sqrt
+PLANAR_MARGIN = 1e-4
+CLIP_MARGIN = 1  # Voxels around the bounds kept by clipping, so voxels on the border are tested with whole triangles
 
-from concurrent.futures import ProcessPoolExecutor
 
-from tqdm import tqdm
+def voxelize_mesh(vertices: np.array, faces: np.array, min_bound: np.array, max_bound: np.array, offset: np.array,
+                  block_id: str, palette: Palette = None, progress: bool = False,
+                  executor: Executor = None) -> VoxelBuffer:
+    triangles = get_triangles(vertices, faces, min_bound, max_bound)
+    return get_region_voxels(voxelize(triangles, min_bound, max_bound, progress=progress, executor=executor),
+                             min_bound, max_bound, offset, block_id, palette)
 
-from triangle_cube_intersection import Point3, Triangle3, t_c_intersection
 
+def get_triangles(vertices: np.array, faces: np.array, min_bound: np.array, max_bound: np.array) -> np.array:
+    """ Returns (N, 3, 3) triangles of the mesh clipped to the bounds, triangles outside of them are dropped. """
+    triangles = np.asarray(vertices, dtype=np.float64)[np.asarray(faces)]
+    mesh_min_bound, mesh_max_bound = get_mesh_bounds(min_bound, max_bound)
+    return clip_triangles(triangles, mesh_min_bound - CLIP_MARGIN, mesh_max_bound + CLIP_MARGIN)
+
+
+def get_mesh_bounds(min_bound: np.array, max_bound: np.array) -> tuple:
+    # Bounds are in region axes, get_region_voxels swaps x and z of mesh voxels into them
+    return np.asarray(min_bound)[..., [2, 1, 0]], np.asarray(max_bound)[..., [2, 1, 0]]
+
+
+def get_region_axes(coordinates: np.array) -> np.array:
+    # Mesh voxels get x and z swapped by get_region_voxels
+    return np.asarray(coordinates)[..., [2, 1, 0]]
+
+
+def get_grid_origin(vertices: np.array) -> np.array:
+    # Voxels are on integer coordinates wherever the mesh is
+    return np.zeros(3)
+
+
+def get_region_voxels(voxels: np.array, min_bound: np.array, max_bound: np.array, offset: np.array, block_id: str,
+                      palette: Palette = None) -> VoxelBuffer:
+    voxel_coordinates = np.array(voxels).reshape(-1, 3)
+    voxel_coordinates[:, [0, 2]] = voxel_coordinates[:, [2, 0]]
+    voxel_coordinates = voxel_coordinates[np.all((voxel_coordinates >= min_bound) & (voxel_coordinates <= max_bound),
+                                                 axis=1)]
+    return VoxelBuffer.from_coordinates(np.round(voxel_coordinates + offset), block_id, palette)
 
-def voxelize_mesh(mesh_path: Path, min_bound: np.array, max_bound: np.array, offset: np.array, progress: bool = False) -> List[tuple]:
-    #mesh = o3d.io.read_triangle_mesh(str(mesh_path))
-    mesh = trimesh.load(mesh_path)
-    
-    if isinstance(mesh, trimesh.Scene):
-        mesh = mesh.to_mesh()
-    
-    #voxelized_mesh = o3d.geometry.VoxelGrid.create_from_triangle_mesh(mesh, voxel_size=1)
-
-    voxels = []
-    in_region_coordinates_translator = np.array([1,1,-1])
-    '''
-    half_corrector = 0 if float(voxelized_mesh.get_voxel_center_coordinate(voxelized_mesh.get_voxels()[0].grid_index)[0]) % 1 < 0.5 else 0.5
-    for voxel in voxelized_mesh.get_voxels():
-        voxel_coordinates = np.int32((voxelized_mesh.get_voxel_center_coordinate(voxel.grid_index) - half_corrector)
-                                   * in_region_coordinates_translator)
-                                   '''
-    triangles = [[mesh.vertices[triangle[0]], mesh.vertices[triangle[1]], mesh.vertices[triangle[2]]] for triangle in mesh.faces]
-    
-    
-    
-    for voxel in voxelize(triangles, min_bound, max_bound, progress=progress):
-        voxel_coordinates = np.array(voxel)
-        voxel_coordinates[0], voxel_coordinates[2] = voxel_coordinates[2], voxel_coordinates[0]
-        if np.all(voxel_coordinates >= min_bound) and np.all(voxel_coordinates <= max_bound):
-            voxels.append(tuple(map(round, voxel_coordinates + offset)))
-    
-    return voxels
 
+def voxelize(triangles: np.array, min_bound: np.array, max_bound: np.array, progress: bool = False,
+             executor: Executor = None) -> np.array:
+    """
+    Voxelizes an (N, 3, 3) triangle array in chunks of similar work.
+
+    Chunks are submitted to the given shared executor, without one they are voxelized in the current process,
+    so calling this from a pool worker never starts a nested pool.
+    """
+    chunks = split_into_chunks(triangles)
+    arguments = ((triangles[chunk], min_bound, max_bound) for chunk in chunks)
+    voxel_arrays = executor.map(voxelize_chunk, arguments) if executor else map(voxelize_chunk, arguments)
+    if progress:
+        voxel_arrays = tqdm(voxel_arrays, total=len(chunks))
+
+    voxel_arrays = list(voxel_arrays)
+    if not voxel_arrays:
+        return np.empty((0, 3), dtype=np.int32)
+    return np.unique(np.concatenate(voxel_arrays), axis=0)
+
+
+def voxelize_chunk(args) -> np.array:
+    triangles, min_bound, max_bound = args
+    triangles = np.asarray(triangles, dtype=np.float64)
+
+    candidates = [get_triangle_candidates(triangle) for triangle in triangles]
+    counts = [len(triangle_candidates) for triangle_candidates in candidates]
+    if not sum(counts):
+        return np.empty((0, 3), dtype=np.int32)
+
+    candidates = np.concatenate(candidates)
+    triangle_indices = np.repeat(np.arange(len(triangles)), counts)
+    inside = get_inside_mask(candidates, min_bound, max_bound)
+    candidates, triangle_indices = candidates[inside], triangle_indices[inside]
+
+    intersections = t_c_intersection_pairs(triangles[triangle_indices], candidates)
+    return np.unique(candidates[intersections], axis=0)
 
-def voxelize(triangles: List, min_bound: np.array, max_bound: np.array, progress: bool = False) -> set:
-    voxels = set()
-    with ProcessPoolExecutor() as executor:
-        for voxel_set in tqdm(executor.map(voxelize_triangle, ((triangle, min_bound, max_bound) for triangle in triangles)), total=len(triangles)) \
-            if progress else executor.map(voxelize_triangle, ((triangle, min_bound, max_bound) for triangle in triangles)):
-            voxels.update(voxel_set)
-    return voxels
 
 def voxelize_triangle(args):
     triangle, min_bound, max_bound = args
-    voxels = set()
+    triangle = np.asarray(triangle, dtype=np.float64)
+
+    grid = get_triangle_candidates(triangle)
+    grid = grid[get_inside_mask(grid, min_bound, max_bound)]
+    intersections = t_c_intersection_batch(np.array([triangle]), grid)[0]
+    return set(map(tuple, grid[intersections].tolist()))
+
+
+def get_inside_mask(voxels: np.array, min_bound: np.array, max_bound: np.array) -> np.array:
+    mesh_min_bound, mesh_max_bound = get_mesh_bounds(min_bound, max_bound)
+    return np.all((voxels >= mesh_min_bound) & (voxels <= mesh_max_bound), axis=1)
+
+
+def get_triangle_candidates(triangle: np.array) -> np.array:
     bbox_min = np.floor(np.min(triangle, axis=0)).astype(np.int32)
     bbox_max = np.ceil(np.max(triangle, axis=0)).astype(np.int32)
     
     shape = bbox_max - bbox_min + 1
     
-    if (np.all(bbox_max < min_bound) or np.all(bbox_min > max_bound)):
-        return voxels
-    
-    with np.errstate(divide='ignore'):
-        for x in range(shape[0]):
-            for y in range(shape[1]):
-                for z in range(shape[2]):
-                    voxel = np.array([x, y, z]) + bbox_min
-                    if np.all(voxel >= min_bound) and np.all(voxel <= max_bound):
-                        v1, v2, v3 = map(lambda v: Point3(*(v - voxel)), triangle)
-                        if t_c_intersection(Triangle3(v1, v2, v3)):
-                            voxels.add(tuple(map(int, voxel)))
-    return voxels
-
-
-def make_terrain(voxel_list: List, region_size_x: int, region_size_z: int, min_y: int, region_min_x: int, region_min_z: int,
-                 terrain_cover_block, terrain_bottom_block, terrain_blocks: List, offset: int = -8) -> List[tuple]:
-    voxels = []
-    height_matrix = [[None for x in range(region_size_x)] for z in range(region_size_z)]
-    minimal_height = None
-    
-    for x, y, z in voxel_list:
-        if height_matrix[z - region_min_z][x - region_min_x] is None or y < height_matrix[z - region_min_z][x - region_min_x]:
-            height_matrix[z - region_min_z][x - region_min_x] = y
-        if minimal_height is None or y < minimal_height:
-            minimal_height = y
-    
-    for z in range(region_size_z):
-        for x in range(region_size_x):
-            voxels.append(((x + region_min_x, min_y, z + region_min_z), terrain_bottom_block))
-            if height_matrix[z][x] is None:
-                height_matrix[z][x] = minimal_height #max(get_interpolated(height_matrix, x, z) + offset, min_y + 1)
-            voxels.append(((x,height_matrix[z][x],z), terrain_cover_block))
-            for y in range(min_y + 1, height_matrix[z][x]):
-                voxels.append(((x + region_min_x, y, z + region_min_z), choice(terrain_blocks)))
-    return voxels   
-
-
-def get_interpolated(matrix: List[List[int]], x: int, z: int, found_weight: float = 2):
-    length = len(matrix)
-    width = len(matrix[0])
-    
-    divider = 0
-    summ = 0
-    used = []
-    
-    for radius in range(1, int(max(length / 2, width / 2))):
-        z_offset = -radius
-        for x_offset in range(-radius, radius + 1):
-            current_x = min(max(x + x_offset, 0), width - 1)
-            current_z = min(max(z + z_offset, 0), length - 1)
-            if matrix[current_z][current_x] is not None and (current_x, current_z) not in used:
-                summ += matrix[current_z][current_x] / radius
-                divider += 1 / radius
-                used.append((current_x, current_z))
-        
-        for z_offset in range(-radius, radius + 1):
-            x_offset = -radius
-            current_x = min(max(x + x_offset, 0), width - 1)
-            current_z = min(max(z + z_offset, 0), length - 1)
-            if matrix[current_z][current_x] is not None and (current_x, current_z) not in used:
-                summ += matrix[current_z][current_x] / radius
-                divider += 1 / radius
-                used.append((current_x, current_z))
-                
-            x_offset = radius
-            current_x = min(max(x + x_offset, 0), width - 1)
-            current_z = min(max(z + z_offset, 0), length - 1)
-            if matrix[current_z][current_x] is not None and (current_x, current_z) not in used:
-                summ += matrix[current_z][current_x] / radius
-                divider += 1 / radius
-                used.append((current_x, current_z))
-
-        z_offset = radius
-        for x_offset in range(-radius, radius + 1):
-            current_x = min(max(x + x_offset, 0), width - 1)
-            current_z = min(max(z + z_offset, 0), length - 1)
-            if matrix[current_z][current_x] is not None and (current_x, current_z) not in used:
-                summ += matrix[current_z][current_x] / radius
-                divider += 1 / radius
-                used.append((current_x, current_z))
-                
-        if divider == 0:
-            raise ValueError('Empty matrix')
-        return round(summ / divider)
+    grid = get_planar_candidates(triangle, bbox_min, bbox_max)
+    if grid is None:
+        grid = np.stack(np.meshgrid(*(np.arange(size) for size in shape), indexing='ij'), axis=-1).reshape(-1, 3) + bbox_min
+    return grid
+
+
+def get_planar_candidates(triangle: np.array, bbox_min: np.array, bbox_max: np.array) -> np.array:
+    """
+    Conservatively rasterizes the triangle in the plane of its dominant normal axis.
+
+    Every (u, v) cell of the projected bounding box gets only the span of voxels the triangle plane crosses inside
+    that column, so the intersection test sees a thin shell instead of the whole bounding box.
+    Returns None for degenerate triangles.
+    """
+    normal = np.cross(triangle[1] - triangle[0], triangle[2] - triangle[0])
+    w_axis = int(np.argmax(np.abs(normal)))
+    if abs(normal[w_axis]) < EPS:
+        return None
+    u_axis, v_axis = (w_axis + 1) % 3, (w_axis + 2) % 3
+
+    u, v = np.meshgrid(np.arange(bbox_min[u_axis], bbox_max[u_axis] + 1),
+                       np.arange(bbox_min[v_axis], bbox_max[v_axis] + 1), indexing='ij')
+    u, v = u.ravel(), v.ravel()
+
+    # Range of the plane over the cell square, limited to the triangle extent along w
+    w_center = (np.dot(normal, triangle[0]) - normal[u_axis] * u - normal[v_axis] * v) / normal[w_axis]
+    w_half_range = 0.5 * (abs(normal[u_axis]) + abs(normal[v_axis])) / abs(normal[w_axis])
+    w_low = np.maximum(w_center - w_half_range, np.min(triangle[:, w_axis])) - PLANAR_MARGIN
+    w_high = np.minimum(w_center + w_half_range, np.max(triangle[:, w_axis])) + PLANAR_MARGIN
+
+    first = np.maximum(np.ceil(w_low - 0.5), bbox_min[w_axis]).astype(np.int32)
+    last = np.minimum(np.floor(w_high + 0.5), bbox_max[w_axis]).astype(np.int32)
+    counts = np.maximum(last - first + 1, 0)
+
+    candidates = np.empty((int(counts.sum()), 3), dtype=np.int32)
+    candidates[:, u_axis] = np.repeat(u, counts)
+    candidates[:, v_axis] = np.repeat(v, counts)
+    candidates[:, w_axis] = np.repeat(first, counts) + np.arange(len(candidates)) - np.repeat(np.cumsum(counts) - counts, counts)
+    return candidates
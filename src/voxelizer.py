@@ -1,92 +1,118 @@
-from pathlib import Path
-from random import choice
 from typing import List
 
 import numpy as np
 import open3d as o3d
 
+from clipping import cull_triangles
+from voxel_buffer import Palette, TerrainColumns, VoxelBuffer
 
-def voxelize_mesh(mesh_path: Path, min_bound: np.array, max_bound: np.array, offset: np.array) -> List[tuple]:
-    mesh = o3d.io.read_triangle_mesh(str(mesh_path))
+CULL_MARGIN = 2  # Voxels around the bounds whose faces are kept, open3d voxels are off by up to one
+
+
+def voxelize_mesh(vertices: np.array, faces: np.array, min_bound: np.array, max_bound: np.array, offset: np.array,
+                  block_id: str, palette: Palette = None) -> VoxelBuffer:
+    vertices = np.asarray(vertices, dtype=np.float64)
+    faces = np.asarray(faces, dtype=np.int32)
+    faces = faces[cull_triangles(vertices[faces], min_bound - CULL_MARGIN, max_bound + CULL_MARGIN)]
+    if not len(faces):
+        return VoxelBuffer(palette)
+    # Voxel grid origin is at the lowest corner of the mesh, it is kept as an extra vertex so culling does not move it
+    used_vertices, faces = np.unique(faces, return_inverse=True)
+    faces = faces.reshape(-1, 3).astype(np.int32)
+    vertices = np.concatenate([vertices[used_vertices], vertices.min(axis=0, keepdims=True)])
+
+    mesh = o3d.geometry.TriangleMesh(o3d.utility.Vector3dVector(vertices), o3d.utility.Vector3iVector(faces))
 
     voxelized_mesh = o3d.geometry.VoxelGrid.create_from_triangle_mesh(mesh, voxel_size=1)
 
-    voxels = []
+    grid_indices = np.array([voxel.grid_index for voxel in voxelized_mesh.get_voxels()], dtype=np.int32).reshape(-1, 3)
+    if not len(grid_indices):
+        return VoxelBuffer(palette)
+
     in_region_coordinates_translator = np.array([1, 1, 1])
-    half_corrector = 0 if float(
-        voxelized_mesh.get_voxel_center_coordinate(voxelized_mesh.get_voxels()[0].grid_index)[0]) % 1 < 0.5 else 0.5
-    for voxel in voxelized_mesh.get_voxels():
-        voxel_coordinates = np.int32((voxelized_mesh.get_voxel_center_coordinate(voxel.grid_index) - half_corrector)
-                                     * in_region_coordinates_translator)
-        # voxel_coordinates[0], voxel_coordinates[2] = voxel_coordinates[2], voxel_coordinates[0]
-        if np.all(voxel_coordinates >= min_bound) and np.all(voxel_coordinates <= max_bound):
-            voxels.append(tuple(map(round, voxel_coordinates + offset)))
-
-    return voxels
-
-
-def make_terrain(height_matrix, min_y: int, region_min_x: int, region_min_z: int,
-                 terrain_cover_block, terrain_bottom_block, terrain_blocks: List) -> List[tuple]:
-    voxels = []
-
-    for z in range(len(height_matrix)):
-        for x in range(len(height_matrix[z])):
-            voxels.append(((x + region_min_x, min_y, z + region_min_z), terrain_bottom_block))
-            if height_matrix[z][x] is None:
-                height_matrix[z][x] = max(get_interpolated(height_matrix, x, z), min_y + 1)
-            voxels.append(((x + region_min_x, height_matrix[z][x], z + region_min_z), terrain_cover_block))
-            for y in range(min_y + 1, height_matrix[z][x]):
-                voxels.append(((x + region_min_x, y, z + region_min_z), choice(terrain_blocks)))
-    return voxels
-
-
-def get_interpolated(matrix: List[List[int]], x: int, z: int, found_weight: float = 3):
-    length = len(matrix)
-    width = len(matrix[0])
-
-    divider = 0
-    summ = 0
-    used = []
-
-    for radius in range(1, int(max(length / 2, width / 2))):
-        z_offset = -radius
-        for x_offset in range(-radius, radius + 1):
-            current_x = min(max(x + x_offset, 0), width - 1)
-            current_z = min(max(z + z_offset, 0), length - 1)
-            if matrix[current_z][current_x] is not None and (current_x, current_z) not in used:
-                summ += matrix[current_z][current_x] / radius
-                divider += 1 / radius
-                used.append((current_x, current_z))
-
-        for z_offset in range(-radius, radius + 1):
-            x_offset = -radius
-            current_x = min(max(x + x_offset, 0), width - 1)
-            current_z = min(max(z + z_offset, 0), length - 1)
-            if matrix[current_z][current_x] is not None and (current_x, current_z) not in used:
-                summ += matrix[current_z][current_x] / radius
-                divider += 1 / radius
-                used.append((current_x, current_z))
-
-            x_offset = radius
-            current_x = min(max(x + x_offset, 0), width - 1)
-            current_z = min(max(z + z_offset, 0), length - 1)
-            if matrix[current_z][current_x] is not None and (current_x, current_z) not in used:
-                summ += matrix[current_z][current_x] / radius
-                divider += 1 / radius
-                used.append((current_x, current_z))
-
-        z_offset = radius
-        for x_offset in range(-radius, radius + 1):
-            current_x = min(max(x + x_offset, 0), width - 1)
-            current_z = min(max(z + z_offset, 0), length - 1)
-            if matrix[current_z][current_x] is not None and (current_x, current_z) not in used:
-                summ += matrix[current_z][current_x] / radius
-                divider += 1 / radius
-                used.append((current_x, current_z))
-
-        if divider >= found_weight:
-            break
-
-    if divider == 0:
+    half_corrector = 0 if float(voxelized_mesh.get_voxel_center_coordinate(grid_indices[0])[0]) % 1 < 0.5 else 0.5
+    voxel_centers = voxelized_mesh.origin + (grid_indices + 0.5) * voxelized_mesh.voxel_size
+    voxel_coordinates = np.int32((voxel_centers - half_corrector) * in_region_coordinates_translator)
+    # voxel_coordinates[:, [0, 2]] = voxel_coordinates[:, [2, 0]]
+
+    voxel_coordinates = voxel_coordinates[np.all((voxel_coordinates >= min_bound) & (voxel_coordinates <= max_bound),
+                                                 axis=1)]
+    return VoxelBuffer.from_coordinates(np.round(voxel_coordinates + offset), block_id, palette)
+
+
+def get_mesh_bounds(min_bound: np.array, max_bound: np.array) -> tuple:
+    # Mesh axes are the region axes, see voxelize_mesh
+    return min_bound, max_bound
+
+
+def get_region_axes(coordinates: np.array) -> np.array:
+    # Mesh axes are the region axes, see voxelize_mesh
+    return coordinates
+
+
+def get_grid_origin(vertices: np.array) -> np.array:
+    # Voxel grid starts at the lowest corner of the whole mesh, see voxelize_mesh
+    return np.asarray(vertices).min(axis=0)
+
+
+def make_terrain(height_matrix: np.array, min_y: int, region_min_x: int, region_min_z: int,
+                 terrain_cover_block: str, terrain_bottom_block: str, terrain_blocks: List[str],
+                 seed: int = 0) -> TerrainColumns:
+    """
+    Builds terrain columns from min_y to the height of every column, empty (NaN) heights are interpolated.
+    """
+    heights = np.maximum(np.round(fill_gaps(height_matrix)), min_y + 1).astype(np.int32)
+    return TerrainColumns(heights, region_min_x, region_min_z, min_y, terrain_cover_block, terrain_bottom_block,
+                          terrain_blocks, seed)
+
+
+def fill_gaps(matrix: np.array, relaxation_steps: int = 8) -> np.array:
+    """
+    Fills NaN cells of the matrix with a push-pull pyramid.
+
+    Known cells are averaged down into coarser levels until every cell is covered. Coarse levels are then
+    interpolated back up and relaxed towards a Laplace solution where finer ones have no data, so wide gaps like
+    lakes blend between their shores instead of taking the mean height. Known cells keep their values and the time
+    is linear in the matrix size.
+    """
+    known = ~np.isnan(matrix)
+    if not np.any(known):
         raise ValueError('Empty matrix')
-    return round(summ / divider)
+
+    levels = []
+    values, weights = np.where(known, matrix, 0), known.astype(np.float64)
+    while not np.all(weights > 0):
+        levels.append((values, weights))
+        weighted_sums = downsample(values * weights)
+        weight_sums = downsample(weights)
+        values = np.divide(weighted_sums, weight_sums, out=np.zeros_like(weighted_sums), where=weight_sums > 0)
+        weights = np.minimum(weight_sums, 1)
+
+    for fine_values, fine_weights in reversed(levels):
+        values = upsample(values, fine_values.shape)
+        for _ in range(relaxation_steps):
+            values = fine_values * fine_weights + relax(values) * (1 - fine_weights)
+    return values
+
+
+def relax(matrix: np.array) -> np.array:
+    """ Jacobi step of the Laplace equation, every cell becomes the mean of its 4 neighbours. """
+    padded = np.pad(matrix, 1, mode='edge')
+    return (padded[:-2, 1:-1] + padded[2:, 1:-1] + padded[1:-1, :-2] + padded[1:-1, 2:]) / 4
+
+
+def downsample(matrix: np.array) -> np.array:
+    """ Sums 2x2 blocks, odd sides are padded with zeros. """
+    matrix = np.pad(matrix, ((0, matrix.shape[0] % 2), (0, matrix.shape[1] % 2)))
+    return matrix.reshape(matrix.shape[0] // 2, 2, matrix.shape[1] // 2, 2).sum(axis=(1, 3))
+
+
+def upsample(matrix: np.array, shape: tuple) -> np.array:
+    """ Bilinearly interpolates a matrix of 2x2 blocks back to the cell centers of the given shape. """
+    for axis, size in enumerate(shape):
+        positions = np.clip((np.arange(size) + 0.5) / 2 - 0.5, 0, matrix.shape[axis] - 1)
+        low = np.floor(positions).astype(np.int64)
+        high = np.minimum(low + 1, matrix.shape[axis] - 1)
+        alpha = np.expand_dims(positions - low, 1 - axis)
+        matrix = np.take(matrix, low, axis=axis) * (1 - alpha) + np.take(matrix, high, axis=axis) * alpha
+    return matrix